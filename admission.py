@@ -0,0 +1,271 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import math
+import time
+from typing import Dict, Optional
+import logging
+from aiohttp import web
+from aiohttp_rest_api.responses import respond_with_json
+from metrics import endpoint_name, metrics
+
+log = logging.getLogger(__name__)
+
+ACTIVE = metrics.gauge(
+    'admission_active', 'Запросы, допущенные к выполнению', ('endpoint', ))
+QUEUED = metrics.gauge(
+    'admission_queued', 'Запросы в очереди на выполнение', ('endpoint', ))
+WAIT_SECONDS = metrics.histogram(
+    'admission_wait_seconds', 'Ожидание допуска к выполнению',
+    ('endpoint', ))
+REJECTED = metrics.counter(
+    'admission_rejected_total',
+    'Отклонённые запросы: queue_full, queue_timeout, deadline',
+    ('endpoint', 'reason'))
+# сглаживание среднего времени выполнения для Retry-After
+SMOOTHING = 0.2
+MAX_RETRY_AFTER = 60
+
+
+class Overloaded(Exception):
+    """
+    Запрос не допущен к выполнению или не уложился в дедлайн
+    """
+
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Gate:
+    """
+    Допуск запросов одного эндпоинта: не больше max_concurrency
+    выполняются одновременно, не больше max_queue ждут в очереди не дольше
+    queue_timeout секунд, выполнение ограничено timeout секундами. Полная
+    очередь - немедленный отказ
+    """
+
+    def __init__(self, endpoint: str, max_concurrency: int = 4,
+                 max_queue: int = 16, queue_timeout: float = 10.0,
+                 timeout: float = 60.0):
+        self.endpoint = endpoint
+        self.max_concurrency = int(max_concurrency)
+        self.max_queue = int(max_queue)
+        self.queue_timeout = float(queue_timeout)
+        # 0 - без дедлайна
+        self.timeout = float(timeout)
+        self.active = 0
+        self.waiting = 0
+        self.average = None
+        self._semaphore = None
+
+    def retry_after(self) -> int:
+        """
+        Через сколько секунд стоит повторить запрос: время, за которое по
+        среднему времени выполнения освободится очередь
+
+        :rtype: (``int``)
+        :return: секунды
+        """
+        average = self.average or 1.0
+        seconds = average * (self.waiting + 1) / self.max_concurrency
+        return max(1, min(MAX_RETRY_AFTER, math.ceil(seconds)))
+
+    async def acquire(self):
+        """
+        Ожидание допуска. Отказ - Overloaded
+
+        :rtype: (``None``)
+        :return:
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        if not self._semaphore.locked():
+            # свободное место занимается без переключения задач, иначе
+            # одновременные запросы проходят мимо проверки очереди
+            await self._semaphore.acquire()
+            WAIT_SECONDS.observe(0.0, endpoint=self.endpoint)
+            self._admitted()
+            return
+        if self.waiting >= self.max_queue:
+            raise Overloaded('queue_full', self.retry_after())
+
+        self.waiting += 1
+        QUEUED.set(self.waiting, endpoint=self.endpoint)
+        start = time.time()
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(),
+                                   self.queue_timeout)
+        except asyncio.TimeoutError:
+            raise Overloaded('queue_timeout', self.retry_after())
+        finally:
+            self.waiting -= 1
+            QUEUED.set(self.waiting, endpoint=self.endpoint)
+            WAIT_SECONDS.observe(time.time() - start, endpoint=self.endpoint)
+        self._admitted()
+
+    def _admitted(self):
+        self.active += 1
+        ACTIVE.set(self.active, endpoint=self.endpoint)
+
+    def release(self, duration: float):
+        """
+        Освобождение места после выполнения запроса
+
+        :param
+            * *duration* (``float``) -- время выполнения, секунды
+
+        :rtype: (``None``)
+        :return:
+        """
+        self.active -= 1
+        ACTIVE.set(self.active, endpoint=self.endpoint)
+        self._semaphore.release()
+        if self.average is None:
+            self.average = duration
+        else:
+            self.average += SMOOTHING * (duration - self.average)
+
+    async def run(self, request: web.Request, handler) -> web.StreamResponse:
+        """
+        Выполнение обработчика с допуском и дедлайном. Отмена по дедлайну
+        отменяет ожидание парсинга и сравнения в пулах
+
+        :param
+            * *request* (``Request``) -- http запрос
+        :param
+            * *handler* (``callable``) -- обработчик
+
+        :rtype: (``StreamResponse``)
+        :return: ответ обработчика
+        """
+        await self.acquire()
+        start = time.time()
+        try:
+            if self.timeout <= 0:
+                return await handler(request)
+            try:
+                return await asyncio.wait_for(handler(request), self.timeout)
+            except asyncio.TimeoutError:
+                raise Overloaded('deadline', self.retry_after())
+        finally:
+            self.release(time.time() - start)
+
+    def stats(self) -> dict:
+        """
+        Статистика допуска эндпоинта
+
+        :rtype: (``dict``)
+        :return: лимиты, выполняющиеся и ожидающие запросы
+        """
+        return {
+            'max_concurrency': self.max_concurrency,
+            'max_queue': self.max_queue,
+            'active': self.active,
+            'waiting': self.waiting
+        }
+
+
+class AdmissionController:
+    """
+    Допуск запросов к ресурсоёмким эндпоинтам. Вместо неограниченной
+    очереди работы в пулах перегрузка отдаётся клиентам быстрым 503 с
+    Retry-After, остальные запросы продолжают выполняться в своём темпе
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.gates = dict()
+
+    def configure(self, enabled: bool = None,
+                  endpoints: Dict[str, dict] = None, **kwargs):
+        """
+        Перенастройка допуска из конфига приложения
+
+        :param
+            * *enabled* (``bool``) -- ограничение допуска
+        :param
+            * *endpoints* (``Dict[str, dict]``) -- параметры Gate по пути
+            эндпоинта
+
+        :rtype: (``None``)
+        :return:
+        """
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if endpoints is not None:
+            self.gates = {path: Gate(path, **params)
+                          for path, params in endpoints.items()}
+
+    def gate(self, request: web.Request) -> Optional[Gate]:
+        """
+        Допуск эндпоинта запроса
+
+        :param
+            * *request* (``Request``) -- http запрос
+
+        :rtype: (``Gate``)
+        :return: допуск, либо None - без ограничений
+        """
+        if not self.enabled:
+            return None
+        return self.gates.get(endpoint_name(request))
+
+    def stats(self) -> dict:
+        """
+        Статистика допуска по эндпоинтам
+
+        :rtype: (``dict``)
+        :return: статистика Gate по пути эндпоинта
+        """
+        return {k: v.stats() for k, v in self.gates.items()}
+
+
+admission = AdmissionController()
+
+
+async def mark_prepared(request: web.Request, response: web.StreamResponse):
+    """
+    Отметка о начале отправки ответа, хук on_response_prepare: после неё
+    дедлайн обрывает соединение вместо ответа 503
+
+    :param
+        * *request* (``Request``) -- http запрос
+    :param
+        * *response* (``StreamResponse``) -- ответ
+
+    :rtype: (``None``)
+    :return:
+    """
+    request['prepared'] = True
+
+
+@web.middleware
+async def admission_middleware(request: web.Request, handler):
+    """
+    Допуск запроса к эндпоинту с ограничением конкурентности, очереди и
+    времени выполнения
+
+    :param
+        * *request* (``Request``) -- http запрос
+    :param
+        * *handler* (``callable``) -- обработчик
+
+    :rtype: (``StreamResponse``)
+    :return: ответ обработчика, либо 503 с Retry-After
+    """
+    gate = admission.gate(request)
+    if gate is None:
+        return await handler(request)
+
+    try:
+        return await gate.run(request, handler)
+    except Overloaded as e:
+        REJECTED.inc(endpoint=gate.endpoint, reason=e.reason)
+        log.warning(f'OVERLOADED {gate.endpoint} {e.reason}')
+        if request.get('prepared'):
+            raise
+        return respond_with_json(
+            {'error': f'Service overloaded ({e.reason}), retry later'},
+            status=503,
+            additional_headers={'Retry-After': str(e.retry_after)})
@@ -6,6 +6,20 @@ import logging
 import pathlib
 import pytoml as toml
 import os
+from admission import admission, admission_middleware, mark_prepared
+from executor import diff_executor, parse_executor
+from external_diff import external_diff
+from http_cache import response_cache
+from coalescing import flights
+from itinerary_store import load_store
+from metrics import metrics, metrics_middleware
+from profiling import add_profile_header, profiler, profiling_middleware
+from parse_cache import parsed_cache
+from prefork import PreforkServer
+from responses import uploads
+from snapshot import snapshots
+from watcher import watcher
+from xml_parser import DATA_DIR, FILENAMES, load_cached
 
 BASE_DIR = pathlib.Path(__file__).parent.parent
 PACKAGE_NAME = 'app'
@@ -37,8 +51,29 @@ def init_app(config: dict) -> Application:
     :rtype: (``Application``)
     :return: web приложение
     """
-    app = web.Application()
+    app = web.Application(middlewares=[metrics_middleware,
+                                       admission_middleware,
+                                       profiling_middleware])
     app['config'] = config
+    metrics.configure(**config.get('metrics', {}))
+    profiler.configure(**config.get('profiling', {}))
+    app.on_response_prepare.append(add_profile_header)
+    admission.configure(**config.get('admission', {}))
+    app.on_response_prepare.append(mark_prepared)
+    parsed_cache.configure(**config.get('cache', {}))
+    parse_executor.configure(**config.get('executor', {}))
+    diff_executor.configure(**dict(config.get('diff_executor', {}),
+                                   kind='process'))
+    snapshots.configure(**config.get('snapshot', {}))
+    uploads.configure(**config.get('responses', {}))
+    response_cache.configure(**config.get('http_cache', {}))
+    external_diff.configure(**config.get('external_diff', {}))
+    watcher.configure(**config.get('watcher', {}))
+    app.on_startup.append(warm_up_executor)
+    app.on_startup.append(load_snapshots)
+    app.on_startup.append(start_watcher)
+    app.on_cleanup.append(stop_watcher)
+    app.on_cleanup.append(shutdown_executor)
 
     load_and_connect_all_endpoints_from_folder(
         path='{0}/{1}'.format(os.path.dirname(os.path.realpath(__file__)),
@@ -51,6 +86,129 @@ def init_app(config: dict) -> Application:
     return app
 
 
+def register_collectors():
+    """
+    Метрики из статистики кэшей, пулов парсинга и объединения запросов,
+    снимаются при запросе /v1/metrics
+
+    :rtype: (``None``)
+    :return:
+    """
+    metrics.stats_collector(
+        'parse_cache', 'Кэш распарсенных файлов', parsed_cache.stats,
+        counters=('hits', 'misses', 'evictions', 'stale_hits'))
+    metrics.stats_collector(
+        'response_cache', 'Кэш сжатых тел ответов', response_cache.stats,
+        counters=('hits', 'misses', 'not_modified', 'evictions'))
+    metrics.stats_collector(
+        'executor', 'Пулы парсинга',
+        lambda: {x.name: x.stats() for x in (parse_executor, diff_executor)},
+        label='executor')
+    metrics.stats_collector(
+        'coalescing', 'Объединение одновременных одинаковых запросов',
+        lambda: {k: v.stats() for k, v in flights.items()},
+        counters=('leaders', 'coalesced', 'cancelled'), label='name')
+
+
+register_collectors()
+
+
+async def warm_up_executor(app: Application):
+    """
+    Прогрев процессного пула diff при старте приложения
+
+    :param
+        * *app* (``Application``) -- web приложение
+
+    :rtype: (``None``)
+    :return:
+    """
+    await diff_executor.warm_up()
+
+
+async def load_snapshots(app: Application):
+    """
+    Загрузка хранилищ вариантов перелёта всех файлов при старте
+    приложения, чтобы первый запрос не ждал парсинга. Хранилища берутся из
+    снимков, при их отсутствии файлы парсятся и снимки сохраняются
+
+    :param
+        * *app* (``Application``) -- web приложение
+
+    :rtype: (``None``)
+    :return:
+    """
+    if not app['config'].get('snapshot', {}).get('preload', True):
+        return
+    for filename in FILENAMES.values():
+        file_path = f'{DATA_DIR}/{filename}'
+        try:
+            await load_cached(file_path, 'store', load_store)
+        except Exception as e:
+            log.warning(f'PRELOAD FAILED {filename}: {e!r}')
+
+
+def preload_stores(config: dict):
+    """
+    Синхронная загрузка хранилищ всех файлов в мастер-процессе до запуска
+    воркеров: воркеры получают их через fork без повторной загрузки
+
+    :param
+        * *config* (``dict``) -- конфиг приложения
+
+    :rtype: (``None``)
+    :return:
+    """
+    parsed_cache.configure(**config.get('cache', {}))
+    snapshots.configure(**config.get('snapshot', {}))
+    for filename in FILENAMES.values():
+        try:
+            parsed_cache.get_or_parse(f'{DATA_DIR}/{filename}', 'store',
+                                      load_store)
+        except Exception as e:
+            log.warning(f'PRELOAD FAILED {filename}: {e!r}')
+
+
+async def start_watcher(app: Application):
+    """
+    Запуск наблюдения за каталогом данных после загрузки хранилищ
+
+    :param
+        * *app* (``Application``) -- web приложение
+
+    :rtype: (``None``)
+    :return:
+    """
+    await watcher.start()
+
+
+async def stop_watcher(app: Application):
+    """
+    Остановка наблюдения за каталогом данных до остановки пулов
+
+    :param
+        * *app* (``Application``) -- web приложение
+
+    :rtype: (``None``)
+    :return:
+    """
+    await watcher.stop()
+
+
+async def shutdown_executor(app: Application):
+    """
+    Остановка пулов парсинга при остановке приложения
+
+    :param
+        * *app* (``Application``) -- web приложение
+
+    :rtype: (``None``)
+    :return:
+    """
+    parse_executor.shutdown()
+    diff_executor.shutdown()
+
+
 def main(config_path: str):
     """
     Запуск REST API
@@ -65,11 +223,21 @@ def main(config_path: str):
 
     config = load_config(config_path)
 
-    logging.basicConfig(level=logging.DEBUG)
-    app = init_app(config)
     app_config = config.get('app', None)
+    logging.basicConfig(level=app_config.get('loglevel', 'INFO'))
+    port = app_config.get('port', 9999)
+    workers = int(app_config.get('workers', 1))
+
+    if workers > 1:
+        server = PreforkServer(
+            lambda: init_app(config), port, workers,
+            preload=lambda: preload_stores(config),
+            **config.get('prefork', {}))
+        server.run()
+        return
 
-    web.run_app(app, port=app_config.get('port', 9999))
+    app = init_app(config)
+    web.run_app(app, port=port)
 
 
 if __name__ == '__main__':
@@ -1,36 +1,33 @@
 # -*- coding: utf-8 -*-
 import time
-import dateutil.parser
+from typing import Iterator
 import logging
-from xml_parser import parse_xml_to_dict
+from coalescing import coalesce
+from executor import parse_executor
+from itinerary_store import ACTIONS, get_itinerary_store, load_store
+from metrics import observe_stage
+from route_index import load_routes
+from timestamps import format_travel_time, parse_timestamp
+from xml_parser import build_schema, get_file_path, load_cached_set
 
 log = logging.getLogger(__name__)
 
+ROUTE_FILTERS = ('origin', 'destination', 'carrier', 'max_stops')
 
-async def get_travel_info(input_data: (list, dict)) -> (str, int, bool):
+
+async def get_travel_info(segments: tuple) -> (str, int, bool):
     """
     Получение информаии о полёте
 
     :param
-        * *input_data* (``list or dict``) -- входные данные о полёте(ах)
+        * *segments* (``tuple``) -- билеты полёта (Segment)
 
     :rtype: (``str, int, bool``)
     :return:
     """
-    is_direct_flight = True
-    if isinstance(input_data, list):
-        is_direct_flight = False
-        departure_timestamps = [x['DepartureTimeStamp'] for x in input_data]
-        arrival_timestamps = [x['ArrivalTimeStamp'] for x in input_data]
-        time_info, total_time = await get_travel_time(departure_timestamps[0],
-                                                      arrival_timestamps[1])
-
-    else:
-        departure_timestamp = input_data.get('DepartureTimeStamp')
-        arrival_timestamp = input_data.get('ArrivalTimeStamp')
-
-        time_info, total_time = await get_travel_time(departure_timestamp,
-                                                      arrival_timestamp)
+    is_direct_flight = len(segments) == 1
+    time_info, total_time = await get_travel_time(segments[0].departure,
+                                                  segments[-1].arrival)
 
     return time_info, total_time, is_direct_flight
 
@@ -50,14 +47,9 @@ async def get_travel_time(departure_timestamp: str,
     :return: time_info - текстовое представление общего времени полёта,
     total_time - общее время для анализа
     """
-    departure_time = dateutil.parser.isoparse(departure_timestamp)
-    arrival_time = dateutil.parser.isoparse(arrival_timestamp)
-    delta = arrival_time - departure_time
-
-    total_time = (delta.days * 86400) + delta.seconds
-    time_info = f'{delta.seconds//3600}ч {(delta.seconds//60)%60}м'
-    if delta.days:
-        time_info = f'{delta.days}д {time_info}'
+    total_time = (parse_timestamp(arrival_timestamp) -
+                  parse_timestamp(departure_timestamp)) * 60
+    time_info = format_travel_time(total_time)
 
     return time_info, total_time
 
@@ -131,51 +123,149 @@ async def sort_data(data: dict, action: str, filters: dict,
     return sorted_data
 
 
+@coalesce('get_flight_tickets')
 async def get_flight_tickets(**kwargs) -> dict:
-    """"""
+    """
+    Получение обогащённых и отсортированных вариантов перелёта
+
+    :param kwargs:
+        * *need_return* (``str``) -- наличие обратного маршрута
+        * *response_id* (``str``) -- идентификатор загруженного ответа
+        * *action* (``str``) -- выбор метода сортировки
+        * *fields* (``Iterable[str]``) -- пути к нужным полям варианта
+        перелёта, по умолчанию все поля
+        * *limit* (``int``) -- количество вариантов, по умолчанию все
+        * *offset* (``int``) -- смещение от начала выборки
+        * *weights* (``tuple``) -- веса (цена, время туда, время обратно)
+        для сортировки optimal
+
+    :rtype: (``dict``)
+    :return: варианты перелёта, общие для одновременных одинаковых запросов
+    """
     action = kwargs.get('action')
-    need_return = kwargs.get('need_return')
-    filters = {
-        'price': 'total_amout',
-        'onward': 'onward_total_time',
-        'return': 'return_total_time'
-    }
+    fields = kwargs.get('fields')
+    schema = build_schema(fields) if fields else True
 
-    data = await parse_xml_to_dict(**kwargs)
+    store = await get_itinerary_store(**kwargs)
 
     start_sort = time.time()
 
-    for flights in data:
-
-        onward_flight = data[flights]['OnwardPricedItinerary']['Flights'][
-            'Flight']
-        onward_time_info, onward_total_time, onward_is_direct_flight = \
-            await get_travel_info(onward_flight)
-
-        return_time_info = None
-        return_is_direct_flight = None
-        return_total_time = None
-        if data[flights].get('ReturnPricedItinerary'):
-            return_flight = data[flights]['ReturnPricedItinerary']['Flights'][
-                'Flight']
-            return_time_info, return_total_time, return_is_direct_flight = \
-                await get_travel_info(return_flight)
-
-        total_amount = next((x['text'] for x in data[flights]['Pricing'][
-            'ServiceCharges'] if x['type'] == 'SingleAdult' and
-                             x['ChargeType'] == 'TotalAmount'), None)
-
-        data[flights].update({
-            'total_amout': float(total_amount),
-            'onward_total_time': onward_total_time,
-            'onward_time_info': onward_time_info,
-            'onward_is_direct_flight': onward_is_direct_flight,
-            'return_total_time': return_total_time,
-            'return_time_info': return_time_info,
-            'return_is_direct_flight': return_is_direct_flight
-        })
-
-    data = await sort_data(data, action, filters, need_return)
-    log.info(f'ENDED SORTING {time.time() - start_sort} sec')
+    page = store.page(action, kwargs.get('limit'), kwargs.get('offset') or 0,
+                      kwargs.get('weights'))
+    data = {int(x): store.ticket(x, schema) for x in page}
+    elapsed = observe_stage('sort', start_sort, len(data))
+    log.info(f'ENDED SORTING {elapsed} sec')
 
     return data
+
+
+@coalesce('flight_tickets')
+async def select_flight_tickets(**kwargs) -> tuple:
+    """
+    Выбор страницы отсортированных вариантов перелёта: хранилище файла,
+    поиск по индексу маршрутов и сортировка. Одновременные одинаковые
+    запросы выполняют выбор один раз. Параметры - как у iter_flight_tickets
+
+    :rtype: (``tuple``)
+    :return: хранилище вариантов перелёта и номера вариантов страницы
+    """
+    subset = None
+    filters = {x: kwargs.get(x) for x in ROUTE_FILTERS}
+    file_path = get_file_path(kwargs.get('need_return'),
+                              kwargs.get('response_id'))
+    if file_path and any(x is not None for x in filters.values()):
+        # хранилище и индекс маршрутов одной версии файла: номера
+        # вариантов индекса указывают в хранилище
+        loaded = await load_cached_set(file_path, {
+            'store': (load_store, (), parse_executor),
+            'routes': (load_routes, (), parse_executor)})
+        store = loaded['store']
+        subset = loaded['routes'].search(**filters)
+    else:
+        store = await get_itinerary_store(**kwargs)
+
+    start_sort = time.time()
+    page = store.page(kwargs.get('action'), kwargs.get('limit'),
+                      kwargs.get('offset') or 0, kwargs.get('weights'),
+                      subset)
+    elapsed = observe_stage('sort', start_sort, len(page))
+    log.info(f'ENDED SORTING {elapsed} sec')
+    return store, page
+
+
+async def iter_flight_tickets(**kwargs) -> Iterator[tuple]:
+    """
+    Обогащённые и отсортированные варианты перелёта по одному: страница
+    выбирается сразу, данные варианта собираются при обходе
+
+    :param kwargs:
+        * *need_return* (``str``) -- наличие обратного маршрута
+        * *response_id* (``str``) -- идентификатор загруженного ответа
+        * *action* (``str``) -- выбор метода сортировки
+        * *fields* (``Iterable[str]``) -- пути к нужным полям варианта
+        перелёта, по умолчанию все поля
+        * *limit* (``int``) -- количество вариантов, по умолчанию все
+        * *offset* (``int``) -- смещение от начала выборки
+        * *weights* (``tuple``) -- веса (цена, время туда, время обратно)
+        для сортировки optimal
+        * *origin* (``str``) -- начало плеча перелёта
+        * *destination* (``str``) -- конец плеча перелёта
+        * *carrier* (``str``) -- ID перевозчика
+        * *max_stops* (``int``) -- максимум пересадок в плече
+
+    :rtype: (``Iterator[tuple]``)
+    :return: пары (индекс варианта, данные варианта)
+    """
+    fields = kwargs.get('fields')
+    schema = build_schema(fields) if fields else True
+    # выбор страницы не зависит от полей, запросы с разными fields
+    # выбирают её один раз
+    store, page = await select_flight_tickets(
+        **{k: v for k, v in kwargs.items() if k != 'fields'})
+    return ((int(x), store.ticket(x, schema)) for x in page)
+
+
+def page_params(query) -> dict:
+    """
+    Разбор и проверка параметров выборки вариантов перелёта из запроса:
+    action, fields, limit, offset, weights, а также need_return, если не
+    задан загруженный ответ. Ошибка - ValueError с текстом для ответа 400
+
+    :param
+        * *query* (``Mapping``) -- параметры запроса
+
+    :rtype: (``dict``)
+    :return: параметры для iter_flight_tickets
+    """
+    if not query.get('response') and \
+            get_file_path(query.get('need_return', 'true')) is None:
+        raise ValueError('need_return= must be true or false')
+    action = query.get('action', 'cheap')
+    if action not in ACTIONS:
+        raise ValueError(f'action= must be one of: {", ".join(ACTIONS)}')
+    # порядок полей не влияет на ответ
+    fields = sorted({x for x in query.get('fields', '').split(',') if x})
+    try:
+        limit = query.get('limit')
+        limit = int(limit) if limit is not None else None
+        offset = int(query.get('offset', 0))
+    except ValueError:
+        raise ValueError('limit= and offset= must be integers') from None
+    if (limit is not None and limit < 0) or offset < 0:
+        raise ValueError('limit= and offset= must be non-negative')
+    weights = query.get('weights')
+    if weights:
+        try:
+            weights = tuple(float(x) for x in weights.split(','))
+        except ValueError:
+            weights = ()
+        if len(weights) != 3:
+            raise ValueError('weights= must be 3 numbers: price,onward,'
+                             'return')
+    return {
+        'action': action,
+        'fields': fields,
+        'limit': limit,
+        'offset': offset,
+        'weights': weights
+    }
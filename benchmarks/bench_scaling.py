@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+Бенчмарк масштабирования парсинга, обогащения, сортировки и сравнения на
+синтетических ответах партнёра (benchmarks/synthetic.py) от 1k до 1M
+вариантов перелёта.
+
+Каждый замер - холодный: кэш распарсенных файлов очищается, снимки
+выключены, пулы парсинга - потоковые, чтобы пиковая память (tracemalloc)
+учитывала всю работу. Время - лучшее из --repeat запусков, память -
+отдельным запуском под tracemalloc. Результаты пишутся в JSON, при
+наличии базового файла замедление или рост памяти больше --tolerance
+отмечаются как регрессия, код выхода 1.
+
+Запуск из корня проекта:
+python benchmarks/bench_scaling.py --scales 1000,10000,100000
+python benchmarks/bench_scaling.py --save-baseline
+"""
+import argparse
+import asyncio
+import datetime
+import gc
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+import app_methods  # noqa: E402
+import xml_parser  # noqa: E402
+from executor import diff_executor, parse_executor  # noqa: E402
+from itinerary_store import ACTIONS, get_itinerary_store  # noqa: E402
+from parse_cache import parsed_cache  # noqa: E402
+from snapshot import snapshots  # noqa: E402
+from synthetic import generate  # noqa: E402
+
+DEFAULT_SCALES = (1000, 10000, 100000)
+DATA_DIR = os.path.join(BENCH_DIR, '.data')
+RESULTS = os.path.join(BENCH_DIR, 'results.json')
+BASELINE = os.path.join(BENCH_DIR, 'baseline.json')
+# отправная точка синтетических ответов, как у файлов-образцов
+SOURCE = 'DXB'
+# размер страницы в замере хранилища
+PAGE_LIMIT = 20
+FILTERS = {
+    'price': 'total_amout',
+    'onward': 'onward_total_time',
+    'return': 'return_total_time'
+}
+
+
+class Responses:
+    """
+    Синтетические ответы одного масштаба: туда-обратно, в одну сторону и
+    парный к ответу в одну сторону для сравнения
+    """
+
+    def __init__(self, directory: str, scale: int):
+        self.scale = scale
+        self.round_trip = generate(directory, 'return', scale)
+        self.one_way = generate(directory, 'oneway', scale)
+        self.one_way_changed = generate(directory, 'oneway', scale,
+                                        changed=True)
+
+
+async def _drain(items: AsyncIterator) -> int:
+    # замер потокового парсинга: обход всех вариантов без накопления
+    count = 0
+    async for _ in items:
+        count += 1
+    return count
+
+
+async def _enriched(responses: Responses) -> tuple:
+    # вход sort_data: обогащённые варианты перелёта, как до хранилища
+    store = await get_itinerary_store(response_id=responses.round_trip)
+    data = {x: store.ticket(x) for x in range(len(store.itineraries))}
+    return data, 'cheap', FILTERS, 'true'
+
+
+async def _store(responses: Responses) -> tuple:
+    # вход замера хранилища: колоночное хранилище без построенных
+    # перестановок
+    store = await get_itinerary_store(response_id=responses.round_trip)
+    return store,
+
+
+async def _pages(store) -> int:
+    # первая страница до построения перестановки (отбор np.argpartition),
+    # затем полная перестановка и страница из неё для каждого метода
+    count = 0
+    for action in ACTIONS:
+        count += len(store.page(action, limit=PAGE_LIMIT))
+        store.order(action)
+        count += len(store.page(action, limit=PAGE_LIMIT,
+                                offset=PAGE_LIMIT))
+    return count
+
+
+async def _onward(responses: Responses) -> tuple:
+    # вход compare_xml: группировка билетов обоих файлов
+    data_f1 = await xml_parser.diff_parse_xml(responses.one_way, SOURCE)
+    data_f2 = await xml_parser.diff_parse_xml(responses.one_way_changed,
+                                              SOURCE)
+    return data_f1, data_f2, SOURCE
+
+
+class Benchmark:
+    """
+    Замеряемый вызов: prepare готовит аргументы вне замера, run -
+    замеряемая корутина
+    """
+
+    def __init__(self, name: str, run: Callable[..., Awaitable],
+                 prepare: Callable[[Responses], Awaitable[tuple]] = None):
+        self.name = name
+        self.run = run
+        self.prepare = prepare
+
+    async def arguments(self, responses: Responses) -> tuple:
+        if self.prepare is None:
+            return responses,
+        args = await self.prepare(responses)
+        # подготовка не должна давать тёплый кэш замеру
+        parsed_cache.invalidate()
+        return args
+
+
+BENCHMARKS = [
+    Benchmark('parse_xml_to_dict', lambda r: _drain(
+        xml_parser.parse_xml_to_dict(response_id=r.round_trip))),
+    Benchmark('parse_xml', lambda r: xml_parser.parse_xml(
+        response_id=r.round_trip)),
+    Benchmark('diff_parse_xml', lambda r: xml_parser.diff_parse_xml(
+        r.one_way, SOURCE)),
+    Benchmark('get_flight_tickets', lambda r: app_methods.get_flight_tickets(
+        response_id=r.round_trip, action='cheap')),
+    Benchmark('sort_data', app_methods.sort_data, _enriched),
+    Benchmark('select_flight_tickets',
+              lambda r: app_methods.select_flight_tickets(
+                  response_id=r.round_trip, action='cheap')),
+    Benchmark('ItineraryStore.page', _pages, _store),
+    Benchmark('compare_xml', xml_parser.compare_xml, _onward),
+]
+
+
+async def measure(benchmark: Benchmark, responses: Responses,
+                  repeat: int) -> dict:
+    """
+    Холодные замеры одного вызова на одном масштабе
+
+    :param
+        * *benchmark* (``Benchmark``) -- замеряемый вызов
+    :param
+        * *responses* (``Responses``) -- синтетические ответы
+    :param
+        * *repeat* (``int``) -- количество замеров времени
+
+    :rtype: (``dict``)
+    :return: лучшее и все времена в секундах, пиковая память в байтах
+    """
+    times = list()
+    for _ in range(repeat):
+        parsed_cache.invalidate()
+        args = await benchmark.arguments(responses)
+        gc.collect()
+        start = time.perf_counter()
+        await benchmark.run(*args)
+        times.append(time.perf_counter() - start)
+        del args
+
+    parsed_cache.invalidate()
+    args = await benchmark.arguments(responses)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        await benchmark.run(*args)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    parsed_cache.invalidate()
+    return {'time': min(times), 'times': times, 'peak_memory': peak}
+
+
+async def run(scales: List[int], names: List[str], repeat: int,
+              directory: str) -> Dict[str, dict]:
+    """
+    Замеры выбранных вызовов на всех масштабах
+
+    :param
+        * *scales* (``List[int]``) -- количество вариантов перелёта
+    :param
+        * *names* (``List[str]``) -- имена вызовов
+    :param
+        * *repeat* (``int``) -- количество замеров времени
+    :param
+        * *directory* (``str``) -- каталог синтетических ответов
+
+    :rtype: (``Dict[str, dict]``)
+    :return: {вызов: {масштаб: результат}}
+    """
+    results = {x: dict() for x in names}
+    for scale in scales:
+        start = time.perf_counter()
+        responses = Responses(directory, scale)
+        print(f'-- {scale} itineraries '
+              f'(data {time.perf_counter() - start:.1f} sec)')
+        for benchmark in BENCHMARKS:
+            if benchmark.name not in names:
+                continue
+            result = await measure(benchmark, responses, repeat)
+            results[benchmark.name][str(scale)] = result
+            print(f'{benchmark.name:<24} {result["time"] * 1e3:12.1f} ms '
+                  f'{result["peak_memory"] / 2 ** 20:10.1f} MiB')
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict],
+            tolerance: float) -> List[str]:
+    """
+    Регрессии относительно базовых результатов: время или пиковая память
+    больше базовых в (1 + tolerance) раз
+
+    :param
+        * *results* (``Dict[str, dict]``) -- текущие результаты
+    :param
+        * *baseline* (``Dict[str, dict]``) -- базовые результаты
+    :param
+        * *tolerance* (``float``) -- допустимое относительное ухудшение
+
+    :rtype: (``List[str]``)
+    :return: описания регрессий
+    """
+    regressions = list()
+    for name, scales in results.items():
+        for scale, result in scales.items():
+            base = baseline.get(name, {}).get(scale)
+            if not base:
+                continue
+            for metric in ('time', 'peak_memory'):
+                if not base.get(metric):
+                    continue
+                ratio = result[metric] / base[metric]
+                if ratio > 1 + tolerance:
+                    regressions.append(
+                        f'{name} {scale} {metric}: {base[metric]:.6g} -> '
+                        f'{result[metric]:.6g} (x{ratio:.2f})')
+    return regressions
+
+
+def _load(path: str) -> Optional[dict]:
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save(path: str, report: dict):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description='Бенчмарк масштабирования на синтетических ответах')
+    parser.add_argument('--scales',
+                        default=','.join(map(str, DEFAULT_SCALES)),
+                        help='количество вариантов перелёта через запятую, '
+                             'до 1000000')
+    parser.add_argument('--only',
+                        default=','.join(x.name for x in BENCHMARKS),
+                        help='замеряемые вызовы через запятую')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='количество замеров времени')
+    parser.add_argument('--data-dir', default=DATA_DIR,
+                        help='каталог синтетических ответов')
+    parser.add_argument('--output', default=RESULTS,
+                        help='файл результатов JSON')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='файл базовых результатов JSON')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='сохранить результаты как базовые')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='допустимое относительное ухудшение')
+    args = parser.parse_args()
+
+    names = [x for x in args.only.split(',') if x]
+    unknown = set(names) - {x.name for x in BENCHMARKS}
+    if unknown:
+        parser.error(f'unknown benchmarks: {", ".join(sorted(unknown))}')
+    scales = [int(x) for x in args.scales.split(',') if x]
+
+    # синтетические ответы - загруженные ответы из каталога данных
+    xml_parser.RESPONSES_DIR = args.data_dir
+    snapshots.configure(enabled=False, write=False)
+    parse_executor.configure(kind='thread', max_workers=1)
+    diff_executor.configure(kind='thread', max_workers=1)
+    parsed_cache.configure(max_entries=4)
+
+    try:
+        results = asyncio.run(run(scales, names, args.repeat,
+                                  args.data_dir))
+    finally:
+        parse_executor.shutdown()
+        diff_executor.shutdown()
+
+    report = {
+        'meta': {
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': args.repeat
+        },
+        'results': results
+    }
+    _save(args.output, report)
+    print(f'results: {args.output}')
+    if args.save_baseline:
+        _save(args.baseline, report)
+        print(f'baseline: {args.baseline}')
+        return 0
+
+    baseline = _load(args.baseline)
+    if baseline is None:
+        print('no baseline, run with --save-baseline to store one')
+        return 0
+    regressions = compare(results, baseline['results'], args.tolerance)
+    for regression in regressions:
+        print(f'REGRESSION {regression}')
+    if not regressions:
+        print(f'no regressions against {args.baseline}')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Микробенчмарк разбора времени партнёра: parse_timestamp против
+dateutil.parser.isoparse, которым время разбиралось раньше.
+
+Запуск из корня проекта: python benchmarks/bench_timestamps.py
+"""
+import os
+import sys
+import timeit
+import xml.etree.ElementTree as ET
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(
+    __file__))))
+
+from timestamps import parse_timestamp  # noqa: E402
+from xml_parser import DATA_DIR, FILENAMES  # noqa: E402
+
+
+def load_timestamps() -> list:
+    """
+    Все времена вылета и прилёта из файлов data/ в порядке следования
+
+    :rtype: (``list``)
+    :return: время в формате партнёра
+    """
+    timestamps = list()
+    for filename in FILENAMES.values():
+        root = ET.parse(f'{DATA_DIR}/{filename}').getroot()
+        for tag in ('DepartureTimeStamp', 'ArrivalTimeStamp'):
+            timestamps.extend(x.text for x in root.iter(tag))
+    return timestamps
+
+
+def main(number: int = 20):
+    timestamps = load_timestamps()
+    print(f'{len(timestamps)} timestamps, '
+          f'{len(set(timestamps))} unique, {number} runs')
+
+    def memo():
+        for x in timestamps:
+            parse_timestamp(x)
+
+    def cold():
+        parse_timestamp.cache_clear()
+        memo()
+
+    results = [('parse_timestamp (memo)', memo),
+               ('parse_timestamp (cold)', cold)]
+    try:
+        import dateutil.parser
+    except ImportError:
+        print('python-dateutil is not installed, skipping isoparse')
+    else:
+        def isoparse():
+            for x in timestamps:
+                dateutil.parser.isoparse(x)
+        results.append(('dateutil isoparse', isoparse))
+
+    for name, func in results:
+        best = min(timeit.repeat(func, number=number, repeat=5)) / number
+        per_call = best / len(timestamps) * 1e9
+        print(f'{name:<24} {best * 1e3:8.3f} ms/run {per_call:8.1f} ns/call')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,330 @@
+# -*- coding: utf-8 -*-
+"""
+Генератор синтетических ответов партнёра AirFareSearchResponse по образцу
+файлов data/: варианты перелёта берутся из встроенных файлов как шаблоны,
+у копий меняются номера рейсов, время и цены. Результат воспроизводим:
+вариант с номером i зависит только от seed и i.
+
+Запуск из корня проекта:
+python benchmarks/synthetic.py -n 100000 -k return -o /tmp/response.xml
+"""
+import argparse
+import copy
+import datetime
+import hashlib
+import os
+import random
+import sys
+import xml.etree.ElementTree as ET
+from functools import lru_cache
+from typing import Iterator, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(
+    __file__))))
+
+from xml_parser import DATA_DIR, FILENAMES, \
+    iter_itinerary_elements  # noqa: E402
+
+# меняется вместе с алгоритмом генерации, чтобы не брать старые файлы
+GENERATOR_VERSION = 1
+# вид ответа - файл-образец
+KINDS = {'return': FILENAMES['1'], 'oneway': FILENAMES['2']}
+HEADER = ('<?xml version="1.0" encoding="utf-8"?>\n'
+          '<AirFareSearchResponse RequestTime="28-09-2015 20:23:49" '
+          'ResponseTime="28-09-2015 20:23:56">\n'
+          '    <RequestId>{request_id}</RequestId>\n'
+          '    <PricedItineraries>\n')
+# формат времени в ответах партнёра: 2018-10-22T0005
+TIMESTAMP_FORMAT = '%Y-%m-%dT%H%M'
+FOOTER = '    </PricedItineraries>\n</AirFareSearchResponse>\n'
+# доли изменённых, удалённых и добавленных вариантов в парном файле
+CHANGED, DROPPED, ADDED = 0.1, 0.05, 0.05
+
+
+class Template:
+    """
+    Вариант перелёта файла-образца, заранее сериализованный в xml с
+    пропусками на месте изменяемых значений: времени вылета и прилёта,
+    номера рейса первого билета туда и цены. Новый вариант - подстановка
+    значений без копирования и сериализации дерева
+    """
+    # разделитель пропусков в сериализованном xml
+    MARK = '\x01'
+
+    def __init__(self, elem: ET.Element):
+        elem = copy.deepcopy(elem)
+        self.values = list()
+        self.timestamps = list()
+        self.arrivals = list()
+        self.flight = None
+        self.base = self.total = None
+        self.taxes = 0.0
+
+        for tag in ('DepartureTimeStamp', 'ArrivalTimeStamp'):
+            for node in elem.iter(tag):
+                slot = self._slot(node)
+                self.timestamps.append(slot)
+                if tag == 'ArrivalTimeStamp':
+                    self.arrivals.append(slot)
+        node = elem.find('OnwardPricedItinerary/Flights/Flight/FlightNumber')
+        if node is not None:
+            self.flight = self._slot(node)
+        charges = {x.get('ChargeType'): x
+                   for x in elem.iter('ServiceCharges')
+                   if x.get('type') == 'SingleAdult'}
+        if all(x in charges for x in ('BaseFare', 'AirlineTaxes',
+                                      'TotalAmount')):
+            self.taxes = float(charges['AirlineTaxes'].text)
+            self.base = self._slot(charges['BaseFare'])
+            self.total = self._slot(charges['TotalAmount'])
+
+        elem.tail = '\n'
+        parts = ('        ' + ET.tostring(elem, encoding='unicode')).split(
+            self.MARK)
+        self.texts = parts[0::2]
+        self.order = [int(x) for x in parts[1::2]]
+
+    def _slot(self, node: ET.Element) -> int:
+        slot = len(self.values)
+        self.values.append(node.text.strip())
+        node.text = f'{self.MARK}{slot}{self.MARK}'
+        return slot
+
+    def set_price(self, values: list, factor: float):
+        """
+        Базовая цена, умноженная на factor, и пересчитанная полная
+
+        :param
+            * *values* (``list``) -- значения пропусков варианта
+        :param
+            * *factor* (``float``) -- множитель цены
+
+        :rtype: (``None``)
+        :return:
+        """
+        if self.base is None:
+            return
+        amount = round(float(values[self.base]) * factor, 2)
+        values[self.base] = f'{amount:.2f}'
+        values[self.total] = f'{amount + self.taxes:.2f}'
+
+    def render(self, values: list) -> str:
+        """
+        Вариант перелёта в xml
+
+        :param
+            * *values* (``list``) -- значения пропусков варианта
+
+        :rtype: (``str``)
+        :return: элемент Flights верхнего уровня
+        """
+        out = [self.texts[0]]
+        for slot, text in zip(self.order, self.texts[1:]):
+            out.append(values[slot])
+            out.append(text)
+        return ''.join(out)
+
+
+def load_templates(kind: str) -> List[Template]:
+    """
+    Шаблоны вариантов перелёта файла-образца
+
+    :param
+        * *kind* (``str``) -- вид ответа: return или oneway
+
+    :rtype: (``List[Template]``)
+    :return: шаблоны
+    """
+    with open(f'{DATA_DIR}/{KINDS[kind]}', 'rb') as f:
+        return [Template(x) for x in iter_itinerary_elements(f)]
+
+
+@lru_cache(maxsize=65536)
+def _shift(value: str, minutes: int) -> str:
+    moment = datetime.datetime.strptime(value, TIMESTAMP_FORMAT)
+    moment += datetime.timedelta(minutes=minutes)
+    return moment.strftime(TIMESTAMP_FORMAT)
+
+
+def make_itinerary(templates: List[Template], seed: int,
+                   index: int) -> tuple:
+    """
+    Вариант перелёта с номером index: шаблон со сдвигом времени, другим
+    номером рейса билета из отправной точки и другой ценой
+
+    :param
+        * *templates* (``List[Template]``) -- шаблоны
+    :param
+        * *seed* (``int``) -- зерно генератора
+    :param
+        * *index* (``int``) -- номер варианта перелёта
+
+    :rtype: (``tuple``)
+    :return: шаблон и значения его пропусков
+    """
+    rng = random.Random(seed * 1000003 + index)
+    template = rng.choice(templates)
+    values = list(template.values)
+    minutes = rng.randrange(60) * 1440 + rng.randrange(-120, 121, 5)
+    for slot in template.timestamps:
+        values[slot] = _shift(values[slot], minutes)
+    if template.flight is not None:
+        values[template.flight] = str(rng.randint(1, 9999))
+    template.set_price(values, rng.uniform(0.7, 1.5))
+    return template, values
+
+
+def change_itinerary(template: Template, values: list,
+                     rng: random.Random):
+    """
+    Изменение варианта перелёта для парного файла: цена или время
+    прилёта одного из билетов
+
+    :param
+        * *template* (``Template``) -- шаблон варианта
+    :param
+        * *values* (``list``) -- значения пропусков варианта
+    :param
+        * *rng* (``random.Random``) -- генератор
+
+    :rtype: (``None``)
+    :return:
+    """
+    if rng.random() < 0.5 or not template.arrivals:
+        template.set_price(values, rng.uniform(0.9, 1.1))
+    else:
+        slot = rng.choice(template.arrivals)
+        values[slot] = _shift(values[slot], rng.choice((-30, 30, 60)))
+
+
+def iter_response(kind: str, count: int, seed: int = 0,
+                  changed: bool = False) -> Iterator[str]:
+    """
+    Варианты перелёта синтетического ответа. Парный файл (changed) - тот
+    же ответ, где часть вариантов изменена, удалена или добавлена
+
+    :param
+        * *kind* (``str``) -- вид ответа: return или oneway
+    :param
+        * *count* (``int``) -- количество вариантов исходного ответа
+    :param
+        * *seed* (``int``) -- зерно генератора
+    :param
+        * *changed* (``bool``) -- парный файл для сравнения
+
+    :rtype: (``Iterator[str]``)
+    :return: элементы Flights верхнего уровня в xml
+    """
+    templates = load_templates(kind)
+    for index in range(count):
+        template, values = make_itinerary(templates, seed, index)
+        if not changed:
+            yield template.render(values)
+            continue
+        rng = random.Random(~(seed * 1000003 + index))
+        value = rng.random()
+        if value < DROPPED:
+            continue
+        if value < DROPPED + CHANGED:
+            change_itinerary(template, values, rng)
+        yield template.render(values)
+        if rng.random() < ADDED:
+            template, values = make_itinerary(templates, seed + 1, index)
+            yield template.render(values)
+
+
+def write_response(path: str, kind: str, count: int, seed: int = 0,
+                   changed: bool = False) -> str:
+    """
+    Запись синтетического ответа в файл
+
+    :param
+        * *path* (``str``) -- путь к файлу
+    :param
+        * *kind* (``str``) -- вид ответа: return или oneway
+    :param
+        * *count* (``int``) -- количество вариантов перелёта
+    :param
+        * *seed* (``int``) -- зерно генератора
+    :param
+        * *changed* (``bool``) -- парный файл для сравнения
+
+    :rtype: (``str``)
+    :return: sha256 содержимого - идентификатор загруженного ответа
+    """
+    digest = hashlib.sha256()
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        def write(text: str):
+            data = text.encode()
+            digest.update(data)
+            f.write(data)
+
+        write(HEADER.format(request_id=f'SYN{seed}{kind[0].upper()}'))
+        for text in iter_response(kind, count, seed, changed):
+            write(text)
+        write(FOOTER)
+    os.replace(tmp, path)
+    return digest.hexdigest()
+
+
+def generate(directory: str, kind: str, count: int, seed: int = 0,
+             changed: bool = False) -> str:
+    """
+    Синтетический ответ в каталоге directory под именем <sha256>.xml, как
+    у загруженных ответов. Готовый файл с теми же параметрами не
+    пересоздаётся
+
+    :param
+        * *directory* (``str``) -- каталог ответов
+    :param
+        * *kind* (``str``) -- вид ответа: return или oneway
+    :param
+        * *count* (``int``) -- количество вариантов перелёта
+    :param
+        * *seed* (``int``) -- зерно генератора
+    :param
+        * *changed* (``bool``) -- парный файл для сравнения
+
+    :rtype: (``str``)
+    :return: идентификатор ответа
+    """
+    os.makedirs(directory, exist_ok=True)
+    name = f'v{GENERATOR_VERSION}-{kind}-{count}-{seed}' + \
+        ('-changed' if changed else '')
+    link = os.path.join(directory, f'{name}.id')
+    if os.path.exists(link):
+        with open(link) as f:
+            response_id = f.read().strip()
+        if os.path.exists(os.path.join(directory, f'{response_id}.xml')):
+            return response_id
+
+    tmp = os.path.join(directory, f'{name}.xml')
+    response_id = write_response(tmp, kind, count, seed, changed)
+    os.replace(tmp, os.path.join(directory, f'{response_id}.xml'))
+    with open(link, 'w') as f:
+        f.write(response_id)
+    return response_id
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Синтетический ответ партнёра AirFareSearchResponse')
+    parser.add_argument('-n', '--count', type=int, default=1000,
+                        help='количество вариантов перелёта')
+    parser.add_argument('-k', '--kind', choices=sorted(KINDS),
+                        default='return', help='вид ответа')
+    parser.add_argument('-s', '--seed', type=int, default=0,
+                        help='зерно генератора')
+    parser.add_argument('--changed', action='store_true',
+                        help='парный файл для сравнения')
+    parser.add_argument('-o', '--output', required=True,
+                        help='путь к файлу')
+    args = parser.parse_args()
+    response_id = write_response(args.output, args.kind, args.count,
+                                 args.seed, args.changed)
+    print(f'{args.output} sha256 {response_id}')
+
+
+if __name__ == '__main__':
+    main()
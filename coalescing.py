@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+import logging
+
+log = logging.getLogger(__name__)
+
+# все группы по имени, для статистики
+flights = dict()
+
+
+class SingleFlight:
+    """
+    Объединение одновременных одинаковых запросов: пока вычисление по ключу
+    выполняется, новые вызовы с тем же ключом ждут его результат, а не
+    запускают своё. Вычисление защищено от отмены отдельным ожидающим и
+    отменяется, только когда его больше никто не ждёт
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.leaders = 0
+        self.coalesced = 0
+        self.cancelled = 0
+        self._tasks = dict()
+        self._waiters = dict()
+
+    @property
+    def in_flight(self) -> int:
+        """
+        Количество выполняющихся вычислений
+        """
+        return len(self._tasks)
+
+    async def do(self, key, func, *args, **kwargs):
+        """
+        Выполнение корутины func(*args, **kwargs) или ожидание уже
+        выполняющейся по тому же ключу
+
+        :param
+            * *key* (``hashable``) -- нормализованный ключ запроса
+        :param
+            * *func* (``callable``) -- асинхронная функция
+
+        :return: результат вычисления, общий для всех ожидающих
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func(*args, **kwargs))
+            self._tasks[key] = task
+            self._waiters[key] = 0
+            task.add_done_callback(functools.partial(self._done, key))
+            self.leaders += 1
+        else:
+            self.coalesced += 1
+
+        self._waiters[key] += 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.done() and self._waiters[key] == 1:
+                # ожидающих больше нет, вычисление никому не нужно
+                task.cancel()
+                self.cancelled += 1
+            raise
+        finally:
+            if self._tasks.get(key) is task:
+                self._waiters[key] -= 1
+
+    def _done(self, key, task: asyncio.Future):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+            del self._waiters[key]
+        if not task.cancelled() and task.exception() is not None:
+            log.info(f'{self.name} {key} failed: {task.exception()!r}')
+
+    def stats(self) -> dict:
+        """
+        Статистика объединения запросов
+
+        :rtype: (``dict``)
+        :return: количество вычислений, объединённых и отменённых запросов
+        """
+        return {
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+            'cancelled': self.cancelled,
+            'in_flight': self.in_flight
+        }
+
+
+def _freeze(value):
+    # порядок списков и кортежей значим (веса optimal), не значим только
+    # порядок множеств
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(map(_freeze, value), key=repr))
+    if isinstance(value, (list, tuple)):
+        return tuple(map(_freeze, value))
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def query_key(*args, **kwargs) -> tuple:
+    """
+    Нормализованный ключ запроса: пустые параметры отбрасываются,
+    коллекции приводятся к кортежам, множества - к отсортированным,
+    need_return - к нижнему регистру
+
+    :rtype: (``tuple``)
+    :return: ключ запроса
+    """
+    params = list()
+    for name, value in sorted(kwargs.items()):
+        if value is None or value == '' or value == [] or value == ():
+            continue
+        if name == 'need_return' and isinstance(value, str):
+            value = value.lower()
+        params.append((name, _freeze(value)))
+    return tuple(_freeze(x) for x in args), tuple(params)
+
+
+def coalesce(name: str, key=query_key):
+    """
+    Декоратор асинхронной функции, объединяющий одновременные вызовы с
+    одинаковым нормализованным ключом. Результат общий для всех
+    ожидающих и не должен изменяться
+
+    :param
+        * *name* (``str``) -- имя группы для статистики
+    :param
+        * *key* (``callable``) -- построение ключа из аргументов вызова
+
+    :rtype: (``callable``)
+    :return: декоратор
+    """
+    def decorator(func):
+        flight = flights.setdefault(name, SingleFlight(name))
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            return await flight.do(key(*args, **kwargs), func, *args,
+                                   **kwargs)
+
+        wrapper.flight = flight
+        return wrapper
+    return decorator
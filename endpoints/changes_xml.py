@@ -0,0 +1,38 @@
+from typing import List
+from aiohttp.web import Request
+from aiohttp.web_response import Response
+from aiohttp_rest_api import AioHTTPRestEndpoint
+from aiohttp_rest_api.responses import respond_with_json
+from watcher import watcher
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class ChangesEndpoint(AioHTTPRestEndpoint):
+
+    def connected_routes(self) -> List[str]:
+        """"""
+        return [
+            '/changes'
+        ]
+
+    async def get(self, request: Request) -> Response:
+        """
+        GET метод /v1/changes фоновые пересборки изменённых файлов каталога
+        данных: добавленные, удалённые и изменённые варианты перелёта,
+        новые записи первыми. file= - только пересборки одного файла
+
+        :param
+            * *request* (``Request``) -- http запрос
+
+        :rtype: (``Response``)
+        :return: ответ на запрос в формате JSON
+        """
+        filename = request.query.get('file')
+        changes = [x for x in reversed(watcher.changes)
+                   if not filename or x['file'] == filename]
+        return respond_with_json({
+            'watcher': watcher.stats(),
+            'changes': changes
+        })
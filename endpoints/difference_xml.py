@@ -1,10 +1,13 @@
-import itertools
+import asyncio
 from typing import List
 from aiohttp.web import Request
-from aiohttp.web_response import Response
+from aiohttp.web_response import StreamResponse
 from aiohttp_rest_api import AioHTTPRestEndpoint
 from aiohttp_rest_api.responses import respond_with_json
-from xml_parser import parse_xml
+from http_cache import response_cache
+from streaming import section_records
+from xml_parser import compare_tags, get_file_path, get_response_path, \
+    parse_xml
 import logging
 
 log = logging.getLogger(__name__)
@@ -18,7 +21,7 @@ class DifferenceEndpoint(AioHTTPRestEndpoint):
             '/diff'
         ]
 
-    async def get(self, request: Request) -> Response:
+    async def get(self, request: Request) -> StreamResponse:
         """
         GET метод /v1/diff получение различия тегов и атрибутов между двумя
         xml файлами
@@ -26,31 +29,31 @@ class DifferenceEndpoint(AioHTTPRestEndpoint):
         :param
             * *request* (``Request``) -- http запрос
 
-        :rtype: (``Response``)
-        :return: ответ на запрос в формате JSON
+        :rtype: (``StreamResponse``)
+        :return: ответ на запрос в формате JSON или NDJSON
         """
         action = request.query.get('action', 'cheap')
-
-        data_file1 = await parse_xml(need_return='true', action=action)
-        data_file2 = await parse_xml(need_return='false', action=action)
-
-        diff = dict()
-        diff['tags'] = data_file1['tags'] - data_file2['tags']
-
-        intersect = [item for item in data_file1['attributes']
-                     if item in data_file2['attributes']]
-        sym_diff = [item for item in
-                    itertools.chain(data_file1['attributes'],
-                                    data_file2['attributes'])
-                    if item not in intersect]
-
-        # визуальная эстетика
-        attrib = dict()
-        for el in sym_diff:
-            tag = el.pop('tag')
-            if tag not in attrib.keys():
-                attrib.update({f'{tag}': []})
-            attrib[tag].append(el)
-
-        diff['attributes'] = attrib
-        return respond_with_json(diff)
+        # загруженные ответы вместо встроенных файлов
+        response_ids = (request.query.get('response1'),
+                        request.query.get('response2'))
+        for response_id in response_ids:
+            if response_id and not get_response_path(response_id):
+                return respond_with_json(
+                    {'error': 'unknown response1= or response2= id'})
+
+        etag, cached = response_cache.lookup(request, [
+            get_file_path('true', response_ids[0]),
+            get_file_path('false', response_ids[1])])
+        if cached is not None:
+            return cached
+
+        # файлы независимы, парсятся параллельно в процессном пуле
+        data_file1, data_file2 = await asyncio.gather(
+            parse_xml(need_return='true', response_id=response_ids[0],
+                      action=action),
+            parse_xml(need_return='false', response_id=response_ids[1],
+                      action=action))
+
+        diff = await compare_tags(data_file1, data_file2)
+        return await response_cache.respond(request, etag, diff,
+                                            section_records)
@@ -0,0 +1,31 @@
+from typing import List
+from aiohttp.web import Request
+from aiohttp.web_response import Response
+from aiohttp_rest_api import AioHTTPRestEndpoint
+from metrics import CONTENT_TYPE, metrics
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class MetricsEndpoint(AioHTTPRestEndpoint):
+
+    def connected_routes(self) -> List[str]:
+        """"""
+        return [
+            '/metrics'
+        ]
+
+    async def get(self, request: Request) -> Response:
+        """
+        GET метод /v1/metrics метрики процесса в текстовом формате
+        Prometheus: время запросов и стадий, кэши, пулы парсинга
+
+        :param
+            * *request* (``Request``) -- http запрос
+
+        :rtype: (``Response``)
+        :return: метрики
+        """
+        return Response(body=metrics.render().encode(),
+                        headers={'Content-Type': CONTENT_TYPE})
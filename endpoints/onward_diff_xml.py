@@ -1,10 +1,15 @@
-import itertools
+import asyncio
 from typing import List
 from aiohttp.web import Request
-from aiohttp.web_response import Response
+from aiohttp.web_response import StreamResponse
 from aiohttp_rest_api import AioHTTPRestEndpoint
 from aiohttp_rest_api.responses import respond_with_json
-from xml_parser import diff_parse_xml, compare_xml
+from executor import diff_executor
+from external_diff import external_diff
+from http_cache import response_cache
+from route_index import get_route_index
+from streaming import section_records
+from xml_parser import diff_parse_xml, compare_xml, get_file_key_path
 import logging
 
 log = logging.getLogger(__name__)
@@ -18,7 +23,7 @@ class DifferenceEndpoint(AioHTTPRestEndpoint):
             '/onward_diff'
         ]
 
-    async def get(self, request: Request) -> Response:
+    async def get(self, request: Request) -> StreamResponse:
         """
         GET метод /v1/onward_diff получение различия между xml файлами
         по тегу OnwardPricedItinerary
@@ -26,20 +31,61 @@ class DifferenceEndpoint(AioHTTPRestEndpoint):
         :param
             * *request* (``Request``) -- http запрос
 
-        :rtype: (``Response``)
-        :return: ответ на запрос в формате JSON
+        :rtype: (``StreamResponse``)
+        :return: ответ на запрос в формате JSON или NDJSON
         """
         option = request.query.get('option', '1')
+        mode = request.query.get('mode', 'auto')
+        if mode not in ('auto', 'memory', 'external'):
+            return respond_with_json(
+                {'error': 'mode= can be "auto", "memory" or "external"'})
 
         if option == '1':
-            data_f1 = await diff_parse_xml('1')
-            data_f2 = await diff_parse_xml('2')
+            keys = ('1', '2')
         elif option == '2':
-            data_f1 = await diff_parse_xml('2')
-            data_f2 = await diff_parse_xml('1')
+            keys = ('2', '1')
         else:
             return respond_with_json({'error': 'option= can be "1" or "2"'})
+        # загруженные ответы вместо встроенных файлов
+        keys = (request.query.get('response1') or keys[0],
+                request.query.get('response2') or keys[1])
+        if not all(map(get_file_key_path, keys)):
+            return respond_with_json(
+                {'error': 'unknown response1= or response2= id'})
 
-        compare = await compare_xml(data_f1, data_f2)
+        file_paths = list(map(get_file_key_path, keys))
+        etag, cached = response_cache.lookup(request, file_paths)
+        if cached is not None:
+            return cached
 
-        return respond_with_json(compare)
+        if mode == 'auto':
+            mode = 'external' if external_diff.wanted(file_paths) \
+                else 'memory'
+        source = request.query.get('origin', '').upper()
+
+        if mode == 'external':
+            # большие файлы сравниваются через диск с ограниченной памятью
+            source = source or \
+                await external_diff.detect_origin(file_paths[0])
+            compare = await external_diff.compare(file_paths, source)
+            try:
+                # слияние и кодирование идут задачами пула, event loop
+                # только пишет готовые порции
+                return await response_cache.respond(
+                    request, etag, compare, section_records,
+                    executor=diff_executor)
+            finally:
+                # при обрыве соединения временные файлы удаляются сразу
+                compare.close()
+
+        # по умолчанию отправная точка - самая частая у сравнивающего файла
+        source = source or (await get_route_index(file_paths[0])).origin
+
+        # файлы независимы, парсятся параллельно в процессном пуле
+        data_f1, data_f2 = await asyncio.gather(
+            *(diff_parse_xml(x, source) for x in keys))
+
+        compare = await compare_xml(data_f1, data_f2, source)
+
+        return await response_cache.respond(request, etag, compare,
+                                            section_records)
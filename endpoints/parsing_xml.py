@@ -1,9 +1,12 @@
 from typing import List
 from aiohttp.web import Request
-from aiohttp.web_response import Response
+from aiohttp.web_response import StreamResponse
 from aiohttp_rest_api import AioHTTPRestEndpoint
 from aiohttp_rest_api.responses import respond_with_json
-from app_methods import get_flight_tickets
+from app_methods import iter_flight_tickets, page_params
+from http_cache import response_cache
+from streaming import LazyObject
+from xml_parser import get_file_path, get_response_path
 import logging
 
 log = logging.getLogger(__name__)
@@ -17,19 +20,34 @@ class ParseEndpoint(AioHTTPRestEndpoint):
             '/parse'
         ]
 
-    async def get(self, request: Request) -> Response:
+    async def get(self, request: Request) -> StreamResponse:
         """
         GET метод /v1/parse получение выборки данных о полётах
 
         :param
             * *request* (``Request``) -- http запрос
 
-        :rtype: (``Response``)
-        :return: ответ на запрос в формате JSON
+        :rtype: (``StreamResponse``)
+        :return: ответ на запрос в формате JSON или NDJSON
         """
         need_return = request.query.get('need_return', 'true')
-        action = request.query.get('action', 'cheap')
-
-        data = await get_flight_tickets(need_return=need_return, action=action)
-
-        return respond_with_json(data)
+        response_id = request.query.get('response')
+        if response_id and not get_response_path(response_id):
+            return respond_with_json({'error': 'unknown response= id'})
+        try:
+            params = page_params(request.query)
+        except ValueError as e:
+            return respond_with_json({'error': str(e)}, status=400)
+
+        etag, cached = response_cache.lookup(
+            request, [get_file_path(need_return, response_id)])
+        if cached is not None:
+            return cached
+
+        tickets = await iter_flight_tickets(need_return=need_return,
+                                            response_id=response_id,
+                                            **params)
+
+        # варианты перелёта кодируются и отдаются по мере готовности
+        return await response_cache.respond(request, etag,
+                                            LazyObject(tickets), depth=1)
@@ -0,0 +1,43 @@
+from typing import List
+from aiohttp.web import Request
+from aiohttp.web_response import Response
+from aiohttp_rest_api import AioHTTPRestEndpoint
+from aiohttp_rest_api.responses import respond_with_json
+from profiling import profiler
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class ProfilesEndpoint(AioHTTPRestEndpoint):
+
+    def connected_routes(self) -> List[str]:
+        """"""
+        return [
+            '/profiles'
+        ]
+
+    async def get(self, request: Request) -> Response:
+        """
+        GET метод /v1/profiles отчёты профилирования запросов: с id= -
+        отчёт запроса из заголовка X-Profile-Id, без него - список отчётов
+        и общий профиль выборочно профилированных запросов
+
+        :param
+            * *request* (``Request``) -- http запрос
+
+        :rtype: (``Response``)
+        :return: ответ на запрос в формате JSON
+        """
+        profile_id = request.query.get('id')
+        if profile_id:
+            report = profiler.reports.get(profile_id)
+            if report is None:
+                return respond_with_json({'error': 'unknown id='})
+            return respond_with_json(report)
+
+        return respond_with_json({
+            'enabled': profiler.enabled,
+            'profiles': profiler.list(),
+            'sampled': profiler.aggregate()
+        })
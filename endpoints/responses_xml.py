@@ -0,0 +1,65 @@
+import xml.etree.ElementTree as ET
+from typing import List
+from aiohttp.web import Request
+from aiohttp.web_response import Response
+from aiohttp_rest_api import AioHTTPRestEndpoint
+from aiohttp_rest_api.responses import respond_with_json
+from itinerary_model import InvalidItinerary
+from responses import CHUNK_SIZE, UploadTooLarge, uploads
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class ResponsesEndpoint(AioHTTPRestEndpoint):
+
+    def connected_routes(self) -> List[str]:
+        """"""
+        return [
+            '/responses'
+        ]
+
+    async def get(self, request: Request) -> Response:
+        """
+        GET метод /v1/responses получение идентификаторов загруженных
+        ответов партнёра
+
+        :param
+            * *request* (``Request``) -- http запрос
+
+        :rtype: (``Response``)
+        :return: ответ на запрос в формате JSON
+        """
+        return respond_with_json({'responses': uploads.list()})
+
+    async def post(self, request: Request) -> Response:
+        """
+        POST метод /v1/responses загрузка ответа партнёра в теле запроса.
+        Ответ парсится по мере загрузки, идентификатор ответа принимают
+        параметры response= /v1/parse и response1=, response2= /v1/diff и
+        /v1/onward_diff
+
+        :param
+            * *request* (``Request``) -- http запрос
+
+        :rtype: (``Response``)
+        :return: ответ на запрос в формате JSON
+        """
+        if request.content_length and \
+                request.content_length > uploads.max_size:
+            return respond_with_json(
+                {'error': f'response is larger than {uploads.max_size} '
+                          f'bytes'}, status=413)
+        try:
+            data = await uploads.receive(
+                request.content.iter_chunked(CHUNK_SIZE))
+        except UploadTooLarge as e:
+            return respond_with_json({'error': str(e)}, status=413)
+        except ET.ParseError as e:
+            return respond_with_json({'error': f'invalid xml: {e}'},
+                                     status=400)
+        except InvalidItinerary as e:
+            return respond_with_json({'error': f'invalid response: {e}'},
+                                     status=400)
+
+        return respond_with_json(data, status=201 if data['created'] else 200)
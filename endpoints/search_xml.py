@@ -0,0 +1,66 @@
+from typing import List
+from aiohttp.web import Request
+from aiohttp.web_response import StreamResponse
+from aiohttp_rest_api import AioHTTPRestEndpoint
+from aiohttp_rest_api.responses import respond_with_json
+from app_methods import iter_flight_tickets, page_params
+from http_cache import response_cache
+from streaming import LazyObject
+from xml_parser import get_file_path, get_response_path
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class SearchEndpoint(AioHTTPRestEndpoint):
+
+    def connected_routes(self) -> List[str]:
+        """"""
+        return [
+            '/search'
+        ]
+
+    async def get(self, request: Request) -> StreamResponse:
+        """
+        GET метод /v1/search поиск вариантов перелёта по маршруту: есть
+        плечо from -> to с перевозчиком carrier и не больше max_stops
+        пересадок. Сортировка и выборка полей - как у /v1/parse
+
+        :param
+            * *request* (``Request``) -- http запрос
+
+        :rtype: (``StreamResponse``)
+        :return: ответ на запрос в формате JSON или NDJSON
+        """
+        need_return = request.query.get('need_return', 'true')
+        response_id = request.query.get('response')
+        if response_id and not get_response_path(response_id):
+            return respond_with_json({'error': 'unknown response= id'})
+        try:
+            params = page_params(request.query)
+        except ValueError as e:
+            return respond_with_json({'error': str(e)}, status=400)
+        try:
+            max_stops = request.query.get('max_stops')
+            max_stops = int(max_stops) if max_stops else None
+        except ValueError:
+            return respond_with_json(
+                {'error': 'max_stops= must be an integer'})
+        filters = {
+            'origin': request.query.get('from', '').upper() or None,
+            'destination': request.query.get('to', '').upper() or None,
+            'carrier': request.query.get('carrier', '').upper() or None,
+            'max_stops': max_stops
+        }
+
+        etag, cached = response_cache.lookup(
+            request, [get_file_path(need_return, response_id)])
+        if cached is not None:
+            return cached
+
+        tickets = await iter_flight_tickets(need_return=need_return,
+                                            response_id=response_id,
+                                            **params, **filters)
+
+        return await response_cache.respond(request, etag,
+                                            LazyObject(tickets), depth=1)
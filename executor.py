@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, \
+    ThreadPoolExecutor
+from itertools import islice
+from typing import AsyncIterator, Iterator
+import logging
+from metrics import metrics, run_collected
+from profiling import current, run_profiled
+
+log = logging.getLogger(__name__)
+
+WAIT_SECONDS = metrics.histogram(
+    'executor_wait_seconds', 'Ожидание свободного места в пуле парсинга',
+    ('executor', ))
+CANCELLED = metrics.counter(
+    'executor_cancelled_total', 'Задачи пула, отменённые вызывающим',
+    ('executor', ))
+
+EXECUTOR_KINDS = ('thread', 'process')
+# элементов синхронного итератора в одной задаче пула
+BATCH_SIZE = 1000
+
+_local = threading.local()
+
+
+class TaskCancelled(Exception):
+    """
+    Задача пула прервана: вызывающий отменил ожидание результата
+    """
+
+
+def run_cancellable(event: threading.Event, func, *args):
+    """
+    Выполнение функции в потоке пула с признаком отмены, который функция
+    проверяет через check_cancelled
+
+    :param
+        * *event* (``Event``) -- признак отмены
+    :param
+        * *func* (``callable``) -- функция
+    :param
+        * *args* -- аргументы функции
+
+    :return: результат функции
+    """
+    _local.event = event
+    try:
+        return func(*args)
+    finally:
+        _local.event = None
+
+
+def check_cancelled():
+    """
+    Прерывание задачи потока пула, ожидание которой отменено. Вне пула и в
+    процессах пула ничего не делает
+
+    :rtype: (``None``)
+    :return:
+    """
+    event = getattr(_local, 'event', None)
+    if event is not None and event.is_set():
+        raise TaskCancelled()
+
+
+class ParseExecutor:
+    """
+    Выделенный пул для синхронного парсинга файлов целиком, чтобы не
+    блокировать event loop. Количество одновременно выполняемых задач
+    ограничено семафором, остальные ждут своей очереди в event loop
+    """
+
+    def __init__(self, kind: str = 'thread', max_workers: int = 4,
+                 max_concurrency: int = None, name: str = 'parse'):
+        self.name = name
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_concurrency = max_concurrency or max_workers
+        self._executor = None
+        self._semaphore = None
+        self.waiting = 0
+        self.running = 0
+
+    def configure(self, kind: str = None, max_workers: int = None,
+                  max_concurrency: int = None, **kwargs):
+        """
+        Перенастройка пула из конфига приложения. Действующий пул
+        останавливается
+
+        :param
+            * *kind* (``str``) -- тип пула thread или process
+        :param
+            * *max_workers* (``int``) -- размер пула
+        :param
+            * *max_concurrency* (``int``) -- максимум одновременных задач
+
+        :rtype: (``None``)
+        :return:
+        """
+        if kind is not None and kind not in EXECUTOR_KINDS:
+            raise ValueError(f'executor kind must be one of {EXECUTOR_KINDS}')
+        self.shutdown()
+        self.kind = kind or self.kind
+        self.max_workers = int(max_workers or self.max_workers)
+        self.max_concurrency = int(max_concurrency or self.max_workers)
+
+    @property
+    def executor(self) -> Executor:
+        """
+        Пул, создаётся при первом обращении
+        """
+        if self._executor is None:
+            if self.kind == 'process':
+                self._executor = ProcessPoolExecutor(self.max_workers)
+            else:
+                self._executor = ThreadPoolExecutor(
+                    self.max_workers, thread_name_prefix='parse')
+            log.info(f'EXECUTOR {self.kind} x {self.max_workers}')
+        return self._executor
+
+    async def run(self, func, *args):
+        """
+        Выполнение синхронной функции в пуле с ограничением
+        конкурентности. Отмена ожидания прерывает задачу потока пула на
+        ближайшей проверке check_cancelled, задача процесса пула
+        отменяется, только если ещё не начала выполняться
+
+        :param
+            * *func* (``callable``) -- функция, для process пула должна
+            импортироваться по имени
+        :param
+            * *args* -- аргументы функции
+
+        :return: результат функции
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        semaphore = self._semaphore
+        loop = asyncio.get_event_loop()
+
+        self.waiting += 1
+        start = time.time()
+        try:
+            await semaphore.acquire()
+        finally:
+            self.waiting -= 1
+            WAIT_SECONDS.observe(time.time() - start, executor=self.name)
+        self.running += 1
+        # задачи профилируемого запроса выполняются под cProfile
+        profile = current()
+        profiled = profile is not None and profile.deterministic
+        if profiled:
+            func, args = run_profiled, (func, ) + args
+        event = threading.Event()
+        try:
+            if self.kind != 'process':
+                result = await loop.run_in_executor(
+                    self.executor, run_cancellable, event, func, *args)
+            else:
+                # метрики стадий из процесса пула
+                result, state = await loop.run_in_executor(
+                    self.executor, run_collected, func, *args)
+                metrics.merge(state)
+            if profiled:
+                result, stats = result
+                profile.add_stats(stats)
+            return result
+        except asyncio.CancelledError:
+            event.set()
+            CANCELLED.inc(executor=self.name)
+            raise
+        finally:
+            self.running -= 1
+            semaphore.release()
+
+    async def iterate(self, iterator: Iterator,
+                      batch_size: int = BATCH_SIZE) -> AsyncIterator[list]:
+        """
+        Обход синхронного итератора пакетами: каждый пакет собирается
+        задачей пула, event loop только получает готовые пакеты. Состояние
+        итератора не передать в процесс, поэтому для process пула пакеты
+        собираются в потоковом пуле event loop. Отмена ожидания дожидается
+        сборки текущего пакета, чтобы итератор можно было закрыть
+
+        :param
+            * *iterator* (``Iterator``) -- синхронный итератор
+        :param
+            * *batch_size* (``int``) -- элементов в пакете
+
+        :rtype: (``AsyncIterator[list]``)
+        :return: непустые пакеты элементов
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            if self.kind == 'process':
+                task = loop.run_in_executor(None, _next_batch, iterator,
+                                            batch_size)
+            else:
+                task = asyncio.ensure_future(
+                    self.run(_next_batch, iterator, batch_size))
+            try:
+                batch = await asyncio.shield(task)
+            except asyncio.CancelledError:
+                await asyncio.wait({task})
+                raise
+            if not batch:
+                return
+            yield batch
+
+    async def warm_up(self):
+        """
+        Прогрев пула: запуск всех процессов заранее, чтобы первый запрос не
+        платил за их старт и импорт модулей
+
+        :rtype: (``None``)
+        :return:
+        """
+        loop = asyncio.get_event_loop()
+        start = time.time()
+        pids = await asyncio.gather(*(
+            loop.run_in_executor(self.executor, _warm_up_worker)
+            for _ in range(self.max_workers)))
+        log.info(f'EXECUTOR {self.kind} warmed up {len(set(pids))} workers '
+                 f'{time.time() - start} sec')
+
+    def stats(self) -> dict:
+        """
+        Статистика пула
+
+        :rtype: (``dict``)
+        :return: размер пула, лимит, ожидающие и выполняющиеся задачи
+        """
+        return {
+            'workers': self.max_workers,
+            'max_concurrency': self.max_concurrency,
+            'queue_depth': self.waiting,
+            'running': self.running
+        }
+
+    def shutdown(self, wait: bool = True):
+        """
+        Остановка пула
+
+        :param
+            * *wait* (``bool``) -- дождаться завершения задач
+
+        :rtype: (``None``)
+        :return:
+        """
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+        self._executor = None
+        self._semaphore = None
+
+
+def _next_batch(iterator: Iterator, size: int) -> list:
+    return list(islice(iterator, size))
+
+
+def _warm_up_worker() -> int:
+    # импорт парсеров в процессе пула и небольшая пауза, чтобы задачи
+    # прогрева разошлись по разным процессам
+    import xml_parser  # noqa: F401
+    time.sleep(0.05)
+    return os.getpid()
+
+
+parse_executor = ParseExecutor()
+# процессный пул для параллельного парсинга двух файлов эндпоинтами diff
+diff_executor = ParseExecutor(kind='process', max_workers=2, name='diff')
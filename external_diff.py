@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import heapq
+import os
+import pickle
+import shutil
+import tempfile
+import time
+from collections import Counter
+from itertools import groupby
+from operator import itemgetter
+from typing import Iterable, Iterator, List, Optional
+import logging
+from executor import ParseExecutor, diff_executor
+from itinerary_model import MISSING, Itinerary
+from metrics import observe_stage
+from streaming import LazyArray, LazyObject
+from xml_parser import build_models, compare_flight, \
+    iter_itinerary_elements, iter_onward_tickets
+
+log = logging.getLogger(__name__)
+
+# максимальное количество одновременно сливаемых серий
+MERGE_FAN_IN = 64
+# накладные расходы на запись серии сверх размера билета, байт
+RECORD_OVERHEAD = 100
+
+
+def _keep(value):
+    # без таблицы строк: варианты перелёта живут до записи серии
+    return value
+
+
+def iter_models(file_path: str) -> Iterator[Itinerary]:
+    """
+    Потоковый парсинг вариантов перелёта xml файла без накопления модели
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+
+    :rtype: (``Iterator[Itinerary]``)
+    :return: варианты перелёта
+    """
+    with open(file_path, 'rb') as f:
+        yield from build_models(iter_itinerary_elements(f), _keep)
+
+
+def detect_origin(file_path: str) -> Optional[str]:
+    """
+    Отправная точка ответа за один потоковый проход: самое частое начало
+    плеча туда, как RouteIndex.origin
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+
+    :rtype: (``str``)
+    :return: код аэропорта, либо None
+    """
+    counts = Counter(x.onward[0].source for x in iter_models(file_path)
+                     if x.onward)
+    counts.pop(MISSING, None)
+    counts.pop(None, None)
+    return counts.most_common(1)[0][0] if counts else None
+
+
+def _write_run(records: list, directory: str) -> str:
+    records.sort(key=itemgetter(0, 1))
+    fd, path = tempfile.mkstemp(prefix='run-', dir=directory)
+    with os.fdopen(fd, 'wb') as f:
+        for record in records:
+            pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+    return path
+
+
+def iter_run(path: str) -> Iterator[tuple]:
+    """
+    Записи отсортированной серии
+
+    :param
+        * *path* (``str``) -- путь к файлу серии
+
+    :rtype: (``Iterator[tuple]``)
+    :return: записи (ключ, порядковый номер, сериализованный билет)
+    """
+    with open(path, 'rb') as f:
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+
+
+def write_runs(file_path: str, source: str, directory: str,
+               budget: int) -> List[str]:
+    """
+    Синхронная запись билетов тега OnwardPricedItinerary xml файла в
+    отсортированные по ключу '{ID перевозчика}-{номер рейса}' серии.
+    Очередная серия сбрасывается на диск, когда билеты в памяти превысили
+    budget. Порядковый номер сохраняет исходный порядок билетов внутри
+    ключа
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+    :param
+        * *source* (``str``) -- отправная точка маршрута
+    :param
+        * *directory* (``str``) -- каталог для серий
+    :param
+        * *budget* (``int``) -- объём билетов в памяти, байт
+
+    :rtype: (``List[str]``)
+    :return: пути к файлам серий
+    """
+    start = time.time()
+    runs = list()
+    records = list()
+    size = 0
+    count = 0
+    for seq, (key, tickets) in enumerate(
+            iter_onward_tickets(iter_models(file_path), source)):
+        blob = pickle.dumps(tickets, pickle.HIGHEST_PROTOCOL)
+        records.append((key, seq, blob))
+        size += len(blob) + len(key) + RECORD_OVERHEAD
+        count += 1
+        if size >= budget:
+            runs.append(_write_run(records, directory))
+            records = list()
+            size = 0
+    if records or not runs:
+        runs.append(_write_run(records, directory))
+
+    elapsed = observe_stage('group', start, count)
+    log.info(f'EXTERNAL RUNS {elapsed} sec | {count} tickets, '
+             f'{len(runs)} runs | {os.path.basename(file_path)}')
+    return runs
+
+
+def merge_runs(runs: List[str], directory: str) -> Iterator[tuple]:
+    """
+    Слияние отсортированных серий в один поток. Серий больше MERGE_FAN_IN
+    предварительно сливаются в промежуточные файлы, чтобы число открытых
+    файлов оставалось ограниченным
+
+    :param
+        * *runs* (``List[str]``) -- пути к файлам серий
+    :param
+        * *directory* (``str``) -- каталог для промежуточных серий
+
+    :rtype: (``Iterator[tuple]``)
+    :return: записи (ключ, порядковый номер, сериализованный билет)
+    """
+    runs = list(runs)
+    while len(runs) > MERGE_FAN_IN:
+        merged = list()
+        for num in range(0, len(runs), MERGE_FAN_IN):
+            group = runs[num:num + MERGE_FAN_IN]
+            fd, path = tempfile.mkstemp(prefix='run-', dir=directory)
+            with os.fdopen(fd, 'wb') as f:
+                for record in heapq.merge(*map(iter_run, group)):
+                    pickle.dump(record, f, pickle.HIGHEST_PROTOCOL)
+            for run in group:
+                os.unlink(run)
+            merged.append(path)
+        runs = merged
+    return heapq.merge(*map(iter_run, runs))
+
+
+def iter_flights(runs: List[str], directory: str) -> Iterator[tuple]:
+    """
+    Билеты, сгруппированные по ключу полёта, в порядке ключей
+
+    :param
+        * *runs* (``List[str]``) -- пути к файлам серий
+    :param
+        * *directory* (``str``) -- каталог для промежуточных серий
+
+    :rtype: (``Iterator[tuple]``)
+    :return: пары (ключ, список билетов в исходном порядке)
+    """
+    for key, records in groupby(merge_runs(runs, directory),
+                                key=itemgetter(0)):
+        yield key, [pickle.loads(x[2]) for x in records]
+
+
+class _Spill:
+    # записи раздела ответа, отложенные на диск до конца слияния
+
+    def __init__(self, directory: str, name: str):
+        self.path = os.path.join(directory, name)
+        self._file = open(self.path, 'wb')
+        self._reader = None
+        self.count = 0
+
+    def append(self, value):
+        pickle.dump(value, self._file, pickle.HIGHEST_PROTOCOL)
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+        if self._reader is not None:
+            self._reader.close()
+
+    def __iter__(self) -> Iterator:
+        self._reader = iter_run(self.path)
+        return self._reader
+
+
+class _Sections:
+    # разделы ответа: различия по мере слияния, затем отложенные новые и
+    # неправильные билеты. close закрывает файлы и удаляет каталог, в том
+    # числе при обрыве соединения до конца ответа
+
+    def __init__(self, runs: List[List[str]], source: str, directory: str):
+        self.directory = directory
+        self.new = _Spill(directory, 'new_tickets')
+        self.wrong = _Spill(directory, 'wrong_tickets')
+        self.differences = ExternalDiff._join(runs, source, directory,
+                                              self.new, self.wrong)
+
+    def __iter__(self) -> Iterator[tuple]:
+        yield 'differences', LazyArray(self.differences)
+        self.new.close()
+        self.wrong.close()
+        yield 'new_tickets', LazyArray(self.new)
+        yield 'wrong_tickets', LazyArray(self.wrong)
+        self.close()
+
+    def close(self):
+        self.differences.close()
+        self.new.close()
+        self.wrong.close()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ExternalDiff:
+    """
+    Сравнение файлов тега OnwardPricedItinerary с ограниченной памятью.
+
+    Каждый файл обходится потоково, билеты пишутся во временные файлы
+    сериями, отсортированными по ключу '{ID перевозчика}-{номер рейса}'.
+    Два отсортированных потока сливаются merge join по ключу, билеты
+    каждого ключа сравниваются так же, как в compare_xml. Различия
+    отдаются клиенту по мере слияния, которое вызывающий ведёт в пуле
+    (stream_response с executor), новые и неправильные билеты
+    откладываются на диск и отдаются следом. В памяти одновременно
+    находятся одна серия при записи и билеты одного ключа при слиянии.
+    Разделы ответа упорядочены по ключу, а не по первому появлению в файле
+    """
+
+    def __init__(self, memory_budget: int = 64 * 1024 * 1024,
+                 threshold: int = 512 * 1024 * 1024,
+                 tmp_dir: str = None):
+        self.memory_budget = memory_budget
+        self.threshold = threshold
+        self.tmp_dir = tmp_dir
+
+    def configure(self, memory_budget: int = None, threshold: int = None,
+                  tmp_dir: str = None, **kwargs):
+        """
+        Перенастройка сравнения из конфига приложения
+
+        :param
+            * *memory_budget* (``int``) -- объём билетов в памяти на оба
+            файла, байт
+        :param
+            * *threshold* (``int``) -- размер файла, начиная с которого
+            сравнение идёт через диск, 0 - только по mode=external
+        :param
+            * *tmp_dir* (``str``) -- каталог временных файлов, пустая
+            строка - системный
+
+        :rtype: (``None``)
+        :return:
+        """
+        if memory_budget is not None:
+            self.memory_budget = int(memory_budget)
+        if threshold is not None:
+            self.threshold = int(threshold)
+        if tmp_dir is not None:
+            self.tmp_dir = tmp_dir or None
+
+    def wanted(self, file_paths: Iterable[str]) -> bool:
+        """
+        Хотя бы один из файлов не меньше порога
+
+        :param
+            * *file_paths* (``Iterable[str]``) -- сравниваемые файлы
+
+        :rtype: (``bool``)
+        :return: сравнение через диск
+        """
+        if self.threshold <= 0:
+            return False
+        return any(os.path.getsize(x) >= self.threshold for x in file_paths)
+
+    async def detect_origin(self, file_path: str,
+                            executor: ParseExecutor = diff_executor
+                            ) -> Optional[str]:
+        """
+        Отправная точка ответа без загрузки модели в память
+
+        :param
+            * *file_path* (``str``) -- путь к файлу
+        :param
+            * *executor* (``ParseExecutor``) -- пул для парсинга
+
+        :rtype: (``str``)
+        :return: код аэропорта, либо None
+        """
+        return await executor.run(detect_origin, file_path)
+
+    async def compare(self, file_paths: List[str], source: str,
+                      executor: ParseExecutor = diff_executor
+                      ) -> LazyObject:
+        """
+        Сравнение двух файлов. Серии обоих файлов пишутся параллельно в
+        пуле, слияние идёт по мере записи ответа. Временные файлы
+        удаляются после записи ответа либо при close результата, который
+        вызывающий делает и при обрыве соединения
+
+        :param
+            * *file_paths* (``List[str]``) -- сравнивающий и сравниваемый
+            файлы
+        :param
+            * *source* (``str``) -- отправная точка маршрута
+        :param
+            * *executor* (``ParseExecutor``) -- пул для парсинга
+
+        :rtype: (``LazyObject``)
+        :return: результат сравнения в форме compare_xml
+        """
+        directory = tempfile.mkdtemp(prefix='onward-diff-', dir=self.tmp_dir)
+        try:
+            budget = max(self.memory_budget // len(file_paths), 1)
+            runs = await asyncio.gather(
+                *(executor.run(write_runs, x, source, directory, budget)
+                  for x in file_paths))
+            sections = _Sections(runs, source, directory)
+        except BaseException:
+            shutil.rmtree(directory, ignore_errors=True)
+            raise
+        return LazyObject(sections)
+
+    @staticmethod
+    def _join(runs: List[List[str]], source: str, directory: str,
+              new: _Spill, wrong: _Spill) -> Iterator[dict]:
+        start = time.time()
+        count = 0
+        flights = iter_flights(runs[0], directory)
+        new_flights = iter_flights(runs[1], directory)
+        new_key, new_tickets = next(new_flights, (None, None))
+        for flight_key, tickets in flights:
+            # ключи только сравниваемого файла пропускаются, как в
+            # compare_xml
+            while new_key is not None and new_key < flight_key:
+                new_key, new_tickets = next(new_flights, (None, None))
+            diff_tickets, new_val, wrong_val, rest = compare_flight(
+                tickets, new_tickets if new_key == flight_key else None,
+                source)
+
+            if new_val:
+                new.append({flight_key: new_val})
+            if wrong_val:
+                wrong.append({flight_key: wrong_val})
+            if rest:
+                new.append({flight_key: rest})
+            if diff_tickets:
+                count += 1
+                yield {flight_key: diff_tickets}
+
+        elapsed = observe_stage('diff', start)
+        log.info(f'EXTERNAL COMPARING DATA {elapsed} sec | '
+                 f'{count} differences, {new.count} new, '
+                 f'{wrong.count} wrong')
+
+
+external_diff = ExternalDiff()
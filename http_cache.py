@@ -0,0 +1,409 @@
+# -*- coding: utf-8 -*-
+import gzip
+import hashlib
+import os
+import zlib
+from collections import OrderedDict
+from typing import Iterable, List, Optional
+import logging
+from aiohttp.web import Request, Response, StreamResponse
+from coalescing import query_key
+from executor import ParseExecutor
+from parse_cache import ParsedCache, parsed_cache
+from streaming import encode_body, object_records, stream_response, \
+    wants_ndjson
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+log = logging.getLogger(__name__)
+
+# меняется вместе с форматом ответов, чтобы старые ETag перестали совпадать
+ETAG_VERSION = 1
+VARY = 'Accept, Accept-Encoding'
+
+
+class _GzipCompressor:
+    # потоковое сжатие gzip
+
+    def __init__(self, level: int):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def process(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.flush()
+
+
+class _BrotliCompressor:
+    # потоковое сжатие brotli
+
+    def __init__(self, level: int):
+        self._compressor = brotli.Compressor(quality=min(level, 11))
+
+    def process(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def finish(self) -> bytes:
+        return self._compressor.finish()
+
+
+COMPRESSORS = {'gzip': _GzipCompressor}
+DECOMPRESSORS = {'gzip': gzip.decompress}
+if brotli is not None:
+    COMPRESSORS['br'] = _BrotliCompressor
+    DECOMPRESSORS['br'] = brotli.decompress
+# предпочтение сервера при равном q клиента
+PREFERENCE = ('br', 'gzip')
+
+
+def accepted_encodings(request: Request) -> List[str]:
+    """
+    Поддерживаемые сервером кодировки из Accept-Encoding клиента в порядке
+    предпочтения
+
+    :param
+        * *request* (``Request``) -- http запрос
+
+    :rtype: (``List[str]``)
+    :return: кодировки
+    """
+    weights = dict()
+    for token in request.headers.get('Accept-Encoding', '').split(','):
+        name, _, params = token.strip().partition(';')
+        name = name.strip().lower()
+        q = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                q = float(params[2:])
+            except ValueError:
+                q = 0.0
+        if name == '*':
+            for encoding in COMPRESSORS:
+                weights.setdefault(encoding, q)
+        elif name in COMPRESSORS:
+            weights[name] = q
+    return sorted((x for x, q in weights.items() if q > 0),
+                  key=lambda x: (-weights[x], PREFERENCE.index(x)))
+
+
+def _entity_tags(header: str) -> Iterable[str]:
+    for tag in header.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        yield tag
+
+
+class _Entry:
+    __slots__ = ('content_type', 'bodies', 'size', 'paths')
+
+    def __init__(self, content_type: str, paths: frozenset):
+        self.content_type = content_type
+        self.bodies = dict()
+        self.size = 0
+        self.paths = paths
+
+
+class ResponseCache:
+    """
+    Условные GET и кэш сжатых тел ответов.
+
+    Ответ эндпоинта - чистая функция параметров запроса и исходных файлов,
+    поэтому ETag строится из нормализованного запроса и отпечатков файлов
+    до какого-либо парсинга. Совпавший If-None-Match - 304 без тела. Тела
+    ответов хранятся сжатыми (gzip, brotli при наличии модуля), размер
+    кэша ограничен количеством записей и суммарным объёмом, вытеснение по
+    LRU. ETag сжатого представления получает суффикс кодировки.
+
+    Пока исходный файл пересобирается в фоне, запросы получают его прежнюю
+    версию, поэтому такие ответы отдаются без ETag и не кэшируются: ни
+    при пересборке во время lookup, ни при её начале до respond
+    """
+
+    def __init__(self, max_entries: int = 64,
+                 max_bytes: int = 64 * 1024 * 1024, level: int = 6):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.level = level
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.evictions = 0
+        self._size = 0
+        self._entries = OrderedDict()
+        # исходные файлы ответов, которые вычисляются после промаха lookup
+        self._sources = OrderedDict()
+
+    def configure(self, max_entries: int = None, max_bytes: int = None,
+                  level: int = None, **kwargs):
+        """
+        Перенастройка кэша из конфига приложения
+
+        :param
+            * *max_entries* (``int``) -- максимальное количество ответов
+        :param
+            * *max_bytes* (``int``) -- максимальный суммарный объём тел
+        :param
+            * *level* (``int``) -- уровень сжатия
+
+        :rtype: (``None``)
+        :return:
+        """
+        if max_entries is not None:
+            self.max_entries = int(max_entries)
+        if max_bytes is not None:
+            self.max_bytes = int(max_bytes)
+        if level is not None:
+            self.level = int(level)
+        self._shrink()
+
+    @staticmethod
+    def sources(file_paths: Iterable[str]) -> Optional[tuple]:
+        """
+        Отпечатки и номера пересборки исходных файлов ответа
+
+        :param
+            * *file_paths* (``Iterable[str]``) -- исходные файлы ответа
+
+        :rtype: (``tuple``)
+        :return: пары (отпечаток, номер пересборки), либо None, если файла
+        нет или он пересобирается
+        """
+        sources = list()
+        for file_path in file_paths:
+            if not file_path:
+                return None
+            try:
+                fingerprint = ParsedCache.fingerprint(file_path)
+            except OSError:
+                return None
+            generation = parsed_cache.generation(fingerprint[0])
+            if generation is None:
+                return None
+            sources.append((fingerprint, generation))
+        return tuple(sources)
+
+    @staticmethod
+    def etag(request: Request, sources: tuple) -> str:
+        """
+        Сильный ETag ответа по нормализованному запросу и отпечаткам
+        исходных файлов
+
+        :param
+            * *request* (``Request``) -- http запрос
+        :param
+            * *sources* (``tuple``) -- исходные файлы ответа из sources
+
+        :rtype: (``str``)
+        :return: ETag
+        """
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr((ETAG_VERSION, request.path,
+                            query_key(**dict(request.query)),
+                            wants_ndjson(request))).encode())
+        for fingerprint, _ in sources:
+            digest.update(repr(fingerprint).encode())
+        return f'"{digest.hexdigest()}"'
+
+    @staticmethod
+    def _unchanged(sources: tuple) -> bool:
+        # исходные файлы не менялись и не пересобирались после lookup
+        for fingerprint, generation in sources:
+            try:
+                if ParsedCache.fingerprint(fingerprint[0]) != fingerprint:
+                    return False
+            except OSError:
+                return False
+            if parsed_cache.generation(fingerprint[0]) != generation:
+                return False
+        return True
+
+    def lookup(self, request: Request,
+               file_paths: Iterable[str]) -> tuple:
+        """
+        Ответ без вычисления: 304 при совпадении If-None-Match, либо
+        закэшированное тело
+
+        :param
+            * *request* (``Request``) -- http запрос
+        :param
+            * *file_paths* (``Iterable[str]``) -- исходные файлы ответа
+
+        :rtype: (``tuple``)
+        :return: ETag и готовый ответ, либо None
+        """
+        sources = self.sources(file_paths)
+        if sources is None:
+            return None, None
+        etag = self.etag(request, sources)
+
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            base = etag[:-1]
+            for tag in _entity_tags(if_none_match):
+                if tag == '*' or tag == etag or \
+                        (tag.startswith(base + '-') and tag.endswith('"')):
+                    self.not_modified += 1
+                    return etag, Response(status=304, headers={
+                        'ETag': tag if tag != '*' else etag, 'Vary': VARY})
+
+        entry = self._entries.get(etag)
+        if entry is None:
+            self.misses += 1
+            self._sources[etag] = sources
+            self._sources.move_to_end(etag)
+            while len(self._sources) > max(self.max_entries, 256):
+                self._sources.popitem(last=False)
+            return etag, None
+        self._entries.move_to_end(etag)
+        self.hits += 1
+
+        encoding = next((x for x in accepted_encodings(request)
+                         if x in entry.bodies), None)
+        headers = {'Vary': VARY}
+        if encoding is None:
+            # клиент без поддержки сжатия
+            encoding, body = next(iter(entry.bodies.items()))
+            body = DECOMPRESSORS[encoding](body)
+            headers['ETag'] = etag
+        else:
+            body = entry.bodies[encoding]
+            headers['ETag'] = self._tag(etag, encoding)
+            headers['Content-Encoding'] = encoding
+        response = Response(body=body, headers=headers)
+        response.content_type = entry.content_type
+        return etag, response
+
+    async def respond(self, request: Request, etag: Optional[str], data,
+                      records=object_records, depth: int = 2,
+                      executor: ParseExecutor = None) -> StreamResponse:
+        """
+        Потоковый ответ с сохранением сжатого тела в кэш. Тело сжимается
+        один раз: в кодировке клиента, если он её поддерживает, иначе
+        клиенту уходит несжатое, а в кэш - gzip
+
+        :param
+            * *request* (``Request``) -- http запрос
+        :param
+            * *etag* (``str``) -- ETag из lookup, None - без кэширования
+        :param
+            * *data* (``dict or LazyObject``) -- данные ответа
+        :param
+            * *records* (``callable``) -- разбиение данных на записи NDJSON
+        :param
+            * *depth* (``int``) -- глубина поэлементного кодирования JSON
+        :param
+            * *executor* (``ParseExecutor``) -- пул для вычисления и
+            кодирования тела, None - event loop
+
+        :rtype: (``StreamResponse``)
+        :return: ответ
+        """
+        content_type, chunks = encode_body(request, data, records, depth)
+        sources = self._sources.get(etag) if etag is not None else None
+        if sources is None or not self._unchanged(sources):
+            # данные могли быть построены по прежней версии файла
+            etag = None
+        if etag is None:
+            return await stream_response(request, chunks, content_type,
+                                         executor=executor)
+
+        accepted = accepted_encodings(request)
+        encoding = accepted[0] if accepted else None
+        compressor = COMPRESSORS[encoding or 'gzip'](self.level)
+        # тело больше max_bytes в кэш не попадёт, его части не копятся
+        parts = list()
+        size = 0
+        headers = {'Vary': VARY, 'ETag': self._tag(etag, encoding)}
+        if encoding:
+            headers['Content-Encoding'] = encoding
+
+        def tee() -> Iterable[bytes]:
+            nonlocal parts, size
+            for chunk in chunks:
+                compressed = compressor.process(chunk)
+                if parts is not None:
+                    size += len(compressed)
+                    parts.append(compressed)
+                    if size > self.max_bytes:
+                        parts = None
+                yield compressed if encoding else chunk
+            tail = compressor.finish()
+            if parts is not None:
+                parts.append(tail)
+            if encoding:
+                yield tail
+
+        response = await stream_response(request, tee(), content_type,
+                                         headers=headers, executor=executor)
+        if parts is not None:
+            self._put(etag, content_type, encoding or 'gzip',
+                      b''.join(parts),
+                      frozenset(x[0][0] for x in sources))
+        return response
+
+    @staticmethod
+    def _tag(etag: str, encoding: Optional[str]) -> str:
+        return f'{etag[:-1]}-{encoding}"' if encoding else etag
+
+    def _put(self, etag: str, content_type: str, encoding: str,
+             body: bytes, paths: frozenset):
+        if len(body) > self.max_bytes:
+            return
+        entry = self._entries.get(etag)
+        if entry is None:
+            entry = self._entries[etag] = _Entry(content_type, paths)
+        self._size -= entry.size
+        entry.bodies[encoding] = body
+        entry.size = sum(map(len, entry.bodies.values()))
+        self._size += entry.size
+        self._entries.move_to_end(etag)
+        self._shrink()
+
+    def invalidate(self, file_path: str) -> int:
+        """
+        Удаление ответов, построенных по файлу
+
+        :param
+            * *file_path* (``str``) -- путь к файлу
+
+        :rtype: (``int``)
+        :return: количество удалённых ответов
+        """
+        path = os.path.realpath(file_path)
+        etags = [k for k, v in self._entries.items() if path in v.paths]
+        for etag in etags:
+            self._size -= self._entries.pop(etag).size
+        return len(etags)
+
+    def _shrink(self):
+        while self._entries and (len(self._entries) > self.max_entries or
+                                 self._size > self.max_bytes):
+            _, entry = self._entries.popitem(last=False)
+            self._size -= entry.size
+            self.evictions += 1
+
+    def stats(self) -> dict:
+        """
+        Статистика кэша ответов
+
+        :rtype: (``dict``)
+        :return: количество и объём записей, попаданий, промахов, 304 и
+        вытеснений
+        """
+        return {
+            'entries': len(self._entries),
+            'bytes': self._size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'not_modified': self.not_modified,
+            'evictions': self.evictions
+        }
+
+
+response_cache = ResponseCache()
@@ -0,0 +1,382 @@
+# -*- coding: utf-8 -*-
+import xml.etree.ElementTree as ET
+from typing import Optional, Tuple
+import logging
+
+log = logging.getLogger(__name__)
+
+# теги билета в порядке следования в ответе партнёра, кроме Carrier
+SEGMENT_TAGS = (
+    ('FlightNumber', 'flight_number'),
+    ('Source', 'source'),
+    ('Destination', 'destination'),
+    ('DepartureTimeStamp', 'departure'),
+    ('ArrivalTimeStamp', 'arrival'),
+    ('Class', 'klass'),
+    ('NumberOfStops', 'stops'),
+    ('FareBasis', 'fare_basis'),
+    ('WarningText', 'warning_text'),
+    ('TicketType', 'ticket_type'),
+)
+_SEGMENT_SLOTS = dict(SEGMENT_TAGS)
+
+
+class InvalidItinerary(ValueError):
+    """
+    Вариант перелёта без билетов в одном из направлений
+    """
+
+
+class Missing:
+    """
+    Значение тега, которого нет в xml. Отличается от пустого тега, который
+    сериализуется в null
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'MISSING'
+
+    def __reduce__(self):
+        return 'MISSING'
+
+
+MISSING = Missing()
+
+
+class StringTable:
+    """
+    Словарное кодирование повторяющихся строк одного ответа партнёра:
+    коды перевозчиков, аэропорты, классы и длинные FareBasis хранятся в
+    единственном экземпляре
+    """
+    __slots__ = ('_strings', )
+
+    def __init__(self):
+        self._strings = dict()
+
+    def __call__(self, value):
+        if value is None or value is MISSING:
+            return value
+        return self._strings.setdefault(value, value)
+
+    def __len__(self):
+        return len(self._strings)
+
+
+def _child(schema, tag: str):
+    # схема дочернего узла build_schema: None - узел не нужен
+    return True if schema is True else schema.get(tag)
+
+
+def _leaf_value(elem: ET.Element):
+    # значение листа в том же виде, что отдаёт etree_to_dict
+    if elem.text is None:
+        return None
+    return elem.text.strip()
+
+
+class Segment:
+    """
+    Билет (тег Flight) варианта перелёта
+    """
+    __slots__ = ('carrier_id', 'carrier') + tuple(_SEGMENT_SLOTS.values())
+
+    def __init__(self, carrier_id=MISSING, carrier=MISSING,
+                 flight_number=MISSING, source=MISSING, destination=MISSING,
+                 departure=MISSING, arrival=MISSING, klass=MISSING,
+                 stops=MISSING, fare_basis=MISSING, warning_text=MISSING,
+                 ticket_type=MISSING):
+        self.carrier_id = carrier_id
+        self.carrier = carrier
+        self.flight_number = flight_number
+        self.source = source
+        self.destination = destination
+        self.departure = departure
+        self.arrival = arrival
+        self.klass = klass
+        self.stops = stops
+        self.fare_basis = fare_basis
+        self.warning_text = warning_text
+        self.ticket_type = ticket_type
+
+    @classmethod
+    def from_element(cls, elem: ET.Element,
+                     strings: StringTable) -> 'Segment':
+        """
+        Построение билета из тега Flight
+
+        :param
+            * *elem* (``<class 'xml.etree.ElementTree.Element'>``) - тег
+            Flight
+        :param
+            * *strings* (``StringTable``) -- таблица строк ответа
+
+        :rtype: (``Segment``)
+        :return: билет
+        """
+        segment = cls()
+        for child in elem:
+            if child.tag == 'Carrier':
+                segment.carrier_id = strings(child.get('id', MISSING))
+                text = child.text.strip() if child.text else ''
+                segment.carrier = strings(text) if text else MISSING
+                continue
+            slot = _SEGMENT_SLOTS.get(child.tag)
+            if slot:
+                setattr(segment, slot, strings(_leaf_value(child)))
+        return segment
+
+    def __getstate__(self) -> tuple:
+        # компактное состояние для передачи между процессами
+        return self.key()
+
+    def __setstate__(self, state: tuple):
+        for slot, value in zip(self.__slots__, state):
+            setattr(self, slot, value)
+
+    def key(self) -> tuple:
+        """
+        Значения всех полей билета, пригодные для хэширования
+
+        :rtype: (``tuple``)
+        :return: значения полей
+        """
+        return tuple(getattr(self, slot) for slot in self.__slots__)
+
+    def flat_items(self) -> tuple:
+        """
+        Пары (тег, значение) билета с развёрнутым перевозчиком, как в
+        данных /v1/onward_diff
+
+        :rtype: (``tuple``)
+        :return: пары тег-значение
+        """
+        items = [(tag, getattr(self, slot)) for tag, slot in SEGMENT_TAGS]
+        items.append(('id', self.carrier_id))
+        items.append(('text', self.carrier))
+        return tuple((k, v) for k, v in items if v is not MISSING)
+
+    def to_flat_dict(self) -> dict:
+        """
+        Словарь билета с развёрнутым перевозчиком
+
+        :rtype: (``dict``)
+        :return: данные билета
+        """
+        return dict(self.flat_items())
+
+    def to_dict(self, schema=True) -> dict:
+        """
+        Словарь билета в форме etree_to_dict. Собираются только поля
+        схемы
+
+        :param
+            * *schema* (``dict``) -- схема выборки полей билета, True - все
+            поля
+
+        :rtype: (``dict``)
+        :return: данные билета
+        """
+        data = dict()
+        carrier_schema = _child(schema, 'Carrier')
+        if carrier_schema is not None:
+            carrier = dict()
+            if self.carrier_id is not MISSING and \
+                    _child(carrier_schema, 'id') is not None:
+                carrier['id'] = self.carrier_id
+            if self.carrier is not MISSING and \
+                    _child(carrier_schema, 'text') is not None:
+                carrier['text'] = self.carrier
+            if carrier or self.carrier_id is not MISSING or \
+                    self.carrier is not MISSING:
+                data['Carrier'] = carrier
+        for tag, slot in SEGMENT_TAGS:
+            value = getattr(self, slot)
+            if value is not MISSING and _child(schema, tag) is not None:
+                data[tag] = value
+        return data
+
+
+class Pricing:
+    """
+    Стоимость варианта перелёта (тег Pricing)
+    """
+    __slots__ = ('currency', 'charges')
+
+    def __init__(self, currency=MISSING, charges: tuple = ()):
+        self.currency = currency
+        # (type, ChargeType, сумма текстом)
+        self.charges = charges
+
+    @classmethod
+    def from_element(cls, elem: ET.Element,
+                     strings: StringTable) -> 'Pricing':
+        """
+        Построение стоимости из тега Pricing
+
+        :param
+            * *elem* (``<class 'xml.etree.ElementTree.Element'>``) - тег
+            Pricing
+        :param
+            * *strings* (``StringTable``) -- таблица строк ответа
+
+        :rtype: (``Pricing``)
+        :return: стоимость
+        """
+        charges = tuple(
+            (strings(x.get('type', MISSING)),
+             strings(x.get('ChargeType', MISSING)),
+             strings(x.text.strip()) if x.text else MISSING)
+            for x in elem.iter('ServiceCharges'))
+        return cls(strings(elem.get('currency', MISSING)), charges)
+
+    def amount(self, charge_type: str = 'TotalAmount',
+               passenger: str = 'SingleAdult') -> Optional[float]:
+        """
+        Сумма по типу пассажира и типу тарифа
+
+        :param
+            * *charge_type* (``str``) -- тип тарифа
+        :param
+            * *passenger* (``str``) -- тип пассажира
+
+        :rtype: (``float``)
+        :return: сумма или None
+        """
+        return next((float(text) for type_, charge, text in self.charges
+                     if type_ == passenger and charge == charge_type and
+                     text), None)
+
+    def to_dict(self, schema=True) -> dict:
+        """
+        Словарь стоимости в форме etree_to_dict. Собираются только поля
+        схемы
+
+        :param
+            * *schema* (``dict``) -- схема выборки полей стоимости, True -
+            все поля
+
+        :rtype: (``dict``)
+        :return: данные стоимости
+        """
+        data = dict()
+        charge_schema = _child(schema, 'ServiceCharges')
+        if charge_schema is not None:
+            charges = list()
+            for type_, charge_type, text in self.charges:
+                charge = dict()
+                if type_ is not MISSING and \
+                        _child(charge_schema, 'type') is not None:
+                    charge['type'] = type_
+                if charge_type is not MISSING and \
+                        _child(charge_schema, 'ChargeType') is not None:
+                    charge['ChargeType'] = charge_type
+                if text and _child(charge_schema, 'text') is not None:
+                    charge['text'] = text
+                charges.append(charge)
+            if charges:
+                data['ServiceCharges'] = charges[0] if len(charges) == 1 \
+                    else charges
+        if self.currency is not MISSING and \
+                _child(schema, 'currency') is not None:
+            data['currency'] = self.currency
+        return data
+
+
+def _segments_to_value(segments: Tuple[Segment, ...], schema=True):
+    value = [x.to_dict(schema) for x in segments]
+    return value[0] if len(value) == 1 else value
+
+
+def _leg_to_dict(segments: Tuple[Segment, ...], schema) -> dict:
+    # OnwardPricedItinerary/ReturnPricedItinerary: Flights/Flight
+    flights_schema = _child(schema, 'Flights')
+    if flights_schema is None:
+        return {}
+    flight_schema = _child(flights_schema, 'Flight')
+    if flight_schema is None:
+        return {'Flights': {}}
+    return {'Flights': {'Flight': _segments_to_value(segments,
+                                                     flight_schema)}}
+
+
+class Itinerary:
+    """
+    Вариант перелёта (тег Flights верхнего уровня)
+    """
+    __slots__ = ('onward', 'returns', 'pricing')
+
+    def __init__(self, onward: Tuple[Segment, ...] = (),
+                 returns: Optional[Tuple[Segment, ...]] = None,
+                 pricing: Optional[Pricing] = None):
+        self.onward = onward
+        # None - нет обратного перелёта
+        self.returns = returns
+        self.pricing = pricing
+
+    @classmethod
+    def from_element(cls, elem: ET.Element,
+                     strings: StringTable) -> 'Itinerary':
+        """
+        Построение варианта перелёта из тега Flights верхнего уровня. Без
+        билетов туда или с пустым обратным перелётом - InvalidItinerary
+
+        :param
+            * *elem* (``<class 'xml.etree.ElementTree.Element'>``) - тег
+            Flights
+        :param
+            * *strings* (``StringTable``) -- таблица строк ответа
+
+        :rtype: (``Itinerary``)
+        :return: вариант перелёта
+        """
+        itinerary = cls()
+        for child in elem:
+            if child.tag == 'Pricing':
+                itinerary.pricing = Pricing.from_element(child, strings)
+            elif child.tag in ('OnwardPricedItinerary',
+                               'ReturnPricedItinerary'):
+                segments = tuple(Segment.from_element(x, strings)
+                                 for x in child.iter('Flight'))
+                if child.tag == 'OnwardPricedItinerary':
+                    itinerary.onward = segments
+                else:
+                    itinerary.returns = segments
+        if not itinerary.onward or itinerary.returns == ():
+            raise InvalidItinerary('itinerary without flights in one of the '
+                                   'directions')
+        return itinerary
+
+    @property
+    def total_amount(self) -> Optional[float]:
+        """
+        Полная стоимость билета для взрослого
+        """
+        return self.pricing.amount() if self.pricing else None
+
+    def to_dict(self, schema=True) -> dict:
+        """
+        Словарь варианта перелёта в той же форме, что отдают эндпоинты.
+        Собираются только поля схемы, остальные узлы не строятся
+
+        :param
+            * *schema* (``dict``) -- схема выборки полей варианта перелёта
+            из build_schema, True - все поля
+
+        :rtype: (``dict``)
+        :return: данные варианта перелёта
+        """
+        data = dict()
+        onward_schema = _child(schema, 'OnwardPricedItinerary')
+        if onward_schema is not None:
+            data['OnwardPricedItinerary'] = _leg_to_dict(self.onward,
+                                                         onward_schema)
+        return_schema = _child(schema, 'ReturnPricedItinerary')
+        if self.returns is not None and return_schema is not None:
+            data['ReturnPricedItinerary'] = _leg_to_dict(self.returns,
+                                                         return_schema)
+        pricing_schema = _child(schema, 'Pricing')
+        if self.pricing is not None and pricing_schema is not None:
+            data['Pricing'] = self.pricing.to_dict(pricing_schema)
+        return data
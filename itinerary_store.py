@@ -0,0 +1,372 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+from typing import Optional, Sequence
+import logging
+import numpy as np
+from itinerary_model import Itinerary
+from pareto import skyline_layers, weighted_score
+from parse_cache import parsed_cache
+from snapshot import Snapshot, snapshots
+from metrics import observe_stage
+from timestamps import format_travel_time, parse_timestamp
+from xml_parser import get_file_path, load_cached, load_models
+
+log = logging.getLogger(__name__)
+
+ACTIONS = ('cheap', 'expensive', 'fast', 'slow', 'optimal')
+# доля выборки, до которой страница считается отбором кандидатов без
+# перестановки
+TOP_K_RATIO = 0.1
+# веса (цена, время туда, время обратно) оценки внутри слоя Парето
+OPTIMAL_WEIGHTS = (1.0, 1.0, 1.0)
+COLUMNS = ('price', 'has_return',
+           'onward_departure', 'onward_arrival', 'onward_time', 'onward_stops',
+           'return_departure', 'return_arrival', 'return_time', 'return_stops')
+
+
+def to_epoch_minutes(timestamps: list) -> np.ndarray:
+    """
+    Конвертация времени формата партнёра YYYY-MM-DDTHHMM в минуты от
+    начала эпохи
+
+    :param
+        * *timestamps* (``list``) -- время в формате партнёра
+
+    :rtype: (``np.ndarray``)
+    :return: массив int64
+    """
+    return np.fromiter(map(parse_timestamp, timestamps), dtype=np.int64,
+                       count=len(timestamps))
+
+
+class ItineraryStore:
+    """
+    Колоночное хранилище вариантов перелёта одного ответа партнёра.
+    Цена, длительности, количество пересадок и время вылета/прилёта лежат в
+    массивах NumPy и строятся один раз на файл. Обогащение и сортировка
+    выполняются операциями над массивами
+    """
+
+    def __init__(self, itineraries: Sequence[Itinerary],
+                 columns: dict = None, orders: dict = None,
+                 layers: np.ndarray = None):
+        self.itineraries = itineraries
+        if columns is None:
+            columns = self._build_columns(itineraries)
+        for name in COLUMNS:
+            setattr(self, name, columns[name])
+
+        self.onward_time_info = self._time_info(self.onward_time)
+        self.return_time_info = self._time_info(self.return_time)
+        # перестановки по методам сортировки, строятся один раз по запросу
+        self._orders = dict()
+        for action, order in (orders or {}).items():
+            self._orders[self._order_key(action)] = order
+        self._layers = layers
+        log.info(f'STORE BUILT {len(itineraries)} itineraries')
+
+    @classmethod
+    def _build_columns(cls, itineraries: Sequence[Itinerary]) -> dict:
+        columns = dict()
+        columns['price'] = np.array(
+            [np.nan if x.total_amount is None else x.total_amount
+             for x in itineraries], dtype=np.float64)
+        has_return = np.array([x.returns is not None for x in itineraries],
+                              dtype=bool)
+        columns['has_return'] = has_return
+
+        onward = [x.onward for x in itineraries]
+        returns = [x.returns or x.onward for x in itineraries]
+        (columns['onward_departure'], columns['onward_arrival'],
+         columns['onward_time'], columns['onward_stops']) = \
+            cls._leg_columns(onward)
+        (columns['return_departure'], columns['return_arrival'],
+         columns['return_time'], columns['return_stops']) = \
+            cls._leg_columns(returns)
+        # у вариантов без обратного перелёта колонки обратного пути нулевые
+        for name in ('return_departure', 'return_arrival', 'return_time',
+                     'return_stops'):
+            columns[name][~has_return] = 0
+        return columns
+
+    def columns(self) -> dict:
+        """
+        Числовые колонки хранилища
+
+        :rtype: (``dict``)
+        :return: имя колонки - массив
+        """
+        return {name: getattr(self, name) for name in COLUMNS}
+
+    @classmethod
+    def from_snapshot(cls, snapshot: Snapshot) -> Optional['ItineraryStore']:
+        """
+        Хранилище из снимка xml файла без повторного построения колонок и
+        перестановок
+
+        :param
+            * *snapshot* (``Snapshot``) -- снимок
+
+        :rtype: (``ItineraryStore``)
+        :return: хранилище, либо None, если в снимке нет колонок
+        """
+        arrays = snapshot.arrays
+        if not all(f'column_{x}' in arrays for x in COLUMNS):
+            return None
+        columns = {x: arrays[f'column_{x}'] for x in COLUMNS}
+        orders = {x: arrays[f'order_{x}'] for x in ACTIONS
+                  if f'order_{x}' in arrays}
+        return cls(snapshot.itineraries, columns, orders,
+                   arrays.get('layers'))
+
+    def snapshot_arrays(self) -> dict:
+        """
+        Колонки, перестановки и слои Парето для сохранения в снимок
+
+        :rtype: (``dict``)
+        :return: имя массива - массив
+        """
+        arrays = {f'column_{x}': y for x, y in self.columns().items()}
+        arrays.update((f'order_{x}', y) for x, y in self.orders().items())
+        arrays['layers'] = self.layers
+        return arrays
+
+    def orders(self) -> dict:
+        """
+        Перестановки по всем методам сортировки, optimal - с весами по
+        умолчанию. Недостающие перестановки строятся
+
+        :rtype: (``dict``)
+        :return: метод сортировки - индексы вариантов перелёта
+        """
+        return {action: self.order(action) for action in ACTIONS}
+
+    @staticmethod
+    def _leg_columns(legs: list) -> tuple:
+        # эпохи в минутах, длительность в секундах, количество пересадок
+        departure = to_epoch_minutes([x[0].departure for x in legs])
+        arrival = to_epoch_minutes([x[-1].arrival for x in legs])
+        total_time = (arrival - departure) * 60
+        stops = np.array([len(x) - 1 for x in legs], dtype=np.int16)
+        return departure, arrival, total_time, stops
+
+    @staticmethod
+    def _time_info(total_time: np.ndarray) -> list:
+        unique, inverse = np.unique(total_time, return_inverse=True)
+        labels = [format_travel_time(int(x)) for x in unique]
+        return [labels[x] for x in inverse.ravel()]
+
+    def __len__(self):
+        return len(self.itineraries)
+
+    def _sort_keys(self, action: str) -> Optional[tuple]:
+        # ключи в порядке значимости, NaN цены уходят в конец выборки
+        price = np.where(np.isnan(self.price), np.inf, self.price)
+        onward, back = self.onward_time, self.return_time
+        if action == 'cheap':
+            return price, onward, back
+        if action == 'expensive':
+            return np.where(np.isnan(self.price), np.inf, -self.price), \
+                onward, back
+        if action == 'fast':
+            return onward, back, price
+        if action == 'slow':
+            return -onward, -back, price
+        return None
+
+    @staticmethod
+    def _order_key(action: str, weights: tuple = None):
+        if action == 'optimal':
+            return action, tuple(weights or OPTIMAL_WEIGHTS)
+        return action
+
+    @property
+    def layers(self) -> np.ndarray:
+        """
+        Номера слоёв Парето по (цена, время туда, время обратно)
+        """
+        if self._layers is None:
+            self._layers = skyline_layers(self.price, self.onward_time,
+                                          self.return_time)
+            self._layers.flags.writeable = False
+        return self._layers
+
+    def order(self, action: str, weights: tuple = None) -> np.ndarray:
+        """
+        Порядок вариантов перелёта для метода сортировки. Перестановка
+        строится один раз на метод и переиспользуется. Равные варианты
+        сохраняют порядок следования в файле
+
+        Доступные методы action:
+        cheap - по возрастанию цены, затем по времени туда и обратно
+        expensive - по убыванию цены, затем по времени туда и обратно
+        fast - по времени туда и обратно, затем по цене
+        slow - по убыванию времени туда и обратно, затем по цене
+        optimal - по слоям Парето (цена, время туда, время обратно), внутри
+        слоя по взвешенной оценке, затем как fast
+
+        :param
+            * *action* (``str``) -- выбор метода сортировки
+        :param
+            * *weights* (``tuple``) -- веса оценки для optimal
+
+        :rtype: (``np.ndarray``)
+        :return: индексы вариантов перелёта
+        """
+        key = self._order_key(action, weights)
+        order = self._orders.get(key)
+        if order is None:
+            if action == 'optimal':
+                score = weighted_score(
+                    (self.price, self.onward_time, self.return_time), key[1])
+                keys = (self.layers, score) + self._sort_keys('fast')
+            else:
+                keys = self._sort_keys(action)
+            if keys is None:
+                return np.arange(len(self))
+            # последний ключ np.lexsort - основной
+            order = np.lexsort(keys[::-1])
+            order.flags.writeable = False
+            self._orders[key] = order
+        return order
+
+    def build_orders(self):
+        """
+        Построение перестановок для всех методов сортировки
+
+        :rtype: (``None``)
+        :return:
+        """
+        for action in ACTIONS:
+            self.order(action)
+
+    def page(self, action: str, limit: int = None, offset: int = 0,
+             weights: tuple = None,
+             subset: np.ndarray = None) -> np.ndarray:
+        """
+        Страница отсортированных вариантов перелёта. Пока перестановка для
+        метода не построена, для небольших страниц np.argpartition за O(n)
+        отбирает кандидатов по основному ключу, и сортируются только они.
+        Подмножество вариантов выбирается из готовой перестановки без
+        пересортировки
+
+        :param
+            * *action* (``str``) -- выбор метода сортировки
+        :param
+            * *limit* (``int``) -- размер страницы, None - до конца выборки
+        :param
+            * *offset* (``int``) -- смещение страницы
+        :param
+            * *weights* (``tuple``) -- веса оценки для optimal
+        :param
+            * *subset* (``np.ndarray``) -- индексы допустимых вариантов
+
+        :rtype: (``np.ndarray``)
+        :return: индексы вариантов перелёта страницы
+        """
+        stop = None if limit is None else offset + limit
+        if subset is not None:
+            order = self.order(action, weights)
+            mask = np.zeros(len(self), dtype=bool)
+            mask[subset] = True
+            return order[mask[order]][offset:stop]
+        if action not in self._orders and stop is not None and \
+                stop <= len(self) * TOP_K_RATIO:
+            keys = self._sort_keys(action)
+            if keys is not None:
+                return self._top(keys, stop)[offset:]
+        return self.order(action, weights)[offset:stop]
+
+    @staticmethod
+    def _top(keys: tuple, stop: int) -> np.ndarray:
+        # кандидаты - варианты с основным ключом не больше stop-го по
+        # величине, вместе с равными ему; сортируются только они
+        if stop <= 0:
+            return np.empty(0, dtype=np.int64)
+        primary = keys[0]
+        kth = primary[np.argpartition(primary, stop - 1)[stop - 1]]
+        candidates = np.flatnonzero(primary <= kth)
+        order = np.lexsort(tuple(x[candidates] for x in keys[::-1]))
+        return candidates[order][:stop]
+
+    def ticket(self, index: int, schema=True) -> dict:
+        """
+        Обогащённый вариант перелёта в форме ответа /v1/parse
+
+        :param
+            * *index* (``int``) -- индекс варианта перелёта
+        :param
+            * *schema* (``dict``) -- схема выборки полей варианта перелёта
+
+        :rtype: (``dict``)
+        :return: данные варианта перелёта
+        """
+        itinerary = self.itineraries[index]
+        has_return = bool(self.has_return[index])
+        price = self.price[index]
+        return dict(itinerary.to_dict(schema), **{
+            'total_amout': None if np.isnan(price) else float(price),
+            'onward_total_time': int(self.onward_time[index]),
+            'onward_time_info': self.onward_time_info[index],
+            'onward_is_direct_flight': not int(self.onward_stops[index]),
+            'return_total_time':
+                int(self.return_time[index]) if has_return else None,
+            'return_time_info':
+                self.return_time_info[index] if has_return else None,
+            'return_is_direct_flight':
+                not int(self.return_stops[index]) if has_return else None
+        })
+
+
+async def get_itinerary_store(**kwargs) -> ItineraryStore:
+    """
+    Колоночное хранилище вариантов перелёта xml файла. Результат кэшируется
+    до изменения файла
+
+    :param kwargs:
+         * *need_return* (``str``) -- наличие обратного маршрута
+         * *response_id* (``str``) -- идентификатор загруженного ответа
+
+    :rtype: (``ItineraryStore``)
+    :return: хранилище вариантов перелёта
+    """
+    file_path = get_file_path(kwargs.get('need_return'),
+                              kwargs.get('response_id'))
+    if not file_path:
+        return ItineraryStore([])
+
+    log.info(f'FILE {os.path.basename(file_path)}')
+
+    return await load_cached(file_path, 'store', load_store)
+
+
+def load_store(file_path: str) -> ItineraryStore:
+    """
+    Синхронное построение колоночного хранилища вариантов перелёта. Готовые
+    колонки и перестановки берутся из снимка, иначе строятся по модели из
+    общего кэша и дописываются в снимок
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+
+    :rtype: (``ItineraryStore``)
+    :return: хранилище вариантов перелёта
+    """
+    snapshot = snapshots.load(file_path)
+    if snapshot is not None:
+        store = ItineraryStore.from_snapshot(snapshot)
+        if store is not None:
+            return store
+
+    fingerprint = parsed_cache.fingerprint(file_path)
+    itineraries = parsed_cache.get_or_parse(file_path, 'models', load_models)
+    start = time.time()
+    store = ItineraryStore(itineraries)
+    elapsed = observe_stage('enrich', start, len(itineraries))
+    log.info(f'BUILDING STORE {elapsed} sec')
+    if snapshots.write:
+        arrays = store.snapshot_arrays()
+        if not snapshots.update(fingerprint, arrays):
+            snapshots.save(fingerprint, itineraries, arrays)
+    return store
@@ -0,0 +1,492 @@
+# -*- coding: utf-8 -*-
+import math
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Sequence
+import logging
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# границы корзин гистограмм времени, секунды
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                   2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n') \
+        .replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence) -> str:
+    if not names:
+        return ''
+    pairs = ','.join(f'{x}="{_escape(y)}"' for x, y in zip(names, values))
+    return '{' + pairs + '}'
+
+
+def _format_value(value) -> str:
+    if isinstance(value, float):
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        if value.is_integer():
+            return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Метрика с метками. Значения хранятся по кортежу значений меток,
+    обновление потокобезопасно: стадии парсинга выполняются в пуле потоков
+    """
+    kind = 'untyped'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(x, '')) for x in self.labels)
+
+    def samples(self) -> Iterator[tuple]:
+        """
+        Отсчёты метрики
+
+        :rtype: (``Iterator[tuple]``)
+        :return: (суффикс имени, имена меток, значения меток, значение)
+        """
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in sorted(values):
+            yield '', self.labels, key, value
+
+    def dump(self) -> dict:
+        """
+        Состояние метрики для передачи из процесса пула
+
+        :rtype: (``dict``)
+        :return: значения по кортежу меток
+        """
+        with self._lock:
+            return dict(self._values)
+
+    def merge(self, state: dict):
+        """
+        Добавление состояния метрики из процесса пула
+
+        :param
+            * *state* (``dict``) -- значения по кортежу меток
+
+        :rtype: (``None``)
+        :return:
+        """
+        with self._lock:
+            for key, value in state.items():
+                self._values[key] = self._values.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Counter(Metric):
+    """
+    Монотонный счётчик
+    """
+    kind = 'counter'
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    """
+    Текущее значение
+    """
+    kind = 'gauge'
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def inc(self, value: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def dec(self, value: float = 1, **labels):
+        self.inc(-value, **labels)
+
+    def merge(self, state: dict):
+        # текущие значения процессов пула не складываются
+        pass
+
+
+class Histogram(Metric):
+    """
+    Гистограмма: количество наблюдений по корзинам, сумма и количество
+    """
+    kind = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def set_buckets(self, buckets: Sequence[float]):
+        """
+        Новые границы корзин, накопленные наблюдения сбрасываются
+
+        :param
+            * *buckets* (``Sequence[float]``) -- границы корзин
+
+        :rtype: (``None``)
+        :return:
+        """
+        with self._lock:
+            self.buckets = tuple(sorted(float(x) for x in buckets))
+            self._values.clear()
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [0] * (len(self.buckets) + 2)
+            for num, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[num] += 1
+                    break
+            else:
+                state[len(self.buckets)] += 1
+            # сумма и количество наблюдений
+            state[-2] += value
+            state[-1] += 1
+
+    def samples(self) -> Iterator[tuple]:
+        with self._lock:
+            values = [(k, list(v)) for k, v in self._values.items()]
+        names = self.labels + ('le', )
+        for key, state in sorted(values):
+            total = 0
+            for bound, count in zip(self.buckets + (math.inf, ), state):
+                total += count
+                yield '_bucket', names, key + (_format_value(bound), ), total
+            yield '_sum', self.labels, key, state[-2]
+            yield '_count', self.labels, key, state[-1]
+
+    def dump(self) -> dict:
+        with self._lock:
+            return {k: list(v) for k, v in self._values.items()}
+
+    def merge(self, state: dict):
+        size = len(self.buckets) + 2
+        with self._lock:
+            for key, values in state.items():
+                if len(values) != size:
+                    # процесс пула считал по другим границам корзин
+                    log.warning(f'METRIC {self.name} {key} skipped: '
+                                f'{len(values) - 2} buckets instead of '
+                                f'{len(self.buckets)}')
+                    continue
+                current = self._values.get(key)
+                if current is None:
+                    self._values[key] = list(values)
+                else:
+                    for num, value in enumerate(values):
+                        current[num] += value
+
+
+class Metrics:
+    """
+    Реестр метрик приложения в текстовом формате Prometheus.
+
+    Метрики обновляются по ходу обработки запросов, статистика кэшей и
+    пулов снимается коллекторами в момент запроса /v1/metrics. Стадии,
+    выполненные в процессном пуле, передаются в родительский процесс
+    вместе с результатом (run_collected)
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self._metrics = dict()
+        self._collectors = list()
+
+    def configure(self, enabled: bool = None,
+                  buckets: Sequence[float] = None, **kwargs):
+        """
+        Перенастройка метрик из конфига приложения
+
+        :param
+            * *enabled* (``bool``) -- сбор метрик запросов
+        :param
+            * *buckets* (``Sequence[float]``) -- границы корзин гистограмм
+            времени, секунды
+
+        :rtype: (``None``)
+        :return:
+        """
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if buckets:
+            for metric in self._metrics.values():
+                if isinstance(metric, Histogram):
+                    metric.set_buckets(buckets)
+
+    def _register(self, metric: Metric) -> Metric:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str,
+                labels: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def gauge(self, name: str, documentation: str,
+              labels: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str,
+                  labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels,
+                                        buckets))
+
+    def collector(self, collect: Callable[[], Iterable[Metric]]):
+        """
+        Регистрация коллектора: функции, которая при запросе метрик
+        возвращает заполненные метрики
+
+        :param
+            * *collect* (``callable``) -- коллектор
+
+        :rtype: (``None``)
+        :return:
+        """
+        self._collectors.append(collect)
+
+    def stats_collector(self, prefix: str, documentation: str,
+                        stats: Callable[[], dict],
+                        counters: Iterable[str] = (), label: str = None):
+        """
+        Коллектор из метода stats(): каждое числовое поле - метрика
+        {prefix}_{поле}, поля counters - счётчики, остальные - текущие
+        значения
+
+        :param
+            * *prefix* (``str``) -- префикс имён метрик
+        :param
+            * *documentation* (``str``) -- описание
+        :param
+            * *stats* (``callable``) -- статистика: словарь полей, либо при
+            заданной label - словарь {значение метки: словарь полей}
+        :param
+            * *counters* (``Iterable[str]``) -- монотонные поля
+        :param
+            * *label* (``str``) -- имя метки
+
+        :rtype: (``None``)
+        :return:
+        """
+        counters = frozenset(counters)
+
+        def collect() -> List[Metric]:
+            groups = stats()
+            if label is None:
+                groups = {None: groups}
+            collected = dict()
+            for value, fields in groups.items():
+                labels = {label: value} if label else {}
+                for field, number in fields.items():
+                    if isinstance(number, bool) or \
+                            not isinstance(number, (int, float)):
+                        continue
+                    metric = collected.get(field)
+                    if metric is None:
+                        name = f'{prefix}_{field}'
+                        labels_names = (label, ) if label else ()
+                        if field in counters:
+                            metric = Counter(f'{name}_total', documentation,
+                                             labels_names)
+                        else:
+                            metric = Gauge(name, documentation, labels_names)
+                        collected[field] = metric
+                    metric.inc(number, **labels)
+            return list(collected.values())
+
+        self._collectors.append(collect)
+
+    def render(self) -> str:
+        """
+        Все метрики в текстовом формате Prometheus
+
+        :rtype: (``str``)
+        :return: текст для /v1/metrics
+        """
+        metrics = list(self._metrics.values())
+        for collect in self._collectors:
+            try:
+                metrics.extend(collect())
+            except Exception as e:
+                log.warning(f'METRICS COLLECTOR FAILED {collect}: {e!r}')
+
+        lines = list()
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} '
+                         f'{metric.documentation.replace(chr(10), " ")}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for suffix, names, values, value in metric.samples():
+                lines.append(f'{metric.name}{suffix}'
+                             f'{_format_labels(names, values)} '
+                             f'{_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+    def dump(self) -> Dict[str, dict]:
+        """
+        Состояние всех метрик для передачи из процесса пула
+
+        :rtype: (``Dict[str, dict]``)
+        :return: состояние по имени метрики
+        """
+        return {k: v.dump() for k, v in self._metrics.items()}
+
+    def merge(self, state: Dict[str, dict]):
+        """
+        Добавление состояния метрик из процесса пула
+
+        :param
+            * *state* (``Dict[str, dict]``) -- состояние по имени метрики
+
+        :rtype: (``None``)
+        :return:
+        """
+        for name, values in state.items():
+            metric = self._metrics.get(name)
+            if metric is not None:
+                metric.merge(values)
+
+    def reset(self):
+        for metric in self._metrics.values():
+            metric.reset()
+
+
+metrics = Metrics()
+
+REQUEST_SECONDS = metrics.histogram(
+    'http_request_duration_seconds',
+    'Время обработки запроса, включая запись тела ответа',
+    ('endpoint', 'method'))
+REQUESTS = metrics.counter(
+    'http_requests_total', 'Обработанные запросы',
+    ('endpoint', 'method', 'status'))
+REQUESTS_IN_PROGRESS = metrics.gauge(
+    'http_requests_in_progress', 'Запросы в обработке', ('endpoint', ))
+STAGE_SECONDS = metrics.histogram(
+    'stage_duration_seconds',
+    'Время стадий: parse, enrich, index, group, sort, diff, serialise',
+    ('stage', ))
+ITINERARIES = metrics.counter(
+    'itineraries_processed_total',
+    'Варианты перелёта (билеты для diff), прошедшие стадию', ('stage', ))
+
+
+def observe_stage(stage: str, start: float, itineraries: int = None) -> float:
+    """
+    Время стадии от start до текущего момента в гистограмму стадий
+
+    :param
+        * *stage* (``str``) -- стадия
+    :param
+        * *start* (``float``) -- начало стадии, time.time()
+    :param
+        * *itineraries* (``int``) -- количество обработанных вариантов
+
+    :rtype: (``float``)
+    :return: время стадии, секунды
+    """
+    elapsed = time.time() - start
+    STAGE_SECONDS.observe(elapsed, stage=stage)
+    if itineraries is not None:
+        ITINERARIES.inc(itineraries, stage=stage)
+    return elapsed
+
+
+def endpoint_name(request: web.Request) -> str:
+    """
+    Метка эндпоинта: шаблон маршрута, чтобы параметры пути и неизвестные
+    адреса не размножали ряды метрик
+
+    :param
+        * *request* (``Request``) -- http запрос
+
+    :rtype: (``str``)
+    :return: шаблон маршрута, либо unmatched
+    """
+    resource = request.match_info.route.resource
+    if resource is None:
+        return 'unmatched'
+    return resource.canonical
+
+
+@web.middleware
+async def metrics_middleware(request: web.Request, handler):
+    """
+    Время обработки и количество запросов по эндпоинтам. Для потоковых
+    ответов время включает запись всего тела
+
+    :param
+        * *request* (``Request``) -- http запрос
+    :param
+        * *handler* (``callable``) -- обработчик
+
+    :rtype: (``StreamResponse``)
+    :return: ответ обработчика
+    """
+    if not metrics.enabled:
+        return await handler(request)
+
+    endpoint = endpoint_name(request)
+    status = 500
+    REQUESTS_IN_PROGRESS.inc(endpoint=endpoint)
+    start = time.perf_counter()
+    try:
+        response = await handler(request)
+        status = response.status
+        return response
+    except web.HTTPException as e:
+        status = e.status
+        raise
+    finally:
+        REQUESTS_IN_PROGRESS.dec(endpoint=endpoint)
+        REQUEST_SECONDS.observe(time.perf_counter() - start,
+                                endpoint=endpoint, method=request.method)
+        REQUESTS.inc(endpoint=endpoint, method=request.method, status=status)
+
+
+def run_collected(func, *args) -> tuple:
+    """
+    Выполнение функции в процессе пула со сбором метрик, которые она
+    записала: состояние метрик процесса сбрасывается до вызова и
+    возвращается вместе с результатом
+
+    :param
+        * *func* (``callable``) -- функция
+    :param
+        * *args* -- аргументы функции
+
+    :rtype: (``tuple``)
+    :return: результат и состояние метрик
+    """
+    metrics.reset()
+    result = func(*args)
+    return result, metrics.dump()
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_right
+from typing import Sequence
+import logging
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+
+# наибольший размер блока лестницы, больший блок делится пополам
+BLOCK_SIZE = 1024
+
+
+class _Staircase:
+    """
+    Двумерная "лестница" одного слоя Парето: точки (onward, return) с
+    возрастающим onward и строго убывающим return. Точки слоя уже
+    отсортированы по цене, поэтому цена проверяется только на равенство.
+
+    Точки хранятся блоками не больше BLOCK_SIZE: вставка и удаление
+    сдвигают один блок и список первых onward блоков, а не всю лестницу
+    """
+    __slots__ = ('firsts', 'onward', 'back', 'price')
+
+    def __init__(self):
+        # onward первой точки каждого блока
+        self.firsts = []
+        self.onward = []
+        self.back = []
+        self.price = []
+
+    def _find(self, onward) -> tuple:
+        # блок и позиция последней точки с onward не больше данного
+        block = bisect_right(self.firsts, onward) - 1
+        if block < 0:
+            return -1, -1
+        return block, bisect_right(self.onward[block], onward) - 1
+
+    def dominates(self, price, onward, back) -> bool:
+        block = bisect_right(self.firsts, onward) - 1
+        if block < 0:
+            return False
+        onwards = self.onward[block]
+        pos = bisect_right(onwards, onward) - 1
+        best = self.back[block][pos]
+        if best < back:
+            return True
+        # равный return - доминирование только если точка не идентична
+        return best == back and (onwards[pos] < onward or
+                                 self.price[block][pos] < price)
+
+    def add(self, price, onward, back):
+        if not self.firsts:
+            self.firsts.append(onward)
+            self.onward.append([onward])
+            self.back.append([back])
+            self.price.append([price])
+            return
+
+        block, pos = self._find(onward)
+        if block < 0:
+            block, pos = 0, 0
+        elif self.onward[block][pos] == onward:
+            # точка с тем же onward и не хуже по return уже есть
+            if self.back[block][pos] <= back:
+                return
+        else:
+            pos += 1
+        onwards, backs, prices = \
+            self.onward[block], self.back[block], self.price[block]
+        end = pos
+        while end < len(backs) and backs[end] >= back:
+            end += 1
+        if end == len(backs):
+            self._drop_dominated(block + 1, back)
+        onwards[pos:end] = [onward]
+        backs[pos:end] = [back]
+        prices[pos:end] = [price]
+        self.firsts[block] = onwards[0]
+        if len(onwards) > BLOCK_SIZE:
+            self._split(block)
+
+    def _drop_dominated(self, block: int, back):
+        # точки следующих блоков с return не меньше нового
+        while block < len(self.firsts) and self.back[block][-1] >= back:
+            del self.firsts[block], self.onward[block], self.back[block], \
+                self.price[block]
+        if block == len(self.firsts):
+            return
+        backs = self.back[block]
+        end = 0
+        while backs[end] >= back:
+            end += 1
+        if end:
+            del self.onward[block][:end], backs[:end], \
+                self.price[block][:end]
+            self.firsts[block] = self.onward[block][0]
+
+    def _split(self, block: int):
+        half = len(self.onward[block]) // 2
+        for blocks in (self.onward, self.back, self.price):
+            blocks.insert(block + 1, blocks[block][half:])
+            del blocks[block][half:]
+        self.firsts.insert(block + 1, self.onward[block + 1][0])
+
+
+def skyline_layers(price: Sequence, onward: Sequence,
+                   back: Sequence) -> np.ndarray:
+    """
+    Разбиение вариантов перелёта на слои Парето по (цена, время туда,
+    время обратно). Слой 0 - Парето-фронт: варианты, которые не хуже
+    остальных хотя бы по одному критерию. Слой k - фронт после удаления
+    слоёв 0..k-1.
+
+    Варианты обходятся по возрастанию цены, слой каждого варианта ищется
+    бинарным поиском по слоям: если вариант доминируется слоем k, он
+    доминируется и всеми слоями до k. Сравнений O(n log^2 n), вставка в
+    лестницу сдвигает не больше блока и списка блоков
+
+    :param
+        * *price* (``Sequence``) -- цены
+    :param
+        * *onward* (``Sequence``) -- время в пути туда
+    :param
+        * *back* (``Sequence``) -- время в пути обратно
+
+    :rtype: (``np.ndarray``)
+    :return: номер слоя для каждого варианта
+    """
+    price = np.asarray(price, dtype=np.float64)
+    onward = np.asarray(onward)
+    back = np.asarray(back)
+    layers = np.zeros(len(price), dtype=np.int32)
+    stairs = []
+
+    order = np.lexsort((back, onward, price))
+    points = zip(order.tolist(), price[order].tolist(),
+                 onward[order].tolist(), back[order].tolist())
+    for index, p, o, b in points:
+        low, high = 0, len(stairs)
+        while low < high:
+            middle = (low + high) // 2
+            if stairs[middle].dominates(p, o, b):
+                low = middle + 1
+            else:
+                high = middle
+        if low == len(stairs):
+            stairs.append(_Staircase())
+        stairs[low].add(p, o, b)
+        layers[index] = low
+
+    log.info(f'PARETO LAYERS {len(stairs)} for {len(price)} itineraries')
+    return layers
+
+
+def weighted_score(columns: Sequence[np.ndarray],
+                   weights: Sequence[float]) -> np.ndarray:
+    """
+    Взвешенная оценка вариантов внутри слоя: сумма нормированных в [0, 1]
+    критериев с весами, чем меньше - тем лучше
+
+    :param
+        * *columns* (``Sequence[np.ndarray]``) -- критерии
+    :param
+        * *weights* (``Sequence[float]``) -- веса критериев
+
+    :rtype: (``np.ndarray``)
+    :return: оценка для каждого варианта
+    """
+    score = np.zeros(len(columns[0]), dtype=np.float64)
+    for column, weight in zip(columns, weights):
+        column = np.asarray(column, dtype=np.float64)
+        if not weight or not len(column):
+            continue
+        low, high = np.nanmin(column), np.nanmax(column)
+        if high > low:
+            score += weight * (column - low) / (high - low)
+    return score
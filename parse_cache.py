@@ -0,0 +1,290 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+from collections import OrderedDict
+from typing import Optional
+import logging
+
+log = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class ParsedCache:
+    """
+    Общий кэш распарсенных xml файлов в памяти процесса.
+
+    Ключ записи - (путь, размер, mtime_ns, тип парсера). Изменение файла
+    меняет отпечаток, поэтому устаревшая запись просто перестаёт находиться
+    и вытесняется при следующей записи по тому же файлу и типу парсера.
+    Размер ограничен количеством записей, вытеснение по LRU.
+
+    Пока изменённый файл пересобирается в фоне (begin_refresh), previous
+    отдаёт его прежнюю версию: новая заменяет её одной записью put.
+    """
+
+    def __init__(self, max_entries: int = 16):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.stale_hits = 0
+        self._entries = OrderedDict()
+        self._refreshing = set()
+        self._generations = dict()
+        self._lock = threading.RLock()
+        self._local = threading.local()
+
+    def configure(self, max_entries: int = None, **kwargs):
+        """
+        Перенастройка кэша из конфига приложения
+
+        :param
+            * *max_entries* (``int``) -- максимальное количество записей
+
+        :rtype: (``None``)
+        :return:
+        """
+        if max_entries is not None:
+            with self._lock:
+                self.max_entries = int(max_entries)
+                self._shrink()
+
+    @staticmethod
+    def fingerprint(file_path: str) -> tuple:
+        """
+        Отпечаток файла, по которому определяется его изменение
+
+        :param
+            * *file_path* (``str``) -- путь к файлу
+
+        :rtype: (``tuple``)
+        :return: (путь, размер, mtime_ns)
+        """
+        path = os.path.realpath(file_path)
+        stat = os.stat(path)
+        return path, stat.st_size, stat.st_mtime_ns
+
+    def key(self, file_path: str, kind) -> tuple:
+        """
+        Ключ записи для файла и типа парсера
+
+        :param
+            * *file_path* (``str``) -- путь к файлу
+        :param
+            * *kind* (``hashable``) -- тип парсера
+
+        :rtype: (``tuple``)
+        :return: (путь, размер, mtime_ns, тип парсера)
+        """
+        return self.fingerprint(file_path) + (kind, )
+
+    def get(self, key: tuple, default=None):
+        """
+        Получение записи по ключу с учётом статистики попаданий
+
+        :param
+            * *key* (``tuple``) -- ключ записи
+        :param
+            * *default* -- значение при промахе
+
+        :return: закэшированный результат парсинга или default
+        """
+        with self._lock:
+            value = self._entries.get(key, _MISSING)
+            if value is _MISSING:
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: tuple, value):
+        """
+        Сохранение записи. Устаревшие версии того же файла и типа парсера
+        удаляются сразу
+
+        :param
+            * *key* (``tuple``) -- ключ записи
+        :param
+            * *value* -- результат парсинга
+
+        :rtype: (``None``)
+        :return:
+        """
+        path, _, _, kind = key
+        with self._lock:
+            stale = [k for k in self._entries
+                     if k[0] == path and k[3] == kind and k != key]
+            for k in stale:
+                del self._entries[k]
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            self._shrink()
+
+    def previous(self, key: tuple) -> Optional[tuple]:
+        """
+        Прежняя версия записи файла, который пересобирается в фоне
+
+        :param
+            * *key* (``tuple``) -- ключ записи новой версии
+
+        :rtype: (``tuple``)
+        :return: ключ и результат парсинга прежней версии файла, либо None,
+        если файл не пересобирается или прежней версии нет
+        """
+        path, _, _, kind = key
+        with self._lock:
+            if path not in self._refreshing:
+                return None
+            for k in reversed(self._entries):
+                if k[0] == path and k[3] == kind and k != key:
+                    self.stale_hits += 1
+                    return k, self._entries[k]
+        return None
+
+    def begin_refresh(self, file_path: str):
+        """
+        Начало фоновой пересборки файла: до end_refresh промахи по новой
+        версии обслуживает previous
+
+        :param
+            * *file_path* (``str``) -- путь к файлу
+
+        :rtype: (``None``)
+        :return:
+        """
+        path = os.path.realpath(file_path)
+        with self._lock:
+            self._refreshing.add(path)
+            self._generations[path] = self._generations.get(path, 0) + 1
+
+    def end_refresh(self, file_path: str):
+        """
+        Окончание фоновой пересборки файла
+
+        :param
+            * *file_path* (``str``) -- путь к файлу
+
+        :rtype: (``None``)
+        :return:
+        """
+        with self._lock:
+            self._refreshing.discard(os.path.realpath(file_path))
+
+    def generation(self, path: str) -> Optional[int]:
+        """
+        Номер пересборки файла: меняется с каждым begin_refresh. Ответ,
+        построенный между двумя одинаковыми номерами, построен по одной
+        версии файла
+
+        :param
+            * *path* (``str``) -- реальный путь к файлу
+
+        :rtype: (``int``)
+        :return: номер пересборки, либо None - файл пересобирается и
+        запросы получают его прежнюю версию
+        """
+        with self._lock:
+            if path in self._refreshing:
+                return None
+            return self._generations.get(path, 0)
+
+    def get_or_parse(self, file_path: str, kind, parser, *args):
+        """
+        Получение результата парсинга файла из кэша, либо парсинг с
+        сохранением результата. Внутри staged результат сохраняется в
+        черновик пересборки, а не в кэш
+
+        :param
+            * *file_path* (``str``) -- путь к файлу
+        :param
+            * *kind* (``hashable``) -- тип парсера
+        :param
+            * *parser* (``callable``) -- функция парсинга parser(file_path,
+            *args)
+
+        :return: результат парсинга
+        """
+        key = self.key(file_path, kind)
+        staging = getattr(self._local, 'staging', None)
+        if staging is not None and key in staging:
+            return staging[key]
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = parser(key[0], *args)
+            if staging is not None:
+                staging[key] = value
+            else:
+                self.put(key, value)
+        return value
+
+    def staged(self, staging: dict, func, *args):
+        """
+        Выполнение функции парсинга, вложенные get_or_parse которой
+        сохраняют результаты в черновик: при пересборке файла его разборы
+        публикуются все вместе после построения последнего
+
+        :param
+            * *staging* (``dict``) -- черновик, записи по ключу кэша
+        :param
+            * *func* (``callable``) -- функция парсинга
+        :param
+            * *args* -- аргументы функции
+
+        :return: результат функции
+        """
+        self._local.staging = staging
+        try:
+            return func(*args)
+        finally:
+            self._local.staging = None
+
+    def invalidate(self, file_path: str = None, kind=None) -> int:
+        """
+        Явная инвалидация записей. Без параметров очищает весь кэш
+
+        :param
+            * *file_path* (``str``) -- путь к файлу
+        :param
+            * *kind* (``hashable``) -- тип парсера
+
+        :rtype: (``int``)
+        :return: количество удалённых записей
+        """
+        path = os.path.realpath(file_path) if file_path else None
+        with self._lock:
+            keys = [k for k in self._entries
+                    if (path is None or k[0] == path) and
+                    (kind is None or k[3] == kind)]
+            for k in keys:
+                del self._entries[k]
+        return len(keys)
+
+    def stats(self) -> dict:
+        """
+        Статистика кэша
+
+        :rtype: (``dict``)
+        :return: количество записей, попаданий, промахов, вытеснений,
+        ответов прежней версией и пересобираемых файлов
+        """
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'stale_hits': self.stale_hits,
+                'refreshing': len(self._refreshing)
+            }
+
+    def _shrink(self):
+        while len(self._entries) > self.max_entries:
+            key, _ = self._entries.popitem(last=False)
+            self.evictions += 1
+            log.info(f'CACHE EVICTED {key}')
+
+
+parsed_cache = ParsedCache()
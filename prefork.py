@@ -0,0 +1,306 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import errno
+import os
+import select
+import signal
+import socket
+import time
+from typing import Callable
+import logging
+from aiohttp import web
+from aiohttp.web import Application
+
+log = logging.getLogger(__name__)
+
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_TIMEOUT = 30.0
+GRACEFUL_TIMEOUT = 30.0
+# воркер, проживший меньше, считается упавшим при старте
+MIN_UPTIME = 2.0
+MAX_BACKOFF = 30.0
+
+
+class Worker:
+    """
+    Процесс воркера глазами мастера
+    """
+    __slots__ = ('pid', 'fd', 'started', 'last_seen', 'ready', 'retiring',
+                 'terminated')
+
+    def __init__(self, pid: int, fd: int):
+        self.pid = pid
+        # конец канала, из которого мастер читает пульс воркера
+        self.fd = fd
+        self.started = self.last_seen = time.monotonic()
+        self.ready = False
+        self.retiring = False
+        self.terminated = None
+
+
+class PreforkServer:
+    """
+    Мастер-процесс: открывает слушающий сокет, запускает воркеры aiohttp
+    через fork и следит за ними. Воркеры наследуют сокет и данные,
+    загруженные мастером до fork, страницы которых разделяются до первой
+    записи.
+
+    Каждый воркер раз в heartbeat_interval пишет в свой канал, зависший
+    дольше heartbeat_timeout воркер убивается. Упавшие воркеры
+    перезапускаются, при частых падениях - с нарастающей задержкой.
+    SIGHUP - плавный перезапуск: новые воркеры запускаются, старые
+    останавливаются по мере готовности новых. SIGTERM/SIGINT - остановка
+    """
+
+    def __init__(self, app_factory: Callable[[], Application], port: int,
+                 workers: int, host: str = '0.0.0.0', backlog: int = 128,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                 heartbeat_timeout: float = HEARTBEAT_TIMEOUT,
+                 graceful_timeout: float = GRACEFUL_TIMEOUT,
+                 preload: Callable[[], None] = None):
+        self.app_factory = app_factory
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.backlog = backlog
+        self.heartbeat_interval = heartbeat_interval
+        self.heartbeat_timeout = heartbeat_timeout
+        self.graceful_timeout = graceful_timeout
+        self.preload = preload
+        self.sock = None
+        self._workers = dict()
+        self._stopping = False
+        self._restart = False
+        self._backoff = 0.0
+        self._spawn_after = 0.0
+
+    def run(self):
+        """
+        Запуск мастера до получения SIGTERM/SIGINT
+
+        :rtype: (``None``)
+        :return:
+        """
+        self.sock = self._listen()
+        if self.preload is not None:
+            start = time.time()
+            self.preload()
+            log.info(f'MASTER preloaded {time.time() - start} sec')
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        signal.signal(signal.SIGHUP, self._on_restart)
+        log.info(f'MASTER {os.getpid()} on {self.host}:{self.port} with '
+                 f'{self.workers} workers')
+        try:
+            while not self._stopping:
+                self._rotate()
+                self._spawn_missing()
+                self._wait_heartbeats()
+                self._reap()
+                self._check_health()
+        finally:
+            self._stop_all()
+            self.sock.close()
+        log.info(f'MASTER {os.getpid()} stopped')
+
+    def _listen(self) -> socket.socket:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        sock.listen(self.backlog)
+        sock.setblocking(False)
+        return sock
+
+    def _on_stop(self, signum, frame):
+        self._stopping = True
+
+    def _on_restart(self, signum, frame):
+        self._restart = True
+
+    def _rotate(self):
+        if self._restart:
+            self._restart = False
+            log.info('MASTER graceful restart')
+            for worker in self._workers.values():
+                worker.retiring = True
+        # старые воркеры останавливаются, когда новые готовы их заменить
+        ready = sum(1 for x in self._workers.values()
+                    if x.ready and not x.retiring)
+        retiring = [x for x in self._workers.values()
+                    if x.retiring and x.terminated is None]
+        while retiring and ready + len(retiring) > self.workers:
+            self._terminate(retiring.pop())
+
+    def _spawn_missing(self):
+        active = sum(1 for x in self._workers.values() if not x.retiring)
+        if active < self.workers and time.monotonic() >= self._spawn_after:
+            for _ in range(self.workers - active):
+                self._spawn()
+
+    def _spawn(self):
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # своя группа процессов: пулы воркера убиваются вместе с ним
+            os.setpgid(0, 0)
+            os.close(read_fd)
+            for worker in self._workers.values():
+                os.close(worker.fd)
+            code = 0
+            try:
+                self._run_worker(write_fd)
+            except BaseException:
+                log.exception(f'WORKER {os.getpid()} failed')
+                code = 1
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        os.set_blocking(read_fd, False)
+        self._workers[pid] = Worker(pid, read_fd)
+        log.info(f'MASTER spawned worker {pid}')
+
+    def _run_worker(self, heartbeat_fd: int):
+        # обработчики сигналов мастера воркеру не нужны, свои ставит run_app
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, signal.SIG_DFL)
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+        asyncio.set_event_loop(asyncio.new_event_loop())
+
+        app = self.app_factory()
+        heartbeat = Heartbeat(heartbeat_fd, os.getppid(),
+                              self.heartbeat_interval)
+        app.on_startup.append(heartbeat.start)
+        app.on_cleanup.append(heartbeat.stop)
+        web.run_app(app, sock=self.sock, print=None)
+
+    def _wait_heartbeats(self):
+        fds = {x.fd: x for x in self._workers.values()}
+        try:
+            readable, _, _ = select.select(list(fds), [], [],
+                                           self.heartbeat_interval)
+        except InterruptedError:
+            return
+        now = time.monotonic()
+        for fd in readable:
+            worker = fds[fd]
+            try:
+                data = os.read(fd, 4096)
+            except OSError as e:
+                if e.errno != errno.EAGAIN:
+                    raise
+                continue
+            if data:
+                worker.last_seen = now
+                if not worker.ready:
+                    worker.ready = True
+                    self._backoff = 0.0
+                    log.info(f'MASTER worker {worker.pid} ready')
+
+    def _reap(self):
+        while self._workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if not pid:
+                return
+            worker = self._workers.pop(pid, None)
+            if worker is None:
+                continue
+            os.close(worker.fd)
+            # дочерние процессы убитого воркера остаются без родителя
+            self._kill(pid)
+            uptime = time.monotonic() - worker.started
+            log.info(f'MASTER worker {pid} exited with status {status} '
+                     f'after {uptime:.1f} sec')
+            if not worker.retiring and uptime < MIN_UPTIME:
+                # падение при старте: перезапуск с нарастающей задержкой
+                self._backoff = min(max(self._backoff * 2, 1.0), MAX_BACKOFF)
+                self._spawn_after = time.monotonic() + self._backoff
+                log.warning(f'MASTER worker {pid} crashed on start, '
+                            f'respawn in {self._backoff} sec')
+
+    def _check_health(self):
+        now = time.monotonic()
+        for worker in self._workers.values():
+            if worker.terminated is not None:
+                if now - worker.terminated > self.graceful_timeout:
+                    self._kill(worker.pid)
+            elif now - worker.last_seen > self.heartbeat_timeout:
+                log.warning(f'MASTER worker {worker.pid} missed heartbeat '
+                            f'for {now - worker.last_seen:.1f} sec')
+                worker.retiring = True
+                worker.terminated = now
+                self._kill(worker.pid)
+
+    def _terminate(self, worker: Worker):
+        worker.retiring = True
+        worker.terminated = time.monotonic()
+        try:
+            os.kill(worker.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+    @staticmethod
+    def _kill(pid: int):
+        # группа процессов воркера вместе с его пулами
+        try:
+            os.killpg(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _stop_all(self):
+        for worker in self._workers.values():
+            if worker.terminated is None:
+                self._terminate(worker)
+        deadline = time.monotonic() + self.graceful_timeout
+        while self._workers and time.monotonic() < deadline:
+            self._reap()
+            time.sleep(0.1)
+        for pid in list(self._workers):
+            self._kill(pid)
+        while self._workers:
+            pid, _ = os.waitpid(-1, 0)
+            worker = self._workers.pop(pid, None)
+            if worker is not None:
+                os.close(worker.fd)
+                self._kill(pid)
+
+
+class Heartbeat:
+    """
+    Пульс воркера: периодическая запись в канал мастера из event loop.
+    Заблокированный event loop перестаёт писать, и мастер убивает воркер.
+    Воркер, потерявший мастера, останавливается сам
+    """
+
+    def __init__(self, fd: int, master_pid: int, interval: float):
+        self.fd = fd
+        os.set_blocking(fd, False)
+        self.master_pid = master_pid
+        self.interval = interval
+        self._task = None
+
+    async def start(self, app: Application):
+        self._task = asyncio.ensure_future(self._beat())
+
+    async def stop(self, app: Application):
+        if self._task is not None:
+            self._task.cancel()
+        os.close(self.fd)
+
+    async def _beat(self):
+        while True:
+            if os.getppid() != self.master_pid:
+                log.warning(f'WORKER {os.getpid()} lost master, stopping')
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            try:
+                os.write(self.fd, b'.')
+            except BlockingIOError:
+                pass
+            except BrokenPipeError:
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+            await asyncio.sleep(self.interval)
@@ -0,0 +1,575 @@
+# -*- coding: utf-8 -*-
+import contextvars
+import cProfile
+import json
+import os
+import pstats
+import random
+import sys
+import threading
+import time
+import tracemalloc
+import uuid
+from collections import Counter, OrderedDict
+from typing import List, Optional
+import logging
+from aiohttp import web
+
+log = logging.getLogger(__name__)
+
+PROJECT_DIR = os.path.dirname(os.path.realpath(__file__))
+MODES = ('cprofile', 'sample')
+HEADER = 'X-Profile'
+ID_HEADER = 'X-Profile-Id'
+# эндпоинты, которые не профилируются
+SKIP_PATHS = ('/v1/profiles', '/v1/metrics')
+# функции, в которых поток ждёт работы: такие отсчёты не считаются
+_IDLE = {('selectors.py', 'select'), ('thread.py', '_worker'),
+         ('threading.py', 'wait'), ('queues.py', 'get'),
+         ('connection.py', '_recv'), ('profiling.py', '_run')}
+
+_current = contextvars.ContextVar('profile', default=None)
+# потоки, в которых работает cProfile: второй профилировщик в том же потоке
+# не всегда даёт ValueError (Python 3.11) и портит статистику первого
+_profiled_threads = set()
+_profiled_lock = threading.Lock()
+
+
+def _claim_thread() -> bool:
+    # True - поток свободен и занят для cProfile
+    ident = threading.get_ident()
+    with _profiled_lock:
+        if ident in _profiled_threads:
+            return False
+        _profiled_threads.add(ident)
+        return True
+
+
+def _release_thread():
+    with _profiled_lock:
+        _profiled_threads.discard(threading.get_ident())
+
+
+def current() -> Optional['Profile']:
+    """
+    Профиль запроса, в контексте которого выполняется код
+
+    :rtype: (``Profile``)
+    :return: профиль, либо None
+    """
+    return _current.get()
+
+
+def _function_name(filename: str, lineno: int, name: str) -> str:
+    if filename.startswith(PROJECT_DIR + os.sep):
+        filename = os.path.relpath(filename, PROJECT_DIR)
+    elif os.sep in filename:
+        filename = os.sep.join(filename.rsplit(os.sep, 2)[-2:])
+    return f'{filename}:{lineno}({name})'
+
+
+class _RawStats:
+    # статистика cProfile из другого потока или процесса для pstats.Stats
+
+    def __init__(self, stats: dict):
+        self.stats = stats
+
+    def create_stats(self):
+        pass
+
+
+def run_profiled(func, *args) -> tuple:
+    """
+    Выполнение функции пула под cProfile
+
+    :param
+        * *func* (``callable``) -- функция
+    :param
+        * *args* -- аргументы функции
+
+    :rtype: (``tuple``)
+    :return: результат и статистика cProfile
+    """
+    if not _claim_thread():
+        # в потоке уже работает другой профилировщик
+        return func(*args), {}
+    profile = cProfile.Profile()
+    try:
+        profile.enable()
+        try:
+            result = func(*args)
+        finally:
+            profile.disable()
+    finally:
+        _release_thread()
+    profile.create_stats()
+    return result, profile.stats
+
+
+class Profile:
+    """
+    Профиль одного запроса: cProfile потока event loop и задач пулов
+    парсинга (режим cprofile), либо отсчёты стеков всех потоков процесса
+    (режим sample)
+    """
+
+    def __init__(self, request: web.Request, mode: str, sampled: bool,
+                 allocations: bool):
+        self.id = uuid.uuid4().hex
+        self.path = request.path
+        self.query = request.query_string
+        self.mode = mode
+        self.sampled = sampled
+        self.allocations = allocations
+        self.started = time.time()
+        self.duration = None
+        self.status = None
+        self.samples = 0
+        self.self_samples = Counter()
+        self.total_samples = Counter()
+        self._lock = threading.Lock()
+        # False - cProfile потока event loop был занят другим запросом
+        self.loop_profiled = self.deterministic
+        self._stats = None
+        self._profile = None
+        self._snapshot = None
+        self._allocations = []
+
+    @property
+    def deterministic(self) -> bool:
+        return self.mode == 'cprofile'
+
+    def add_stats(self, stats: dict):
+        """
+        Статистика cProfile задачи пула
+
+        :param
+            * *stats* (``dict``) -- pstats статистика
+
+        :rtype: (``None``)
+        :return:
+        """
+        if not stats:
+            return
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(_RawStats(stats))
+            else:
+                self._stats.add(_RawStats(stats))
+
+    def add_sample(self, stack: List[tuple]):
+        """
+        Отсчёт стека потока, stack[0] - выполняющаяся функция
+
+        :param
+            * *stack* (``List[tuple]``) -- функции стека
+
+        :rtype: (``None``)
+        :return:
+        """
+        with self._lock:
+            self.samples += 1
+            self.self_samples[stack[0]] += 1
+            for key in set(stack):
+                self.total_samples[key] += 1
+
+    def start(self):
+        if self.allocations:
+            profiler.start_tracing()
+            self._snapshot = tracemalloc.take_snapshot()
+        if self.deterministic:
+            if _claim_thread():
+                self._profile = cProfile.Profile()
+                self._profile.enable()
+            else:
+                # поток event loop уже профилирует другой запрос, остаются
+                # задачи пулов
+                self.loop_profiled = False
+        else:
+            profiler.sampler.add(self)
+
+    def stop(self):
+        if not self.deterministic:
+            profiler.sampler.remove(self)
+        elif self._profile is not None:
+            self._profile.disable()
+            self._profile.create_stats()
+            self.add_stats(self._profile.stats)
+            self._profile = None
+            _release_thread()
+        if self.allocations:
+            snapshot = tracemalloc.take_snapshot()
+            self._allocations = snapshot.compare_to(self._snapshot,
+                                                    'lineno')
+            self._snapshot = None
+            profiler.stop_tracing()
+        self.duration = time.time() - self.started
+
+    def report(self, top: int) -> dict:
+        """
+        Отчёт профиля
+
+        :param
+            * *top* (``int``) -- количество самых затратных функций
+
+        :rtype: (``dict``)
+        :return: параметры запроса, функции и выделения памяти
+        """
+        report = {
+            'id': self.id,
+            'path': self.path,
+            'query': self.query,
+            'mode': self.mode,
+            'sampled': self.sampled,
+            'started': self.started,
+            'duration': self.duration,
+            'status': self.status
+        }
+        if self.deterministic:
+            report['loop_profiled'] = self.loop_profiled
+            report['functions'] = self._top_stats(top)
+        else:
+            report['samples'] = self.samples
+            report['functions'] = top_samples(
+                self.self_samples, self.total_samples, self.samples, top)
+        if self.allocations:
+            report['allocations'] = [{
+                'line': str(x.traceback),
+                'size_diff': x.size_diff,
+                'count_diff': x.count_diff
+            } for x in self._allocations[:top]]
+        return report
+
+    def _top_stats(self, top: int) -> list:
+        if self._stats is None:
+            return []
+        rows = list()
+        for (filename, lineno, name), value in self._stats.stats.items():
+            calls, primitive, tottime, cumtime, _ = value
+            rows.append({
+                'function': _function_name(filename, lineno, name),
+                'calls': calls,
+                'tottime': tottime,
+                'cumtime': cumtime
+            })
+        rows.sort(key=lambda x: x['tottime'], reverse=True)
+        return rows[:top]
+
+
+def top_samples(self_samples: Counter, total_samples: Counter, samples: int,
+                top: int) -> list:
+    """
+    Самые частые функции по отсчётам стеков
+
+    :param
+        * *self_samples* (``Counter``) -- отсчёты на вершине стека
+    :param
+        * *total_samples* (``Counter``) -- отсчёты в любом месте стека
+    :param
+        * *samples* (``int``) -- всего отсчётов
+    :param
+        * *top* (``int``) -- количество функций
+
+    :rtype: (``list``)
+    :return: функции с долями собственных и общих отсчётов
+    """
+    rows = list()
+    for key, count in self_samples.most_common(top):
+        rows.append({
+            'function': _function_name(*key),
+            'self': count,
+            'total': total_samples[key],
+            'self_share': round(count / samples, 4) if samples else 0,
+            'total_share':
+                round(total_samples[key] / samples, 4) if samples else 0
+        })
+    return rows
+
+
+class Sampler:
+    """
+    Фоновый поток, снимающий стеки всех потоков процесса раз в interval
+    секунд, пока есть профилируемые запросы. Отсчёт попадает во все
+    активные профили: в сэмплирующем режиме профиль описывает процесс за
+    время запроса, а не только сам запрос
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self._profiles = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, profile: Profile):
+        with self._lock:
+            self._profiles.add(profile)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='profile-sampler', daemon=True)
+                self._thread.start()
+
+    def remove(self, profile: Profile):
+        with self._lock:
+            self._profiles.discard(profile)
+
+    def _run(self):
+        own = threading.get_ident()
+        while True:
+            with self._lock:
+                profiles = list(self._profiles)
+                if not profiles:
+                    self._thread = None
+                    return
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = _stack(frame)
+                if stack is None:
+                    continue
+                for profile in profiles:
+                    profile.add_sample(stack)
+            time.sleep(self.interval)
+
+
+def _stack(frame) -> Optional[List[tuple]]:
+    code = frame.f_code
+    if (os.path.basename(code.co_filename), code.co_name) in _IDLE:
+        return None
+    stack = list()
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+        frame = frame.f_back
+    return stack
+
+
+class Profiler:
+    """
+    Профилирование запросов по требованию и выборочно.
+
+    Запрос с ?profile=cprofile|sample или заголовком X-Profile выполняется
+    под профилировщиком, если это разрешено конфигом. cprofile - cProfile
+    потока event loop и задач пулов парсинга, включая процессный пул;
+    sample - отсчёты стеков всех потоков с низкими накладными расходами.
+    ?profile_alloc=1 добавляет выделения памяти за время запроса
+    (tracemalloc). Ответ получает заголовок X-Profile-Id, отчёт доступен на
+    /v1/profiles?id=<id> после записи ответа и при заданном directory
+    сохраняется в JSON.
+
+    При sample_rate = N каждый N-й в среднем запрос профилируется в режиме
+    sample, результаты таких запросов суммируются в общий профиль
+    """
+
+    def __init__(self, enabled: bool = False, sample_rate: int = 0,
+                 interval: float = 0.005, top: int = 30,
+                 max_reports: int = 50, directory: str = None):
+        self.enabled = enabled
+        self.sample_rate = sample_rate
+        self.top = top
+        self.max_reports = max_reports
+        self.directory = directory
+        self.sampler = Sampler(interval)
+        self.reports = OrderedDict()
+        self.sampled_requests = 0
+        self.sampled_samples = 0
+        self.self_samples = Counter()
+        self.total_samples = Counter()
+        self._tracing = 0
+        self._lock = threading.Lock()
+
+    def configure(self, enabled: bool = None, sample_rate: int = None,
+                  interval: float = None, top: int = None,
+                  max_reports: int = None, directory: str = None,
+                  **kwargs):
+        """
+        Перенастройка профилирования из конфига приложения
+
+        :param
+            * *enabled* (``bool``) -- профилирование по ?profile= и
+            заголовку X-Profile
+        :param
+            * *sample_rate* (``int``) -- профилировать 1 из N запросов,
+            0 - выключено
+        :param
+            * *interval* (``float``) -- период отсчётов стеков, секунды
+        :param
+            * *top* (``int``) -- количество функций в отчёте
+        :param
+            * *max_reports* (``int``) -- количество хранимых отчётов
+        :param
+            * *directory* (``str``) -- каталог отчётов JSON, пустая строка -
+            только в памяти
+
+        :rtype: (``None``)
+        :return:
+        """
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if sample_rate is not None:
+            self.sample_rate = int(sample_rate)
+        if interval is not None:
+            self.sampler.interval = float(interval)
+        if top is not None:
+            self.top = int(top)
+        if max_reports is not None:
+            self.max_reports = int(max_reports)
+        if directory is not None:
+            self.directory = directory or None
+
+    def requested(self, request: web.Request) -> Optional[Profile]:
+        """
+        Профиль для запроса: по параметру или заголовку, либо выборочно
+
+        :param
+            * *request* (``Request``) -- http запрос
+
+        :rtype: (``Profile``)
+        :return: профиль, либо None
+        """
+        if request.path.startswith(SKIP_PATHS):
+            return None
+        mode = request.query.get('profile') or request.headers.get(HEADER)
+        if mode and self.enabled:
+            mode = mode.lower()
+            if mode not in MODES:
+                mode = 'cprofile'
+            allocations = request.query.get('profile_alloc', '') in (
+                '1', 'true', 'True')
+            return Profile(request, mode, False, allocations)
+        if self.sample_rate > 0 and \
+                random.randrange(self.sample_rate) == 0:
+            return Profile(request, 'sample', True, False)
+        return None
+
+    def start_tracing(self):
+        with self._lock:
+            if self._tracing == 0 and not tracemalloc.is_tracing():
+                tracemalloc.start()
+            self._tracing += 1
+
+    def stop_tracing(self):
+        with self._lock:
+            self._tracing -= 1
+            if self._tracing == 0:
+                tracemalloc.stop()
+
+    def finish(self, profile: Profile):
+        """
+        Сохранение отчёта завершённого профиля, выборочные профили
+        суммируются в общий
+
+        :param
+            * *profile* (``Profile``) -- профиль
+
+        :rtype: (``None``)
+        :return:
+        """
+        if profile.sampled:
+            with self._lock:
+                self.sampled_requests += 1
+                self.sampled_samples += profile.samples
+                self.self_samples.update(profile.self_samples)
+                self.total_samples.update(profile.total_samples)
+            return
+
+        report = profile.report(self.top)
+        self.reports[profile.id] = report
+        while len(self.reports) > self.max_reports:
+            self.reports.popitem(last=False)
+        log.info(f'PROFILE {profile.id} {profile.path} {profile.mode} '
+                 f'{profile.duration} sec')
+        if self.directory:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                path = os.path.join(self.directory, f'{profile.id}.json')
+                with open(path, 'w') as f:
+                    json.dump(report, f, indent=1)
+            except OSError as e:
+                log.warning(f'PROFILE NOT SAVED {profile.id}: {e!r}')
+
+    def aggregate(self) -> dict:
+        """
+        Общий профиль выборочно профилированных запросов
+
+        :rtype: (``dict``)
+        :return: количество запросов и отсчётов, самые частые функции
+        """
+        with self._lock:
+            return {
+                'sample_rate': self.sample_rate,
+                'requests': self.sampled_requests,
+                'samples': self.sampled_samples,
+                'functions': top_samples(self.self_samples,
+                                         self.total_samples,
+                                         self.sampled_samples, self.top)
+            }
+
+    def list(self) -> List[dict]:
+        """
+        Краткие сведения о сохранённых отчётах, новые первыми
+
+        :rtype: (``List[dict]``)
+        :return: отчёты без функций и выделений памяти
+        """
+        keys = ('id', 'path', 'query', 'mode', 'started', 'duration',
+                'status')
+        return [{k: x[k] for k in keys}
+                for x in reversed(list(self.reports.values()))]
+
+
+profiler = Profiler()
+
+
+async def add_profile_header(request: web.Request,
+                             response: web.StreamResponse):
+    """
+    Заголовок X-Profile-Id ответа профилируемого запроса, хук
+    on_response_prepare
+
+    :param
+        * *request* (``Request``) -- http запрос
+    :param
+        * *response* (``StreamResponse``) -- ответ
+
+    :rtype: (``None``)
+    :return:
+    """
+    profile = request.get('profile')
+    if profile is not None and not profile.sampled:
+        response.headers[ID_HEADER] = profile.id
+
+
+@web.middleware
+async def profiling_middleware(request: web.Request, handler):
+    """
+    Выполнение обработчика под профилировщиком, если запрос его требует
+
+    :param
+        * *request* (``Request``) -- http запрос
+    :param
+        * *handler* (``callable``) -- обработчик
+
+    :rtype: (``StreamResponse``)
+    :return: ответ обработчика
+    """
+    profile = profiler.requested(request)
+    if profile is None:
+        return await handler(request)
+
+    request['profile'] = profile
+    token = _current.set(profile)
+    profile.start()
+    try:
+        response = await handler(request)
+        profile.status = response.status
+        return response
+    except web.HTTPException as e:
+        profile.status = e.status
+        raise
+    except BaseException:
+        profile.status = 500
+        raise
+    finally:
+        profile.stop()
+        _current.reset(token)
+        profiler.finish(profile)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import functools
+import hashlib
+import os
+import tempfile
+import time
+from typing import AsyncIterable, List, Optional
+import logging
+from executor import parse_executor
+from itinerary_model import Itinerary
+from parse_cache import parsed_cache
+from snapshot import snapshots
+from xml_parser import RESPONSES_DIR, IncrementalParser, parse_models
+
+log = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+# порции тела собираются в пакеты: пакет хэшируется, пишется и парсится в
+# пуле, пока event loop читает следующий
+BATCH_SIZE = 1024 * 1024
+
+
+class UploadTooLarge(ValueError):
+    """
+    Размер загружаемого ответа больше допустимого
+    """
+
+
+class _Upload:
+    # состояние загрузки, с которым работают только задачи пула по очереди
+
+    def __init__(self, fd: int, incremental: bool):
+        self.file = os.fdopen(fd, 'wb')
+        self.digest = hashlib.sha256()
+        self.parser = IncrementalParser() if incremental else None
+
+    def consume(self, batch: List[bytes]):
+        for chunk in batch:
+            self.digest.update(chunk)
+            self.file.write(chunk)
+            if self.parser is not None:
+                self.parser.feed(chunk)
+
+    def close(self) -> Optional[List[Itinerary]]:
+        self.file.close()
+        return self.parser.close() if self.parser is not None else None
+
+
+class ResponseUploads:
+    """
+    Приём ответов партнёра в теле запроса. Event loop только читает тело,
+    пакеты порций по мере поступления хэшируются, пишутся во временный файл
+    и передаются инкрементальному парсеру в потоковом пуле парсинга, так
+    что к концу загрузки ответ уже распарсен. С процессным пулом парсера
+    состояние в процесс не передать: пакеты пишутся в потоке, а файл
+    парсится в пуле целиком после загрузки. Файл сохраняется
+    под sha256 содержимого, модель вариантов перелёта кладётся в общий
+    кэш, а снимок - рядом с файлом
+    """
+
+    def __init__(self, max_size: int = 256 * 1024 * 1024,
+                 directory: str = RESPONSES_DIR):
+        self.max_size = max_size
+        self.directory = directory
+
+    def configure(self, max_size: int = None, **kwargs):
+        """
+        Перенастройка приёма ответов из конфига приложения
+
+        :param
+            * *max_size* (``int``) -- максимальный размер ответа в байтах
+
+        :rtype: (``None``)
+        :return:
+        """
+        if max_size is not None:
+            self.max_size = int(max_size)
+
+    async def receive(self, chunks: AsyncIterable[bytes]) -> dict:
+        """
+        Приём и парсинг ответа партнёра. Некорректный xml - ET.ParseError,
+        вариант без билетов в одном из направлений - InvalidItinerary,
+        превышение размера - UploadTooLarge
+
+        :param
+            * *chunks* (``AsyncIterable[bytes]``) -- порции тела запроса
+
+        :rtype: (``dict``)
+        :return: идентификатор, размер и количество вариантов перелёта
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(prefix='.upload-', suffix='.xml',
+                                   dir=self.directory)
+        incremental = parse_executor.kind != 'process'
+        if incremental:
+            run = parse_executor.run
+        else:
+            run = functools.partial(asyncio.get_event_loop().run_in_executor,
+                                    None)
+        upload = _Upload(fd, incremental)
+        pending = None
+
+        def submit(func, *args) -> asyncio.Future:
+            # задачи над файлом и парсером идут строго по очереди, отмена
+            # запроса не обрывает их посреди записи
+            nonlocal pending
+            pending = asyncio.ensure_future(run(func, *args))
+            return pending
+
+        batch = list()
+        batch_size = 0
+        size = 0
+        start = time.time()
+        try:
+            async for chunk in chunks:
+                size += len(chunk)
+                if size > self.max_size:
+                    raise UploadTooLarge(
+                        f'Response is larger than {self.max_size} bytes')
+                batch.append(chunk)
+                batch_size += len(chunk)
+                if batch_size >= BATCH_SIZE:
+                    # следующий пакет читается, пока пул разбирает этот
+                    if pending is not None:
+                        await asyncio.shield(pending)
+                    submit(upload.consume, batch)
+                    batch = list()
+                    batch_size = 0
+            if pending is not None:
+                await asyncio.shield(pending)
+            await asyncio.shield(submit(upload.consume, batch))
+            itineraries = await asyncio.shield(submit(upload.close))
+            if itineraries is None:
+                itineraries = await parse_executor.run(parse_models, tmp,
+                                                       True)
+        except BaseException:
+            # задача пула ещё может писать в файл
+            if pending is not None:
+                await asyncio.wait({pending})
+            upload.file.close()
+            os.unlink(tmp)
+            raise
+
+        response_id = upload.digest.hexdigest()
+        file_path = f'{self.directory}/{response_id}.xml'
+        created = not os.path.exists(file_path)
+        if created:
+            os.replace(tmp, file_path)
+        else:
+            # тот же ответ уже загружен, его кэш и снимок действительны
+            os.unlink(tmp)
+        key = parsed_cache.key(file_path, 'models')
+        parsed_cache.put(key, itineraries)
+        if created:
+            await run(snapshots.save, key[:3], itineraries)
+
+        log.info(f'RESPONSE {response_id} {size} bytes, '
+                 f'{len(itineraries)} itineraries {time.time() - start} sec')
+        return {
+            'id': response_id,
+            'size': size,
+            'itineraries': len(itineraries),
+            'created': created
+        }
+
+    def list(self) -> list:
+        """
+        Идентификаторы загруженных ответов
+
+        :rtype: (``list``)
+        :return: идентификаторы
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        return sorted(x[:-4] for x in os.listdir(self.directory)
+                      if x.endswith('.xml') and not x.startswith('.'))
+
+
+uploads = ResponseUploads()
@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+import time
+from collections import Counter, defaultdict
+from typing import Optional, Sequence
+import logging
+import numpy as np
+from itinerary_model import MISSING, Itinerary
+from metrics import observe_stage
+from parse_cache import parsed_cache
+from timestamps import parse_timestamp
+from xml_parser import load_cached, load_models
+
+log = logging.getLogger(__name__)
+
+ONWARD, RETURN = 0, 1
+_EMPTY = np.zeros(0, dtype=np.int32)
+
+
+def _ids(values: list) -> np.ndarray:
+    return np.array(values, dtype=np.int32)
+
+
+class RouteIndex:
+    """
+    Индекс маршрутов одного ответа партнёра, строится один раз на файл.
+
+    Граф маршрутов: рёбра - билеты (Source -> Destination, перевозчик,
+    время вылета), списки смежности упорядочены по времени вылета.
+    Инвертированные индексы по плечам перелёта (туда и обратно): пара
+    (начало, конец) плеча, начало, конец и перевозчик - в отсортированные
+    номера плеч. Поиск по городам и перевозчику - пересечение таких списков
+    вместо обхода всего файла
+    """
+
+    def __init__(self, itineraries: Sequence[Itinerary]):
+        # рёбра графа
+        edge_source, edge_destination, edge_carrier = [], [], []
+        edge_departure, edge_itinerary = [], []
+        # плечи перелёта
+        leg_itinerary, leg_kind, leg_stops = [], [], []
+        od, origins, destinations, carriers = (defaultdict(list)
+                                               for _ in range(4))
+
+        for index, itinerary in enumerate(itineraries):
+            legs = [(ONWARD, itinerary.onward)]
+            if itinerary.returns is not None:
+                legs.append((RETURN, itinerary.returns))
+            for kind, segments in legs:
+                if not segments:
+                    continue
+                leg = len(leg_itinerary)
+                leg_itinerary.append(index)
+                leg_kind.append(kind)
+                leg_stops.append(len(segments) - 1)
+                origin = segments[0].source
+                destination = segments[-1].destination
+                od[(origin, destination)].append(leg)
+                origins[origin].append(leg)
+                destinations[destination].append(leg)
+                for carrier in {x.carrier_id for x in segments}:
+                    carriers[carrier].append(leg)
+                for segment in segments:
+                    edge_source.append(segment.source)
+                    edge_destination.append(segment.destination)
+                    edge_carrier.append(segment.carrier_id)
+                    edge_departure.append(
+                        parse_timestamp(segment.departure)
+                        if isinstance(segment.departure, str) else 0)
+                    edge_itinerary.append(index)
+
+        self.size = len(itineraries)
+        self.leg_itinerary = _ids(leg_itinerary)
+        self.leg_kind = np.array(leg_kind, dtype=np.int8)
+        self.leg_stops = np.array(leg_stops, dtype=np.int16)
+        self.od = {k: _ids(v) for k, v in od.items()}
+        self.origins = {k: _ids(v) for k, v in origins.items()}
+        self.destinations = {k: _ids(v) for k, v in destinations.items()}
+        self.carriers = {k: _ids(v) for k, v in carriers.items()}
+
+        self.edge_source = edge_source
+        self.edge_destination = edge_destination
+        self.edge_carrier = edge_carrier
+        self.edge_departure = np.array(edge_departure, dtype=np.int64)
+        self.edge_itinerary = _ids(edge_itinerary)
+        # список смежности: откуда -> куда -> рёбра по времени вылета
+        graph = defaultdict(lambda: defaultdict(list))
+        for edge, (source, destination) in enumerate(
+                zip(edge_source, edge_destination)):
+            graph[source][destination].append(edge)
+        self.graph = dict()
+        for source, targets in graph.items():
+            self.graph[source] = {
+                destination: np.array(
+                    sorted(edges, key=self.edge_departure.__getitem__),
+                    dtype=np.int32)
+                for destination, edges in targets.items()}
+
+        log.info(f'ROUTE INDEX {len(self.edge_source)} segments, '
+                 f'{len(self.leg_itinerary)} legs, {len(self.graph)} '
+                 f'airports')
+
+    @property
+    def origin(self) -> Optional[str]:
+        """
+        Отправная точка ответа: самое частое начало плеча туда
+        """
+        counts = Counter()
+        onward = self.leg_kind == ONWARD
+        for origin, legs in self.origins.items():
+            if origin is not MISSING and origin is not None:
+                counts[origin] = int(np.count_nonzero(onward[legs]))
+        return counts.most_common(1)[0][0] if counts else None
+
+    def destinations_from(self, source: str) -> list:
+        """
+        Аэропорты, куда есть прямой билет
+
+        :param
+            * *source* (``str``) -- аэропорт вылета
+
+        :rtype: (``list``)
+        :return: коды аэропортов
+        """
+        return sorted(self.graph.get(source, {}))
+
+    def flights(self, source: str, destination: str) -> np.ndarray:
+        """
+        Билеты между аэропортами по времени вылета
+
+        :param
+            * *source* (``str``) -- аэропорт вылета
+        :param
+            * *destination* (``str``) -- аэропорт прилёта
+
+        :rtype: (``np.ndarray``)
+        :return: номера рёбер графа
+        """
+        return self.graph.get(source, {}).get(destination, _EMPTY)
+
+    def search(self, origin: str = None, destination: str = None,
+               carrier: str = None, max_stops: int = None,
+               kind: int = None) -> np.ndarray:
+        """
+        Варианты перелёта, у которых есть плечо с заданными началом,
+        концом, перевозчиком и количеством пересадок
+
+        :param
+            * *origin* (``str``) -- начало плеча
+        :param
+            * *destination* (``str``) -- конец плеча
+        :param
+            * *carrier* (``str``) -- ID перевозчика любого билета плеча
+        :param
+            * *max_stops* (``int``) -- максимум пересадок в плече
+        :param
+            * *kind* (``int``) -- только плечи туда (ONWARD) или обратно
+            (RETURN)
+
+        :rtype: (``np.ndarray``)
+        :return: отсортированные индексы вариантов перелёта
+        """
+        if origin and destination:
+            candidates = [self.od.get((origin, destination), _EMPTY)]
+        else:
+            candidates = []
+            if origin:
+                candidates.append(self.origins.get(origin, _EMPTY))
+            if destination:
+                candidates.append(
+                    self.destinations.get(destination, _EMPTY))
+        if carrier:
+            candidates.append(self.carriers.get(carrier, _EMPTY))
+
+        if candidates:
+            # сначала самые короткие списки
+            candidates.sort(key=len)
+            legs = candidates[0]
+            for other in candidates[1:]:
+                legs = np.intersect1d(legs, other, assume_unique=True)
+        else:
+            legs = np.arange(len(self.leg_itinerary), dtype=np.int32)
+
+        if max_stops is not None:
+            legs = legs[self.leg_stops[legs] <= max_stops]
+        if kind is not None:
+            legs = legs[self.leg_kind[legs] == kind]
+        return np.unique(self.leg_itinerary[legs])
+
+
+async def get_route_index(file_path: str) -> RouteIndex:
+    """
+    Индекс маршрутов xml файла. Результат кэшируется до изменения файла
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+
+    :rtype: (``RouteIndex``)
+    :return: индекс маршрутов
+    """
+    return await load_cached(file_path, 'routes', load_routes)
+
+
+def load_routes(file_path: str) -> RouteIndex:
+    """
+    Синхронное построение индекса маршрутов. Модель вариантов перелёта
+    берётся из общего кэша
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+
+    :rtype: (``RouteIndex``)
+    :return: индекс маршрутов
+    """
+    itineraries = parsed_cache.get_or_parse(file_path, 'models', load_models)
+    start = time.time()
+    index = RouteIndex(itineraries)
+    elapsed = observe_stage('index', start, len(itineraries))
+    log.info(f'BUILDING ROUTE INDEX {elapsed} sec')
+    return index
@@ -9,8 +9,8 @@ setup(
         'aiohttp',
         'aiohttp-rest-api',
         'lxml',
+        'numpy',
         'pytoml',
-        'python-dateutil',
                       ],
     include_package_data=True,
     packages=find_packages(),
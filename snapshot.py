@@ -0,0 +1,384 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import Dict, List, Optional, Sequence
+import logging
+import numpy as np
+from itinerary_model import MISSING, Itinerary, Pricing, Segment
+from parse_cache import ParsedCache
+
+log = logging.getLogger(__name__)
+
+SNAPSHOT_VERSION = 1
+SNAPSHOT_SUFFIX = '.snapshot'
+# коды отсутствующего тега и пустого тега в таблице строк: отрицательный
+# индекс попадает в хвост [None, MISSING] декодирующего списка
+MISSING_CODE = -1
+NONE_CODE = -2
+# колонки таблицы вариантов перелёта
+ONWARD_START, ONWARD_COUNT, RETURN_START, RETURN_COUNT, CURRENCY, \
+    CHARGES_START, CHARGES_COUNT = range(7)
+MODEL_ARRAYS = ('segments', 'itineraries', 'charges')
+
+
+class SnapshotItineraries(Sequence):
+    """
+    Варианты перелёта снимка. Хранятся в целочисленных массивах, модель
+    варианта собирается при обращении к нему
+    """
+
+    def __init__(self, strings: list, segments: np.ndarray,
+                 itineraries: np.ndarray, charges: np.ndarray):
+        self._strings = list(strings) + [None, MISSING]
+        self._segments = segments
+        self._itineraries = itineraries
+        self._charges = charges
+
+    def __len__(self):
+        return len(self._itineraries)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        row = self._itineraries[index].tolist()
+        returns = None
+        if row[RETURN_START] >= 0:
+            returns = self._decode_segments(row[RETURN_START],
+                                            row[RETURN_COUNT])
+        pricing = None
+        if row[CHARGES_START] >= 0:
+            strings = self._strings
+            charges = self._charges[
+                row[CHARGES_START]:row[CHARGES_START] + row[CHARGES_COUNT]]
+            pricing = Pricing(
+                strings[row[CURRENCY]],
+                tuple(tuple(strings[x] for x in charge)
+                      for charge in charges.tolist()))
+        return Itinerary(
+            self._decode_segments(row[ONWARD_START], row[ONWARD_COUNT]),
+            returns, pricing)
+
+    def _decode_segments(self, start: int, count: int) -> tuple:
+        strings = self._strings
+        return tuple(Segment(*(strings[x] for x in row))
+                     for row in self._segments[start:start + count].tolist())
+
+
+class Snapshot:
+    """
+    Загруженный снимок xml файла: таблица строк и отображённые в память
+    массивы
+    """
+
+    def __init__(self, path: str, meta: dict, strings: list,
+                 arrays: Dict[str, np.ndarray]):
+        self.path = path
+        self.meta = meta
+        self.strings = strings
+        self.arrays = arrays
+        self.itineraries = SnapshotItineraries(
+            strings, *(arrays[x] for x in MODEL_ARRAYS))
+
+
+class _Encoder:
+    # словарное кодирование строк снимка
+
+    def __init__(self):
+        self.codes = dict()
+        self.strings = list()
+
+    def __call__(self, value) -> int:
+        if value is MISSING:
+            return MISSING_CODE
+        if value is None:
+            return NONE_CODE
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.strings)
+            self.strings.append(value)
+        return code
+
+
+def encode_itineraries(itineraries: Sequence[Itinerary]) -> tuple:
+    """
+    Кодирование вариантов перелёта в целочисленные массивы
+
+    :param
+        * *itineraries* (``Sequence[Itinerary]``) -- варианты перелёта
+
+    :rtype: (``tuple``)
+    :return: таблица строк и словарь массивов модели
+    """
+    encode = _Encoder()
+    segments, rows, charges = list(), list(), list()
+
+    def add_segments(leg) -> tuple:
+        start = len(segments)
+        segments.extend([encode(x) for x in segment.key()] for segment in leg)
+        return start, len(leg)
+
+    for itinerary in itineraries:
+        onward = add_segments(itinerary.onward)
+        returns = (-1, 0) if itinerary.returns is None \
+            else add_segments(itinerary.returns)
+        pricing = itinerary.pricing
+        if pricing is None:
+            price = (NONE_CODE, -1, 0)
+        else:
+            price = (encode(pricing.currency), len(charges),
+                     len(pricing.charges))
+            charges.extend([encode(x) for x in charge]
+                           for charge in pricing.charges)
+        rows.append(onward + returns + price)
+
+    arrays = {
+        'segments': np.array(segments, dtype=np.int32).reshape(
+            -1, len(Segment.__slots__)),
+        'itineraries': np.array(rows, dtype=np.int32).reshape(-1, 7),
+        'charges': np.array(charges, dtype=np.int32).reshape(-1, 3)
+    }
+    return encode.strings, arrays
+
+
+class SnapshotStorage:
+    """
+    Снимки распарсенных xml файлов на диске: каталог <файл>.snapshot рядом с
+    исходным файлом. Снимок хранит таблицу строк и целочисленные и
+    числовые массивы в формате .npy, которые загружаются через mmap и
+    разделяются страницами между процессами. Снимок действителен, пока
+    совпадает отпечаток исходного файла
+    """
+
+    def __init__(self, enabled: bool = True, write: bool = True):
+        self.enabled = enabled
+        self.write = write
+
+    def configure(self, enabled: bool = None, write: bool = None, **kwargs):
+        """
+        Перенастройка снимков из конфига приложения
+
+        :param
+            * *enabled* (``bool``) -- загружать снимки
+        :param
+            * *write* (``bool``) -- сохранять снимки после парсинга
+
+        :rtype: (``None``)
+        :return:
+        """
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        if write is not None:
+            self.write = bool(write)
+
+    @staticmethod
+    def path(file_path: str) -> str:
+        """
+        Каталог снимка xml файла
+
+        :param
+            * *file_path* (``str``) -- путь к файлу
+
+        :rtype: (``str``)
+        :return: путь к каталогу снимка
+        """
+        return os.path.realpath(file_path) + SNAPSHOT_SUFFIX
+
+    @staticmethod
+    def _meta(fingerprint: tuple) -> dict:
+        _, size, mtime_ns = fingerprint
+        return {'version': SNAPSHOT_VERSION, 'size': size,
+                'mtime_ns': mtime_ns}
+
+    def _read_meta(self, path: str) -> Optional[dict]:
+        try:
+            with open(f'{path}/meta.json') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def load(self, file_path: str) -> Optional[Snapshot]:
+        """
+        Загрузка действительного снимка xml файла
+
+        :param
+            * *file_path* (``str``) -- путь к файлу
+
+        :rtype: (``Snapshot``)
+        :return: снимок, либо None, если его нет или он устарел
+        """
+        if not self.enabled:
+            return None
+        path = self.path(file_path)
+        meta = self._read_meta(path)
+        if meta is None:
+            return None
+        if meta != self._meta(ParsedCache.fingerprint(file_path)):
+            log.info(f'SNAPSHOT STALE {path}')
+            return None
+
+        start = time.time()
+        try:
+            with open(f'{path}/strings.json', encoding='utf-8') as f:
+                strings = json.load(f)
+            arrays = dict()
+            for name in os.listdir(path):
+                if name.endswith('.npy') and not name.startswith('.'):
+                    arrays[name[:-4]] = np.load(f'{path}/{name}',
+                                                mmap_mode='r')
+            snapshot = Snapshot(path, meta, strings, arrays)
+        except (OSError, ValueError, KeyError) as e:
+            log.warning(f'SNAPSHOT BROKEN {path}: {e!r}')
+            return None
+        log.info(f'SNAPSHOT LOADED {path} {time.time() - start} sec')
+        return snapshot
+
+    def save(self, fingerprint: tuple, itineraries: Sequence[Itinerary],
+             arrays: Dict[str, np.ndarray] = None) -> Optional[str]:
+        """
+        Сохранение снимка вариантов перелёта. Каталог собирается во
+        временном и подменяет прежний снимок целиком
+
+        :param
+            * *fingerprint* (``tuple``) -- отпечаток файла до парсинга
+        :param
+            * *itineraries* (``Sequence[Itinerary]``) -- варианты перелёта
+        :param
+            * *arrays* (``Dict[str, np.ndarray]``) -- дополнительные
+            массивы
+
+        :rtype: (``str``)
+        :return: путь к каталогу снимка, либо None
+        """
+        if not self.write:
+            return None
+        path = self.path(fingerprint[0])
+        start = time.time()
+        strings, models = encode_itineraries(itineraries)
+        models.update(arrays or {})
+        tmp = None
+        try:
+            tmp = tempfile.mkdtemp(prefix='.tmp-',
+                                   dir=os.path.dirname(path))
+            with open(f'{tmp}/strings.json', 'w', encoding='utf-8') as f:
+                json.dump(strings, f, ensure_ascii=False)
+            for name, array in models.items():
+                np.save(f'{tmp}/{name}.npy', np.ascontiguousarray(array))
+            with open(f'{tmp}/meta.json', 'w') as f:
+                json.dump(self._meta(fingerprint), f)
+            self._replace(tmp, path)
+        except OSError as e:
+            if tmp:
+                shutil.rmtree(tmp, ignore_errors=True)
+            log.warning(f'SNAPSHOT NOT SAVED {path}: {e!r}')
+            return None
+        log.info(f'SNAPSHOT SAVED {path} {time.time() - start} sec')
+        return path
+
+    def update(self, fingerprint: tuple,
+               arrays: Dict[str, np.ndarray]) -> bool:
+        """
+        Дополнение действительного снимка массивами
+
+        :param
+            * *fingerprint* (``tuple``) -- отпечаток файла, по которому
+            построены массивы
+        :param
+            * *arrays* (``Dict[str, np.ndarray]``) -- массивы
+
+        :rtype: (``bool``)
+        :return: массивы сохранены
+        """
+        if not self.write:
+            return False
+        path = self.path(fingerprint[0])
+        if self._read_meta(path) != self._meta(fingerprint):
+            return False
+        try:
+            for name, array in arrays.items():
+                fd, tmp = tempfile.mkstemp(prefix='.tmp-', suffix='.npy',
+                                           dir=path)
+                with os.fdopen(fd, 'wb') as f:
+                    np.save(f, np.ascontiguousarray(array))
+                os.replace(tmp, f'{path}/{name}.npy')
+        except OSError as e:
+            log.warning(f'SNAPSHOT NOT UPDATED {path}: {e!r}')
+            return False
+        log.info(f'SNAPSHOT UPDATED {path} {sorted(arrays)}')
+        return True
+
+    @staticmethod
+    def _replace(tmp: str, path: str):
+        # каталог нельзя атомарно заменить непустым, поэтому прежний снимок
+        # сначала убирается в сторону. Процессы, уже отобразившие его
+        # файлы в память, продолжают работать со старыми страницами
+        old = None
+        if os.path.exists(path):
+            old = tempfile.mkdtemp(prefix='.old-', dir=os.path.dirname(path))
+            os.rename(path, f'{old}/snapshot')
+        os.rename(tmp, path)
+        if old:
+            shutil.rmtree(old, ignore_errors=True)
+
+    def remove(self, file_path: str) -> bool:
+        """
+        Удаление снимка xml файла
+
+        :param
+            * *file_path* (``str``) -- путь к файлу
+
+        :rtype: (``bool``)
+        :return: снимок был удалён
+        """
+        path = self.path(file_path)
+        if not os.path.isdir(path):
+            return False
+        shutil.rmtree(path, ignore_errors=True)
+        return True
+
+
+snapshots = SnapshotStorage()
+
+
+def build_snapshots(data_dir: str) -> List[str]:
+    """
+    Сборка снимков всех xml файлов каталога
+
+    :param
+        * *data_dir* (``str``) -- каталог с ответами партнёра
+
+    :rtype: (``List[str]``)
+    :return: пути к собранным снимкам
+    """
+    from itinerary_store import ItineraryStore
+    from xml_parser import parse_models
+
+    paths = list()
+    for name in sorted(os.listdir(data_dir)):
+        if not name.endswith('.xml'):
+            continue
+        file_path = os.path.join(data_dir, name)
+        fingerprint = ParsedCache.fingerprint(file_path)
+        store = ItineraryStore(parse_models(fingerprint[0]))
+        path = snapshots.save(fingerprint, store.itineraries,
+                              store.snapshot_arrays())
+        if path:
+            paths.append(path)
+    return paths
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Build snapshots of partner responses')
+    parser.add_argument("-d", "--data", help="Path to data directory",
+                        default=os.path.dirname(os.path.realpath(__file__)) +
+                        '/data')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    for snapshot_path in build_snapshots(args.data):
+        print(snapshot_path)
@@ -0,0 +1,325 @@
+# -*- coding: utf-8 -*-
+from typing import AsyncIterator, Iterable, Iterator
+import json
+import time
+import logging
+from aiohttp.web import Request, StreamResponse
+from executor import ParseExecutor
+from metrics import STAGE_SECONDS
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+log = logging.getLogger(__name__)
+
+JSON = 'application/json'
+NDJSON = 'application/x-ndjson'
+# размер порции, которой тело ответа отдаётся клиенту
+CHUNK_SIZE = 64 * 1024
+
+
+def _default(value):
+    # скаляры NumPy
+    if hasattr(value, 'item'):
+        return value.item()
+    raise TypeError(f'Type is not JSON serializable: {type(value)}')
+
+
+if orjson is not None:
+    def dumps(value) -> bytes:
+        """
+        Кодирование значения в JSON
+
+        :rtype: (``bytes``)
+        :return: JSON
+        """
+        return orjson.dumps(value, default=_default)
+elif ujson is not None:
+    def dumps(value) -> bytes:
+        """
+        Кодирование значения в JSON
+
+        :rtype: (``bytes``)
+        :return: JSON
+        """
+        return ujson.dumps(value).encode()
+else:
+    def dumps(value) -> bytes:
+        """
+        Кодирование значения в JSON
+
+        :rtype: (``bytes``)
+        :return: JSON
+        """
+        return json.dumps(value, separators=(',', ':'),
+                          default=_default).encode()
+
+
+class LazyObject:
+    """
+    JSON объект, пары ключ-значение которого вычисляются по мере записи
+    ответа
+    """
+    __slots__ = ('pairs', )
+
+    def __init__(self, pairs: Iterable[tuple]):
+        self.pairs = pairs
+
+    def items(self) -> Iterable[tuple]:
+        return self.pairs
+
+    def close(self):
+        """
+        Освобождение ресурсов, занятых вычислением пар, если ответ не
+        дописан
+
+        :rtype: (``None``)
+        :return:
+        """
+        close = getattr(self.pairs, 'close', None)
+        if close is not None:
+            close()
+
+
+class LazyArray:
+    """
+    JSON массив, элементы которого вычисляются по мере записи ответа
+    """
+    __slots__ = ('values', )
+
+    def __init__(self, values: Iterable):
+        self.values = values
+
+    def __iter__(self):
+        return iter(self.values)
+
+
+def iter_json(value, depth: int = 2) -> Iterator[bytes]:
+    """
+    Кодирование значения в JSON по частям: объекты и списки до глубины
+    depth раскрываются по элементам, глубже кодируются целиком
+
+    :param
+        * *value* -- значение
+    :param
+        * *depth* (``int``) -- глубина поэлементного кодирования
+
+    :rtype: (``Iterator[bytes]``)
+    :return: части JSON
+    """
+    if depth > 0 and isinstance(value, (dict, LazyObject)):
+        separator = b'{'
+        for key, item in value.items():
+            yield separator + dumps(str(key)) + b':'
+            yield from iter_json(item, depth - 1)
+            separator = b','
+        yield b'{}' if separator == b'{' else b'}'
+    elif depth > 0 and isinstance(value, (list, LazyArray)):
+        separator = b'['
+        for item in value:
+            yield separator
+            yield from iter_json(item, depth - 1)
+            separator = b','
+        yield b'[]' if separator == b'[' else b']'
+    else:
+        yield dumps(value)
+
+
+def iter_ndjson(records: Iterable) -> Iterator[bytes]:
+    """
+    Кодирование записей в NDJSON: одна запись - одна строка
+
+    :param
+        * *records* (``Iterable``) -- записи
+
+    :rtype: (``Iterator[bytes]``)
+    :return: строки NDJSON
+    """
+    for record in records:
+        yield dumps(record) + b'\n'
+
+
+def object_records(data) -> Iterator[dict]:
+    """
+    Записи NDJSON объекта: по одной на пару ключ-значение
+
+    :param
+        * *data* (``dict or LazyObject``) -- объект
+
+    :rtype: (``Iterator[dict]``)
+    :return: записи {key, value}
+    """
+    for key, value in data.items():
+        yield {'key': key, 'value': value}
+
+
+def section_records(data) -> Iterator[dict]:
+    """
+    Записи NDJSON объекта из разделов: по одной на элемент раздела
+
+    :param
+        * *data* (``dict or LazyObject``) -- разделы, словари или
+        списки
+
+    :rtype: (``Iterator[dict]``)
+    :return: записи {section, key, value} или {section, value}
+    """
+    for section, value in data.items():
+        if isinstance(value, dict):
+            for key, item in value.items():
+                yield {'section': section, 'key': key, 'value': item}
+        elif isinstance(value, (list, LazyArray)):
+            for item in value:
+                yield {'section': section, 'value': item}
+        else:
+            yield {'section': section, 'value': value}
+
+
+def wants_ndjson(request: Request) -> bool:
+    """
+    Клиент запросил NDJSON параметром format=ndjson или заголовком Accept
+
+    :param
+        * *request* (``Request``) -- http запрос
+
+    :rtype: (``bool``)
+    :return: ответ в NDJSON
+    """
+    fmt = request.query.get('format')
+    if fmt:
+        return fmt.lower() == 'ndjson'
+    return NDJSON in request.headers.get('Accept', '')
+
+
+def iter_blocks(chunks: Iterable[bytes]) -> Iterator[bytes]:
+    """
+    Склейка частей тела в порции не меньше CHUNK_SIZE, последняя - остаток
+
+    :param
+        * *chunks* (``Iterable[bytes]``) -- части тела
+
+    :rtype: (``Iterator[bytes]``)
+    :return: порции тела
+    """
+    buffer = bytearray()
+    for chunk in chunks:
+        buffer += chunk
+        if len(buffer) >= CHUNK_SIZE:
+            yield bytes(buffer)
+            buffer.clear()
+    if buffer:
+        yield bytes(buffer)
+
+
+async def _produce(blocks: Iterator[bytes],
+                   executor: ParseExecutor = None) -> AsyncIterator[bytes]:
+    # без пула порции собираются в event loop, с пулом - задачами пула
+    if executor is None:
+        for block in blocks:
+            yield block
+        return
+    async for batch in executor.iterate(blocks, 1):
+        for block in batch:
+            yield block
+
+
+async def stream_response(request: Request, chunks: Iterable[bytes],
+                          content_type: str = JSON, status: int = 200,
+                          headers: dict = None,
+                          executor: ParseExecutor = None) -> StreamResponse:
+    """
+    Отдача тела ответа по частям с chunked transfer encoding. Части
+    копятся до CHUNK_SIZE, между порциями event loop свободен. С пулом
+    порции вычисляются и кодируются задачами пула, event loop только
+    пишет их. Время получения порций без ожидания записи - стадия
+    serialise
+
+    :param
+        * *request* (``Request``) -- http запрос
+    :param
+        * *chunks* (``Iterable[bytes]``) -- части тела
+    :param
+        * *content_type* (``str``) -- тип содержимого
+    :param
+        * *status* (``int``) -- код ответа
+    :param
+        * *headers* (``dict``) -- дополнительные заголовки
+    :param
+        * *executor* (``ParseExecutor``) -- пул для вычисления частей,
+        None - event loop
+
+    :rtype: (``StreamResponse``)
+    :return: ответ
+    """
+    response = StreamResponse(status=status, headers=headers)
+    response.content_type = content_type
+    response.enable_chunked_encoding()
+    await response.prepare(request)
+
+    blocks = iter_blocks(chunks)
+    producer = _produce(blocks, executor)
+    elapsed = 0.0
+    start = time.perf_counter()
+    try:
+        async for block in producer:
+            elapsed += time.perf_counter() - start
+            await response.write(block)
+            start = time.perf_counter()
+        elapsed += time.perf_counter() - start
+    finally:
+        # при обрыве соединения части не дочитываются
+        await producer.aclose()
+        blocks.close()
+    STAGE_SECONDS.observe(elapsed, stage='serialise')
+    await response.write_eof()
+    return response
+
+
+def encode_body(request: Request, data, records=object_records,
+                depth: int = 2) -> tuple:
+    """
+    Тип содержимого и части тела ответа JSON или NDJSON по выбору клиента
+
+    :param
+        * *request* (``Request``) -- http запрос
+    :param
+        * *data* (``dict or LazyObject``) -- данные ответа
+    :param
+        * *records* (``callable``) -- разбиение данных на записи NDJSON
+    :param
+        * *depth* (``int``) -- глубина поэлементного кодирования JSON
+
+    :rtype: (``tuple``)
+    :return: тип содержимого и итератор частей тела
+    """
+    if wants_ndjson(request):
+        return NDJSON, iter_ndjson(records(data))
+    return JSON, iter_json(data, depth)
+
+
+async def respond_streaming(request: Request, data, records=object_records,
+                            depth: int = 2) -> StreamResponse:
+    """
+    Потоковый ответ JSON или NDJSON по выбору клиента
+
+    :param
+        * *request* (``Request``) -- http запрос
+    :param
+        * *data* (``dict or LazyObject``) -- данные ответа
+    :param
+        * *records* (``callable``) -- разбиение данных на записи NDJSON
+    :param
+        * *depth* (``int``) -- глубина поэлементного кодирования JSON
+
+    :rtype: (``StreamResponse``)
+    :return: ответ
+    """
+    content_type, chunks = encode_body(request, data, records, depth)
+    return await stream_response(request, chunks, content_type)
@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+import asyncio
+from coalescing import SingleFlight, coalesce, query_key
+
+
+def test_query_key_keeps_sequence_order():
+    assert query_key(weights=(1.0, 0.0, 0.0)) != \
+        query_key(weights=(0.0, 0.0, 1.0))
+    assert query_key(fields=['a', 'b']) != query_key(fields=['b', 'a'])
+
+
+def test_query_key_ignores_set_order_and_empty_params():
+    assert query_key(carriers={'EK', 'AI'}) == \
+        query_key(carriers={'AI', 'EK'})
+    assert query_key(action='cheap', limit=None, fields=[]) == \
+        query_key(action='cheap')
+    assert query_key(need_return='TRUE') == query_key(need_return='true')
+
+
+def test_concurrent_calls_with_reordered_weights_are_not_coalesced():
+    calls = []
+
+    @coalesce('test_weights')
+    async def select(**kwargs):
+        calls.append(kwargs['weights'])
+        await asyncio.sleep(0.01)
+        return kwargs['weights']
+
+    async def main():
+        return await asyncio.gather(
+            select(action='optimal', weights=(1.0, 0.0, 0.0)),
+            select(action='optimal', weights=(0.0, 0.0, 1.0)))
+
+    first, second = asyncio.run(main())
+    assert first == (1.0, 0.0, 0.0)
+    assert second == (0.0, 0.0, 1.0)
+    assert len(calls) == 2
+
+
+def test_concurrent_identical_calls_are_coalesced():
+    flight = SingleFlight('test_identical')
+    calls = []
+
+    async def compute(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    async def main():
+        key = query_key(action='cheap')
+        return await asyncio.gather(
+            *(flight.do(key, compute, 1) for _ in range(3)))
+
+    assert asyncio.run(main()) == [1, 1, 1]
+    assert len(calls) == 1
+    assert flight.stats()['coalesced'] == 2
+
+
+def test_optimal_pages_differ_for_reordered_weights():
+    from app_methods import select_flight_tickets
+
+    async def main():
+        return await asyncio.gather(
+            select_flight_tickets(need_return='true', action='optimal',
+                                  limit=3, weights=(1.0, 0.0, 0.0)),
+            select_flight_tickets(need_return='true', action='optimal',
+                                  limit=3, weights=(0.0, 0.0, 1.0)))
+
+    (_, first), (_, second) = asyncio.run(main())
+    assert list(first) != list(second)
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+from executor import ParseExecutor
+from external_diff import ExternalDiff
+from streaming import iter_json
+from xml_parser import get_file_key_path
+
+
+def _compare(tmp_path):
+    async def main():
+        executor = ParseExecutor('thread', max_workers=2, name='test_diff')
+        try:
+            return await ExternalDiff(memory_budget=4096,
+                                      tmp_dir=str(tmp_path)).compare(
+                [get_file_key_path('1'), get_file_key_path('2')], 'DXB',
+                executor)
+        finally:
+            executor.shutdown()
+
+    return asyncio.run(main())
+
+
+def test_temporary_files_are_removed_after_the_response(tmp_path):
+    compare = _compare(tmp_path)
+    body = b''.join(iter_json(compare))
+    assert body.startswith(b'{"differences":[')
+    assert os.listdir(tmp_path) == []
+
+
+def test_close_removes_temporary_files_of_an_unfinished_response(tmp_path):
+    compare = _compare(tmp_path)
+    chunks = iter_json(compare)
+    next(chunks)
+    next(chunks)
+    assert os.listdir(tmp_path)
+    compare.close()
+    assert os.listdir(tmp_path) == []
+
+
+def test_close_before_the_response_is_written(tmp_path):
+    compare = _compare(tmp_path)
+    compare.close()
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import xml_parser
+from xml_parser import build_schema
+
+
+def _first_round_trip():
+    return xml_parser.parse_models(
+        f'{xml_parser.DATA_DIR}/{xml_parser.FILENAMES["1"]}')[0]
+
+
+def test_to_dict_without_schema_has_all_parts():
+    data = _first_round_trip().to_dict()
+    assert list(data) == ['OnwardPricedItinerary', 'ReturnPricedItinerary',
+                          'Pricing']
+
+
+def test_to_dict_builds_only_requested_fields():
+    itinerary = _first_round_trip()
+    schema = build_schema(['Pricing/currency',
+                           'OnwardPricedItinerary/Flights/Flight/Source'])
+    data = itinerary.to_dict(schema)
+    assert data['Pricing'] == {'currency': itinerary.pricing.currency}
+    flights = data['OnwardPricedItinerary']['Flights']['Flight']
+    flights = flights if isinstance(flights, list) else [flights]
+    assert flights == [{'Source': x.source} for x in itinerary.onward]
+    assert 'ReturnPricedItinerary' not in data
+
+
+def test_to_dict_keeps_requested_nodes_without_matching_children():
+    data = _first_round_trip().to_dict(
+        build_schema(['OnwardPricedItinerary/Unknown', 'Pricing/Unknown']))
+    assert data == {'OnwardPricedItinerary': {}, 'Pricing': {}}
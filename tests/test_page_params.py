@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+import pytest
+from app_methods import page_params
+
+
+def test_defaults():
+    params = page_params({})
+    assert params['action'] == 'cheap'
+    assert params['offset'] == 0
+    assert params['limit'] is None
+
+
+def test_fields_are_normalised():
+    params = page_params({'fields': 'Pricing,OnwardPricedItinerary,Pricing'})
+    assert params['fields'] == ['OnwardPricedItinerary', 'Pricing']
+
+
+def test_need_return_is_ignored_for_uploaded_response():
+    assert page_params({'response': 'f' * 64, 'need_return': 'maybe'})
+
+
+@pytest.mark.parametrize('query', [
+    {'need_return': 'maybe'},
+    {'action': 'fastst'},
+    {'limit': 'x'},
+    {'offset': '-1'},
+    {'weights': '1,2'},
+])
+def test_invalid_params(query):
+    with pytest.raises(ValueError):
+        page_params(query)
@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+import importlib.util
+import json
+import sys
+import numpy as np
+import streaming
+
+
+def test_dumps_falls_back_to_stdlib_json(monkeypatch):
+    # отдельная копия модуля, чтобы не подменять классы streaming
+    monkeypatch.setitem(sys.modules, 'orjson', None)
+    monkeypatch.setitem(sys.modules, 'ujson', None)
+    spec = importlib.util.spec_from_file_location('streaming_json',
+                                                  streaming.__file__)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    assert module.orjson is None and module.ujson is None
+    value = {'price': np.float64(1.5), 'stops': np.int64(0),
+             'name': 'Дубай'}
+    assert json.loads(module.dumps(value)) == \
+        {'price': 1.5, 'stops': 0, 'name': 'Дубай'}
+    assert b''.join(module.iter_json({'a': [1, 2]})) == b'{"a":[1,2]}'
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import os
+import pytest
+from watcher import DataWatcher, INOTIFY_EVENT, IN_Q_OVERFLOW, _Inotify
+
+
+def _write(path, data: bytes):
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+def test_queue_overflow_rescans_the_directory(tmp_path):
+    kept = tmp_path / 'kept.xml'
+    changed = tmp_path / 'changed.xml'
+    removed = tmp_path / 'removed.xml'
+    for path in (kept, changed, removed):
+        _write(path, b'<a/>')
+
+    async def main():
+        watcher = DataWatcher(backend='inotify', settle=60,
+                              directory=str(tmp_path))
+        try:
+            await watcher.start()
+        except OSError as e:
+            pytest.skip(f'inotify unavailable: {e!r}')
+        try:
+            await watcher._baseline
+            # события изменений потеряны, в очереди только переполнение
+            watcher._inotify.read = lambda: ([], True)
+            _write(changed, b'<a><b/></a>')
+            os.unlink(removed)
+            _write(tmp_path / 'added.xml', b'<a/>')
+            watcher._read_events()
+            return set(watcher._timers), set(watcher._files)
+        finally:
+            await watcher.stop()
+
+    timers, files = asyncio.run(main())
+    paths = {x: os.path.realpath(tmp_path / x)
+             for x in ('kept.xml', 'changed.xml', 'removed.xml',
+                       'added.xml')}
+    assert timers == {paths['changed.xml'], paths['removed.xml'],
+                      paths['added.xml']}
+    assert files == {paths['kept.xml'], paths['changed.xml'],
+                     paths['added.xml']}
+
+
+def test_read_reports_queue_overflow(tmp_path):
+    try:
+        inotify = _Inotify(str(tmp_path))
+    except (AttributeError, OSError) as e:
+        pytest.skip(f'inotify unavailable: {e!r}')
+    try:
+        _write(tmp_path / 'a.xml', b'<a/>')
+        names, overflow = inotify.read()
+        assert 'a.xml' in names and not overflow
+    finally:
+        inotify.close()
+
+    # событие переполнения ядро пишет без имени и с wd -1
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, INOTIFY_EVENT.pack(-1, IN_Q_OVERFLOW, 0, 0))
+    os.close(write_fd)
+    inotify.fd = read_fd
+    try:
+        assert inotify.read() == ([], True)
+    finally:
+        inotify.close()
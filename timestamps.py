@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+from datetime import datetime, timezone
+from functools import lru_cache
+import logging
+
+log = logging.getLogger(__name__)
+
+# формат времени в ответах партнёра: 2018-10-22T0005
+TIMESTAMP_LENGTH = 15
+MEMO_SIZE = 8192
+
+_DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+_DIGITS = frozenset('0123456789')
+_FALLBACK_FORMATS = ('%Y-%m-%dT%H%M', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S',
+                     '%Y-%m-%dT%H%M%S', '%Y%m%dT%H%M')
+
+
+def _days_from_civil(year: int, month: int, day: int) -> int:
+    # количество дней от 1970-01-01 для пролептического григорианского
+    # календаря (алгоритм H. Hinnant)
+    year -= month <= 2
+    era = (year if year >= 0 else year - 399) // 400
+    yoe = year - era * 400
+    doy = (153 * (month + (-3 if month > 2 else 9)) + 2) // 5 + day - 1
+    doe = yoe * 365 + yoe // 4 - yoe // 100 + doy
+    return era * 146097 + doe - 719468
+
+
+def _is_leap(year: int) -> bool:
+    return year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+
+
+@lru_cache(maxsize=MEMO_SIZE)
+def parse_timestamp(value: str) -> int:
+    """
+    Разбор времени партнёра YYYY-MM-DDTHHMM в минуты от начала эпохи.
+    Фиксированный формат разбирается срезами строки, остальные форматы
+    проходят строгую проверку через datetime. Результаты запоминаются,
+    т.к. у вариантов перелёта много общих времён вылета и прилёта
+
+    :param
+        * *value* (``str``) -- время в формате партнёра
+
+    :rtype: (``int``)
+    :return: минуты от 1970-01-01T00:00 UTC
+    """
+    if len(value) == TIMESTAMP_LENGTH and value[4] == '-' and \
+            value[7] == '-' and value[10] == 'T' and \
+            _DIGITS.issuperset(value[:4] + value[5:7] + value[8:10] +
+                               value[11:]):
+        year, month, day = int(value[:4]), int(value[5:7]), int(value[8:10])
+        hour, minute = int(value[11:13]), int(value[13:])
+        if 1 <= month <= 12 and hour < 24 and minute < 60 and \
+                1 <= day <= _DAYS_IN_MONTH[month - 1] + (
+                month == 2 and _is_leap(year)):
+            return (_days_from_civil(year, month, day) * 1440 +
+                    hour * 60 + minute)
+        raise ValueError(f'Invalid timestamp {value!r}')
+    return _parse_fallback(value)
+
+
+def _parse_fallback(value: str) -> int:
+    log.debug(f'Unexpected timestamp format {value!r}')
+    moment = None
+    for fmt in _FALLBACK_FORMATS:
+        try:
+            moment = datetime.strptime(value, fmt)
+            break
+        except ValueError:
+            continue
+    if moment is None:
+        try:
+            # полный ISO 8601 с часовым поясом
+            moment = datetime.fromisoformat(value)
+        except ValueError:
+            raise ValueError(f'Invalid timestamp {value!r}') from None
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    return int(moment.timestamp()) // 60
+
+
+def format_travel_time(total_time: int) -> str:
+    """
+    Текстовое представление общего времени полёта
+
+    :param
+        * *total_time* (``int``) -- время полёта в секундах
+
+    :rtype: (``str``)
+    :return: время полёта в виде '1д 2ч 3м'
+    """
+    days, seconds = divmod(total_time, 86400)
+    time_info = f'{seconds // 3600}ч {(seconds // 60) % 60}м'
+    if days:
+        time_info = f'{days}д {time_info}'
+    return time_info
@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import ctypes
+import ctypes.util
+import hashlib
+import os
+import struct
+import time
+from collections import deque
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+import logging
+from executor import parse_executor
+from http_cache import response_cache
+from itinerary_model import Itinerary
+from itinerary_store import load_store
+from metrics import metrics
+from parse_cache import parsed_cache
+from xml_parser import DATA_DIR, begin_refresh, end_refresh, load_models, \
+    refresh_cached, register_loader
+
+log = logging.getLogger(__name__)
+
+RELOADS = metrics.counter(
+    'watcher_reloads_total',
+    'Фоновые пересборки изменённых файлов: ok, failed, removed',
+    ('result', ))
+RELOAD_SECONDS = metrics.histogram(
+    'watcher_reload_seconds', 'Фоновая пересборка изменённого файла')
+PENDING = metrics.gauge(
+    'watcher_pending', 'Изменённые файлы, ожидающие пересборки')
+
+WATCHER_BACKENDS = ('auto', 'inotify', 'poll')
+
+# события inotify: запись и переименование файлов каталога
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+# очередь событий ядра переполнена, часть событий потеряна
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | \
+    IN_CREATE | IN_DELETE
+# struct inotify_event без имени: wd, mask, cookie, len
+INOTIFY_EVENT = struct.Struct('iIII')
+
+
+def itinerary_identity(itinerary: Itinerary) -> str:
+    """
+    Идентификатор варианта перелёта: рейсы и время вылета обоих плеч
+
+    :param
+        * *itinerary* (``Itinerary``) -- вариант перелёта
+
+    :rtype: (``str``)
+    :return: идентификатор вида 'SU123 DXB-SVO 2018-10-27T0005 | ...'
+    """
+    legs = [itinerary.onward]
+    if itinerary.returns is not None:
+        legs.append(itinerary.returns)
+    return ' | '.join(
+        ' '.join(f'{x.carrier_id}{x.flight_number} {x.source}-'
+                 f'{x.destination} {x.departure}' for x in leg)
+        for leg in legs)
+
+
+def itinerary_digest(itinerary: Itinerary) -> bytes:
+    """
+    Отпечаток всех данных варианта перелёта, включая стоимость. Не зависит
+    от процесса, в котором посчитан
+
+    :param
+        * *itinerary* (``Itinerary``) -- вариант перелёта
+
+    :rtype: (``bytes``)
+    :return: 8 байт blake2b
+    """
+    pricing = itinerary.pricing
+    state = (tuple(x.key() for x in itinerary.onward),
+             tuple(x.key() for x in itinerary.returns or ()),
+             (pricing.currency, pricing.charges) if pricing else None)
+    return hashlib.blake2b(repr(state).encode(), digest_size=8).digest()
+
+
+def index_itineraries(file_path: str) -> Dict[str, bytes]:
+    """
+    Синхронное построение отпечатков вариантов перелёта файла. Модель
+    берётся из общего кэша, иначе из снимка или парсингом. Повторяющиеся
+    идентификаторы нумеруются по порядку появления
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+
+    :rtype: (``Dict[str, bytes]``)
+    :return: отпечатки по идентификатору варианта перелёта
+    """
+    itineraries = parsed_cache.get(parsed_cache.key(file_path, 'models'))
+    if itineraries is None:
+        itineraries = load_models(file_path)
+    index = dict()
+    for itinerary in itineraries:
+        identity = itinerary_identity(itinerary)
+        if identity in index:
+            num = 2
+            while f'{identity} #{num}' in index:
+                num += 1
+            identity = f'{identity} #{num}'
+        index[identity] = itinerary_digest(itinerary)
+    return index
+
+
+def compare_indexes(index: Dict[str, bytes],
+                    new_index: Dict[str, bytes]) -> dict:
+    """
+    Добавленные, удалённые и изменённые варианты перелёта между двумя
+    версиями файла
+
+    :param
+        * *index* (``Dict[str, bytes]``) -- отпечатки прежней версии
+    :param
+        * *new_index* (``Dict[str, bytes]``) -- отпечатки новой версии
+
+    :rtype: (``dict``)
+    :return: идентификаторы вариантов перелёта по виду изменения
+    """
+    return {
+        'added': [x for x in new_index if x not in index],
+        'removed': [x for x in index if x not in new_index],
+        'changed': [k for k, v in new_index.items()
+                    if k in index and index[k] != v]
+    }
+
+
+class _Inotify:
+    # события каталога через inotify libc, без сторонних пакетов
+
+    def __init__(self, directory: str):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(directory),
+                                  INOTIFY_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, f'inotify_add_watch failed {directory}')
+
+    def read(self) -> Tuple[List[str], bool]:
+        # имена файлов событий и признак переполнения очереди
+        names = list()
+        overflow = False
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return names, overflow
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+            if name:
+                names.append(os.fsdecode(name))
+        return names, overflow
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DataWatcher:
+    """
+    Наблюдение за xml файлами каталога данных: через inotify, где он есть,
+    иначе опросом размера и mtime.
+
+    Изменённый файл сразу помечается в кэше как пересобираемый, и запросы
+    продолжают получать его прежнюю версию. После settle секунд без новых
+    изменений в фоне заново парсятся только те типы парсинга этого файла,
+    которые уже запрашивались, плюс хранилище вариантов перелёта. Новые
+    версии подменяют прежние одновременно, недостроенные структуры запросам
+    не видны. Ошибка парсинга (например, файл ещё дописывается) оставляет
+    прежнюю версию до следующего изменения. По каждой пересборке
+    запоминаются добавленные, удалённые и изменённые варианты перелёта
+    """
+
+    def __init__(self, enabled: bool = True, backend: str = 'auto',
+                 interval: float = 1.0, settle: float = 0.5,
+                 history: int = 100, max_items: int = 100,
+                 directory: str = DATA_DIR):
+        self.enabled = enabled
+        self.backend = backend
+        self.interval = interval
+        self.settle = settle
+        self.max_items = max_items
+        self.directory = directory
+        self.changes = deque(maxlen=history)
+        self.reloads = 0
+        self.errors = 0
+        self._files = dict()
+        self._indexes = dict()
+        self._timers = dict()
+        self._tasks = dict()
+        self._dirty = set()
+        self._inotify = None
+        self._poller = None
+        self._baseline = None
+
+    def configure(self, enabled: bool = None, backend: str = None,
+                  interval: float = None, settle: float = None,
+                  history: int = None, max_items: int = None, **kwargs):
+        """
+        Перенастройка наблюдения из конфига приложения
+
+        :param
+            * *enabled* (``bool``) -- наблюдение за каталогом данных
+        :param
+            * *backend* (``str``) -- auto, inotify или poll
+        :param
+            * *interval* (``float``) -- период опроса, секунды
+        :param
+            * *settle* (``float``) -- пауза после последнего изменения
+            файла перед пересборкой, секунды
+        :param
+            * *history* (``int``) -- количество запоминаемых пересборок
+        :param
+            * *max_items* (``int``) -- максимум идентификаторов вариантов
+            перелёта каждого вида в записи о пересборке
+
+        :rtype: (``None``)
+        :return:
+        """
+        if backend is not None and backend not in WATCHER_BACKENDS:
+            raise ValueError(
+                f'watcher backend must be one of {WATCHER_BACKENDS}')
+        if enabled is not None:
+            self.enabled = bool(enabled)
+        self.backend = backend or self.backend
+        if interval is not None:
+            self.interval = float(interval)
+        if settle is not None:
+            self.settle = float(settle)
+        if history is not None:
+            self.changes = deque(self.changes, maxlen=int(history))
+        if max_items is not None:
+            self.max_items = int(max_items)
+
+    def scan(self) -> Dict[str, tuple]:
+        """
+        Отпечатки xml файлов каталога данных
+
+        :rtype: (``Dict[str, tuple]``)
+        :return: (размер, mtime_ns) по пути к файлу
+        """
+        files = dict()
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.name.endswith('.xml') and entry.is_file():
+                    stat = entry.stat()
+                    files[os.path.realpath(entry.path)] = \
+                        (stat.st_size, stat.st_mtime_ns)
+        return files
+
+    async def start(self):
+        """
+        Запуск наблюдения и фонового построения отпечатков текущих версий
+        файлов, с которыми будут сравниваться новые
+
+        :rtype: (``None``)
+        :return:
+        """
+        if not self.enabled:
+            return
+        loop = asyncio.get_event_loop()
+        self._files = self.scan()
+        if self.backend in ('auto', 'inotify'):
+            try:
+                self._inotify = _Inotify(self.directory)
+                loop.add_reader(self._inotify.fd, self._read_events)
+            except (AttributeError, OSError) as e:
+                if self.backend == 'inotify':
+                    raise
+                log.info(f'WATCHER inotify unavailable: {e!r}')
+                self._inotify = None
+        if self._inotify is None:
+            self._poller = asyncio.ensure_future(self._poll())
+        self._baseline = asyncio.ensure_future(
+            self._index_all(list(self._files)))
+        log.info(f'WATCHER {"inotify" if self._inotify else "poll"} '
+                 f'{self.directory}')
+
+    async def stop(self):
+        """
+        Остановка наблюдения и фоновых пересборок
+
+        :rtype: (``None``)
+        :return:
+        """
+        if self._inotify is not None:
+            asyncio.get_event_loop().remove_reader(self._inotify.fd)
+            self._inotify.close()
+            self._inotify = None
+        for timer in self._timers.values():
+            timer.cancel()
+        file_paths = set(self._timers) | set(self._tasks)
+        tasks = [x for x in (self._poller, self._baseline) if x is not None]
+        tasks += list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for file_path in file_paths:
+            end_refresh(file_path)
+        self._timers.clear()
+        self._tasks.clear()
+        self._poller = self._baseline = None
+
+    def _read_events(self):
+        names, overflow = self._inotify.read()
+        if overflow:
+            # события потеряны: изменения находятся сравнением полного
+            # обхода каталога с известными отпечатками
+            log.warning('WATCHER inotify queue overflow, rescanning')
+            self._rescan()
+            return
+        for name in set(names):
+            if not name.endswith('.xml'):
+                continue
+            file_path = os.path.realpath(os.path.join(self.directory, name))
+            try:
+                stat = os.stat(file_path)
+                fingerprint = (stat.st_size, stat.st_mtime_ns)
+            except FileNotFoundError:
+                fingerprint = None
+            if self._files.get(file_path) != fingerprint:
+                self._touched(file_path, fingerprint)
+
+    async def _poll(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self._rescan()
+
+    def _rescan(self):
+        # изменённые, новые и удалённые файлы по полному обходу каталога
+        try:
+            files = self.scan()
+        except OSError as e:
+            log.warning(f'WATCHER scan failed: {e!r}')
+            return
+        for file_path in set(files) | set(self._files):
+            fingerprint = files.get(file_path)
+            if self._files.get(file_path) != fingerprint:
+                self._touched(file_path, fingerprint)
+
+    def _touched(self, file_path: str, fingerprint: Optional[tuple]):
+        # изменение файла: прежняя версия отдаётся до окончания пересборки,
+        # пересборка откладывается до паузы в изменениях
+        if fingerprint is None:
+            self._files.pop(file_path, None)
+        else:
+            self._files[file_path] = fingerprint
+        begin_refresh(file_path)
+        timer = self._timers.pop(file_path, None)
+        if timer is not None:
+            timer.cancel()
+        # опрос замечает изменения раз в interval: пауза отсчитывается от
+        # последнего опроса, на котором файл ещё менялся
+        delay = self.settle if self._inotify else self.settle + self.interval
+        self._timers[file_path] = asyncio.get_event_loop().call_later(
+            delay, self._schedule, file_path)
+        PENDING.set(len(self._timers))
+
+    def _schedule(self, file_path: str):
+        self._timers.pop(file_path, None)
+        PENDING.set(len(self._timers))
+        if file_path in self._tasks:
+            # файл изменился во время пересборки: повторить после неё
+            self._dirty.add(file_path)
+            return
+        self._tasks[file_path] = asyncio.ensure_future(
+            self._reload(file_path))
+
+    async def _reload(self, file_path: str):
+        start = time.time()
+        try:
+            if not os.path.exists(file_path):
+                parsed_cache.invalidate(file_path)
+                response_cache.invalidate(file_path)
+                self._record(file_path, self._indexes.pop(file_path, None),
+                             {}, start)
+                RELOADS.inc(result='removed')
+                return
+
+            register_loader(file_path, 'store', load_store)
+            kinds = await refresh_cached(file_path)
+            if kinds is None:
+                # файл изменился во время парсинга, его ждёт новая пересборка
+                self._dirty.add(file_path)
+                return
+            end_refresh(file_path)
+            # ответы прежней версии больше не нужны
+            response_cache.invalidate(file_path)
+            new_index = await parse_executor.run(index_itineraries,
+                                                 file_path)
+            index = self._indexes.get(file_path)
+            self._indexes[file_path] = new_index
+            self._record(file_path, index, new_index, start, kinds)
+            RELOADS.inc(result='ok')
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # прежняя версия остаётся в работе до следующего изменения
+            self.errors += 1
+            end_refresh(file_path, refreshed=False)
+            RELOADS.inc(result='failed')
+            log.warning(f'WATCHER RELOAD FAILED {file_path}: {e!r}')
+        finally:
+            self._tasks.pop(file_path, None)
+            if file_path in self._dirty:
+                self._dirty.discard(file_path)
+                self._touched(file_path, self._files.get(file_path))
+            elif file_path not in self._timers and \
+                    not os.path.exists(file_path):
+                end_refresh(file_path)
+
+    def _record(self, file_path: str, index: Optional[dict],
+                new_index: dict, start: float, kinds: list = ()):
+        elapsed = time.time() - start
+        RELOAD_SECONDS.observe(elapsed)
+        self.reloads += 1
+        record = {
+            'file': os.path.basename(file_path),
+            'time': datetime.now().isoformat(timespec='seconds'),
+            'seconds': round(elapsed, 3),
+            'kinds': [str(x) for x in kinds],
+            'itineraries': len(new_index)
+        }
+        if index is None:
+            # прежняя версия файла неизвестна: файл новый или изменился до
+            # построения отпечатков
+            record['baseline'] = False
+        else:
+            for name, items in compare_indexes(index, new_index).items():
+                record[name] = len(items)
+                record[f'{name}_itineraries'] = items[:self.max_items]
+        self.changes.append(record)
+        log.info(f'WATCHER RELOADED {record["file"]} {elapsed} sec | '
+                 f'{record.get("added")} added, '
+                 f'{record.get("removed")} removed, '
+                 f'{record.get("changed")} changed')
+
+    async def _index_all(self, file_paths: List[str]):
+        # отпечатки текущих версий по одному файлу, чтобы не занимать пул
+        for file_path in file_paths:
+            if file_path in self._indexes or file_path in self._timers or \
+                    file_path in self._tasks:
+                continue
+            try:
+                self._indexes[file_path] = await parse_executor.run(
+                    index_itineraries, file_path)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                log.warning(f'WATCHER INDEX FAILED {file_path}: {e!r}')
+
+    def stats(self) -> dict:
+        """
+        Состояние наблюдения
+
+        :rtype: (``dict``)
+        :return: способ наблюдения, файлы, ожидающие и идущие пересборки
+        """
+        if self._inotify is not None:
+            backend = 'inotify'
+        elif self._poller is not None:
+            backend = 'poll'
+        else:
+            backend = None
+        return {
+            'enabled': self.enabled,
+            'backend': backend,
+            'files': len(self._files),
+            'pending': len(self._timers),
+            'reloading': len(self._tasks),
+            'reloads': self.reloads,
+            'errors': self.errors
+        }
+
+
+watcher = DataWatcher()
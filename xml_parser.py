@@ -1,30 +1,269 @@
 # -*- coding: utf-8 -*-
-import asyncio
 import xml.etree.ElementTree as ET
+import asyncio
 import os
+import re
 import time
-from collections import defaultdict
+from collections import Counter, defaultdict, deque
+from typing import AsyncIterator, Iterable, Iterator, List, Optional, \
+    Sequence
 import logging
+from coalescing import coalesce
+from executor import ParseExecutor, check_cancelled, diff_executor, \
+    parse_executor
+from itinerary_model import InvalidItinerary, Itinerary, StringTable
+from metrics import observe_stage
+from parse_cache import parsed_cache
+from snapshot import snapshots
 
 log = logging.getLogger(__name__)
 
+DATA_DIR = os.path.dirname(os.path.realpath(__file__)) + '/data'
+FILENAMES = {
+    '1': 'RS_Via-3.xml',
+    '2': 'RS_ViaOW.xml'
+}
+# ответы партнёра, загруженные через POST /v1/responses
+RESPONSES_DIR = f'{DATA_DIR}/responses'
+RESPONSE_ID = re.compile(r'^[0-9a-f]{64}$')
+# способы парсинга файлов для фоновой пересборки: (путь, тип парсера) ->
+# (функция, аргументы, пул)
+_loaders = dict()
+# попытки построить разборы одной версии постоянно меняющегося файла
+MAX_LOAD_ATTEMPTS = 3
+# идущие фоновые пересборки файлов: путь -> событие окончания попытки
+_refreshes = dict()
+
+
+def get_response_path(response_id: str) -> Optional[str]:
+    """
+    Путь к загруженному ответу партнёра по его идентификатору
+
+    :param
+        * *response_id* (``str``) -- sha256 содержимого ответа
 
-async def get_etree_to_dict(loop, elem: ET.Element) -> dict:
+    :rtype: (``str``)
+    :return: путь к файлу, либо None для неизвестного идентификатора
     """
-    Обертка для заворачивания синхронной функции etree_to_dict в асинхронную
+    if not response_id or not RESPONSE_ID.match(response_id):
+        return None
+    file_path = f'{RESPONSES_DIR}/{response_id}.xml'
+    return file_path if os.path.isfile(file_path) else None
+
+
+def get_file_key_path(file_key: str) -> Optional[str]:
+    """
+    Путь к файлу по ключу: ключ встроенного файла из FILENAMES, либо
+    идентификатор загруженного ответа
 
     :param
-        * *loop* (``<class 'asyncio'>``) -- текущий event loop
+        * *file_key* (``str``) -- ключ файла
+
+    :rtype: (``str``)
+    :return: путь к файлу, либо None для неизвестного ключа
+    """
+    if file_key in FILENAMES:
+        return f'{DATA_DIR}/{FILENAMES[file_key]}'
+    return get_response_path(file_key)
+
+
+def get_file_path(need_return: str,
+                  response_id: str = None) -> Optional[str]:
+    """
+    Путь к файлу ответа партнёра: загруженный ответ по идентификатору,
+    либо встроенный файл по признаку наличия обратного маршрута
+
     :param
-        * *elem* (``<class 'xml.etree.ElementTree.Element'>``) -- элемент
-        иерархии
+        * *need_return* (``str``) -- наличие обратного маршрута
+    :param
+        * *response_id* (``str``) -- идентификатор загруженного ответа
+
+    :rtype: (``str``)
+    :return: путь к файлу, либо None для неизвестного значения
+    """
+    if response_id:
+        return get_response_path(response_id)
+    if need_return in ['true', 'True', 'TRUE']:
+        filename = FILENAMES.get('1')
+    elif need_return in ['false', 'False', 'FALSE']:
+        filename = FILENAMES.get('2')
+    else:
+        return None
+    return f'{DATA_DIR}/{filename}'
+
+
+async def load_cached(file_path: str, kind, loader, *args,
+                      executor: ParseExecutor = parse_executor):
+    """
+    Получение результата парсинга файла из кэша. При промахе файл целиком
+    парсится в выделенном пуле, не блокируя event loop. Пока изменённый
+    файл пересобирается в фоне, отдаётся его прежняя версия
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+    :param
+        * *kind* (``hashable``) -- тип парсера
+    :param
+        * *loader* (``callable``) -- синхронная функция парсинга
+        loader(file_path, *args)
+    :param
+        * *executor* (``ParseExecutor``) -- пул для парсинга
+
+    :return: результат парсинга
+    """
+    values = await load_cached_set(file_path,
+                                   {kind: (loader, args, executor)})
+    return values[kind]
+
+
+async def load_cached_set(file_path: str, loaders: dict) -> dict:
+    """
+    Несколько разборов файла, гарантированно построенных по одной его
+    версии. Пока файл пересобирается в фоне, отдаются прежние версии
+    разборов, если они есть для всех типов, иначе ожидается публикация
+    новых версий
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+    :param
+        * *loaders* (``dict``) -- тип парсера -> (синхронная функция
+        парсинга loader(file_path, *args), аргументы, пул)
 
     :rtype: (``dict``)
-    :return: данные текущего узла иерархии завернутые в словарь
+    :return: результаты парсинга по типу парсера
+    """
+    attempts = 0
+    while True:
+        attempts += 1
+        fingerprint = parsed_cache.fingerprint(file_path)
+        path = fingerprint[0]
+        values = dict()
+        for kind, loader in loaders.items():
+            _loaders[(path, kind)] = loader
+            value = parsed_cache.get(fingerprint + (kind, ))
+            if value is not None:
+                values[kind] = value
+        if len(values) == len(loaders):
+            return values
+
+        if path in _refreshes:
+            previous = [parsed_cache.previous(fingerprint + (x, ))
+                        for x in loaders]
+            if all(previous) and len({x[0][:3] for x in previous}) == 1:
+                return {x[0][3]: x[1] for x in previous}
+            # прежних версий нет для всех типов: ждать новые версии всех
+            # разборов файла, чтобы не смешать их с прежними
+            await _refreshes[path].wait()
+            continue
+
+        for kind, (loader, args, executor) in loaders.items():
+            if kind not in values:
+                values[kind] = await executor.run(loader, path, *args)
+        # файл не менялся во время парсинга: все разборы одной версии
+        if parsed_cache.fingerprint(path) == fingerprint:
+            for kind, value in values.items():
+                parsed_cache.put(fingerprint + (kind, ), value)
+            return values
+        if len(loaders) == 1 or attempts >= MAX_LOAD_ATTEMPTS:
+            # файл постоянно переписывается: результат без кэширования
+            return values
+
+
+def register_loader(file_path: str, kind, loader, *args,
+                    executor: ParseExecutor = parse_executor):
     """
-    future = loop.run_in_executor(None, etree_to_dict, elem)
-    response = await future
-    return response
+    Запоминание способа парсинга файла для фоновой пересборки при его
+    изменении
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+    :param
+        * *kind* (``hashable``) -- тип парсера
+    :param
+        * *loader* (``callable``) -- синхронная функция парсинга
+        loader(file_path, *args)
+    :param
+        * *executor* (``ParseExecutor``) -- пул для парсинга
+
+    :rtype: (``None``)
+    :return:
+    """
+    _loaders[(os.path.realpath(file_path), kind)] = (loader, args, executor)
+
+
+async def refresh_cached(file_path: str) -> Optional[list]:
+    """
+    Пересборка всех типов парсинга файла, которые запрашивались с помощью
+    load_cached, по очереди в их пулах. Вложенные get_or_parse потоковых
+    пулов (модель для хранилища и индекса маршрутов) пишут в общий
+    черновик, а не в кэш. Новые версии, включая модель, заменяют прежние
+    в кэше все сразу, без переключения задач event loop, поэтому запросы
+    видят либо прежние, либо новые версии целиком
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+
+    :rtype: (``list``)
+    :return: пересобранные типы парсера, либо None - файл изменился во
+    время пересборки
+    """
+    path = os.path.realpath(file_path)
+    fingerprint = parsed_cache.fingerprint(path)
+    staging = dict()
+    for (loader_path, kind), (loader, args, executor) in list(
+            _loaders.items()):
+        key = fingerprint + (kind, )
+        if loader_path != path or key in staging:
+            continue
+        if executor.kind == 'process':
+            # кэш процесса пула и так не виден приложению
+            staging[key] = await executor.run(loader, path, *args)
+        else:
+            staging[key] = await executor.run(
+                parsed_cache.staged, staging, loader, path, *args)
+    if parsed_cache.fingerprint(path) != fingerprint:
+        return None
+    for key, value in staging.items():
+        parsed_cache.put(key, value)
+    return [key[3] for key in staging]
+
+
+def begin_refresh(file_path: str):
+    """
+    Начало фоновой пересборки файла: запросы получают прежние версии его
+    разборов, а разборы без прежней версии ждут end_refresh
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+
+    :rtype: (``None``)
+    :return:
+    """
+    path = os.path.realpath(file_path)
+    parsed_cache.begin_refresh(path)
+    if path not in _refreshes:
+        _refreshes[path] = asyncio.Event()
+
+
+def end_refresh(file_path: str, refreshed: bool = True):
+    """
+    Окончание попытки фоновой пересборки файла
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+    :param
+        * *refreshed* (``bool``) -- новые версии опубликованы, иначе
+        запросы продолжают получать прежние
+
+    :rtype: (``None``)
+    :return:
+    """
+    path = os.path.realpath(file_path)
+    if refreshed:
+        parsed_cache.end_refresh(path)
+    event = _refreshes.pop(path, None)
+    if event is not None:
+        event.set()
 
 
 def etree_to_dict(elem: ET.Element) -> dict:
@@ -38,224 +277,704 @@ def etree_to_dict(elem: ET.Element) -> dict:
     :rtype: (``dict``)
     :return: все данные текущего узла иерархии завернутые в словарь
     """
-    elem_dict = {elem.tag: {} if elem.attrib else None}
-    children = list(elem)
-    if children:
-        children_dict = defaultdict(list)
-        for dc in map(etree_to_dict, children):
-            for k, v in dc.items():
-                children_dict[k].append(v)
+    return extract(elem)
+
+
+def build_schema(fields: Iterable[str]) -> dict:
+    """
+    Построение схемы выборки из списка путей к нужным полям относительно
+    элемента, например 'OnwardPricedItinerary/Flights/Flight/Source'.
+    Лист схемы True означает, что узел нужен целиком
 
-        elem_dict = {elem.tag: {k: v[0] if len(v) == 1 else v
-                                for k, v in children_dict.items()}}
+    :param
+        * *fields* (``Iterable[str]``) -- пути к нужным полям
+
+    :rtype: (``dict``)
+    :return: вложенная схема выборки
+    """
+    schema = dict()
+    for field in fields:
+        node = schema
+        tags = [tag for tag in field.split('/') if tag]
+        for tag in tags[:-1]:
+            child = node.get(tag)
+            if child is True:
+                break
+            node = node.setdefault(tag, dict())
+        else:
+            if tags:
+                node[tags[-1]] = True
+    return schema
+
+
+def extract(elem: ET.Element, schema: dict = None) -> dict:
+    """
+    Итеративная конвертация элемента в словарь с выборкой только нужных
+    полей. Узлы, отсутствующие в схеме, пропускаются без конвертации.
+    Без схемы результат совпадает с полной конвертацией узла
+
+    :param
+        * *elem* (``<class 'xml.etree.ElementTree.Element'>``) - элемент
+        иерархии
+    :param
+        * *schema* (``dict``) -- схема выборки из build_schema
+
+    :rtype: (``dict``)
+    :return: выбранные данные узла иерархии завернутые в словарь
+    """
+    result = dict()
+    # кадр: элемент, схема узла, итератор по детям, собранные дети
+    stack = [(elem, True if schema is None else schema, iter(elem),
+              defaultdict(list))]
+    while stack:
+        node, node_schema, children, collected = stack[-1]
+        for child in children:
+            if node_schema is True:
+                child_schema = True
+            else:
+                child_schema = node_schema.get(child.tag)
+                if child_schema is None:
+                    continue
+            stack.append((child, child_schema, iter(child),
+                          defaultdict(list)))
+            break
+        else:
+            stack.pop()
+            value = _node_value(node, collected)
+            if stack:
+                stack[-1][3][node.tag].append(value)
+            else:
+                result[node.tag] = value
+    return result
+
+
+def _node_value(elem: ET.Element, collected: dict):
+    has_children = len(elem) > 0
+    if has_children:
+        value = {k: v[0] if len(v) == 1 else v for k, v in collected.items()}
+    else:
+        value = {} if elem.attrib else None
     if elem.attrib:
-        elem_dict[elem.tag].update((k, v)
-                                   for k, v in elem.attrib.items())
+        value.update(elem.attrib)
     if elem.text:
         text = elem.text.strip()
-        if children or elem.attrib:
+        if has_children or elem.attrib:
             if text:
-                elem_dict[elem.tag]['text'] = text
+                value['text'] = text
         else:
-            elem_dict[elem.tag] = text
-    return elem_dict
+            value = text
+    return value
 
 
-async def parse_xml_to_dict(**kwargs) -> dict:
+class ItinerarySplitter:
+    """
+    Выделение вариантов перелёта из потока событий start/end. Блок Flights
+    верхнего уровня (PricedItineraries/Flights) отличается от вложенных
+    Flights глубиной, а не набором дочерних тегов. После того как
+    потребитель забрал элемент, он удаляется из родителя, поэтому в памяти
+    одновременно держится только один вариант перелёта. Состояние
+    сохраняется между порциями событий инкрементального парсера. В потоке
+    пула обход прерывается после отмены задачи
+    """
+    # AirFareSearchResponse/PricedItineraries/Flights
+    itinerary_depth = 3
+
+    def __init__(self):
+        self._stack = []
+
+    def elements(self, events: Iterable[tuple]) -> Iterator[ET.Element]:
+        """
+        Элементы Flights верхнего уровня из порции событий
+
+        :param
+            * *events* (``Iterable[tuple]``) -- события (event, elem)
+
+        :rtype: (``Iterator[ET.Element]``)
+        :return: элементы Flights верхнего уровня
+        """
+        stack = self._stack
+        depth = self.itinerary_depth
+        for event, elem in events:
+            if event == 'start':
+                stack.append(elem)
+                continue
+
+            stack.pop()
+            if len(stack) == depth - 1 and \
+                    stack[-1].tag == 'PricedItineraries':
+                check_cancelled()
+                yield elem
+                stack[-1].remove(elem)
+            elif len(stack) < depth - 1:
+                # служебные блоки верхнего уровня (RequestId и т.п.)
+                elem.clear()
+
+
+def iter_itinerary_elements(source) -> Iterator[ET.Element]:
     """
-    Парсинг данных по полётам xml файла в словарь
+    Потоковый обход вариантов перелёта xml файла на событиях start/end
+    iterparse
 
-    :param kwargs:
-         * *need_return* (``str``) -- наличие обратного маршрута
+    :param
+        * *source* (``str or file``) -- путь к файлу или файловый объект
 
-    :rtype: (``dict``)
-    :return: данные о полётах
+    :rtype: (``Iterator[ET.Element]``)
+    :return: элементы Flights верхнего уровня
     """
-    filenames = {
-        '1': 'RS_Via-3.xml',
-        '2': 'RS_ViaOW.xml'
-    }
-    need_return = kwargs.get('need_return')
-    columns = ['OnwardPricedItinerary', 'Pricing']
-    if need_return in ['true', 'True', 'TRUE']:
-        filename = filenames.get('1')
-    elif need_return in ['false', 'False', 'FALSE']:
-        filename = filenames.get('2')
-        columns.append('ReturnPricedItinerary',)
-    else:
-        return {'error': 'Required need_return'}
+    return ItinerarySplitter().elements(
+        ET.iterparse(source, events=('start', 'end')))
 
-    dir_path = os.path.dirname(os.path.realpath(__file__)) + '/data'
-    file_path = open(f'{dir_path}/{filename}', "rb")
 
-    log.info(f'FILE {filename}')
+def build_models(elements: Iterable[ET.Element], strings,
+                 strict: bool = False) -> Iterator[Itinerary]:
+    """
+    Модели вариантов перелёта из элементов Flights верхнего уровня.
+    Варианты без билетов в одном из направлений пропускаются, в строгом
+    режиме - InvalidItinerary
 
-    tree = ET.parse(file_path)
-    root = tree.getroot()
+    :param
+        * *elements* (``Iterable[ET.Element]``) -- элементы Flights
+    :param
+        * *strings* (``callable``) -- таблица строк ответа
+    :param
+        * *strict* (``bool``) -- ошибка вместо пропуска варианта
 
-    data = dict()
-    info = dict()
-    count = 0
-    check_keys = set(columns)
+    :rtype: (``Iterator[Itinerary]``)
+    :return: варианты перелёта
+    """
+    for num, elem in enumerate(elements):
+        try:
+            yield Itinerary.from_element(elem, strings)
+        except InvalidItinerary as e:
+            if strict:
+                raise InvalidItinerary(f'itinerary {num + 1}: {e}')
+            log.warning(f'ITINERARY {num + 1} SKIPPED: {e}')
 
-    start = time.time()
 
-    for elem in root.iter('Flights'):
+class IncrementalParser:
+    """
+    Парсинг вариантов перелёта в компактную модель по мере поступления
+    данных: порции xml передаются в XMLPullParser, готовые варианты
+    перелёта забираются сразу после закрытия их тега. Вариант без билетов
+    в одном из направлений - InvalidItinerary
+    """
 
-        # обработка оснвного блока Flights верхнего уровня
-        if elem.tag == 'Flights':
-            # прикручена логика проверок, т.к есть дубликат имен Flights в xml
-            checker = [x.tag for x in list(elem)]
-            is_check = set(checker) & check_keys
-            if is_check:
-                current_count = count
-                info[count] = {elem.tag: {}}
-                count += 1
+    def __init__(self):
+        self._parser = ET.XMLPullParser(events=('start', 'end'))
+        self._splitter = ItinerarySplitter()
+        self._strings = StringTable()
+        self.itineraries = []
+
+    def feed(self, chunk: bytes):
+        """
+        Очередная порция xml
+
+        :param
+            * *chunk* (``bytes``) -- данные
+
+        :rtype: (``None``)
+        :return:
+        """
+        self._parser.feed(chunk)
+        self._collect()
+
+    def close(self) -> List[Itinerary]:
+        """
+        Завершение парсинга. Незакрытые теги - ET.ParseError
+
+        :rtype: (``List[Itinerary]``)
+        :return: варианты перелёта
+        """
+        self._parser.close()
+        self._collect()
+        return self.itineraries
+
+    def _collect(self):
+        elements = self._splitter.elements(self._parser.read_events())
+        for elem in elements:
+            try:
+                itinerary = Itinerary.from_element(elem, self._strings)
+            except InvalidItinerary as e:
+                raise InvalidItinerary(
+                    f'itinerary {len(self.itineraries) + 1}: {e}')
+            self.itineraries.append(itinerary)
+
+
+def iter_itineraries(source, schema: dict = None) -> Iterator[dict]:
+    """
+    Генератор вариантов перелёта xml файла в виде словарей, по одному за раз
 
-                elem_dict = etree_to_dict(elem)
-                data[current_count] = elem_dict.get('Flights', {})
+    :param
+        * *source* (``str or file``) -- путь к файлу или файловый объект
+    :param
+        * *schema* (``dict``) -- схема выборки полей варианта перелёта
 
-        elem.clear()
-    root.clear()
-    log.info(f'PARSING DATA  {time.time() - start} sec')
-    return data
+    :rtype: (``Iterator[dict]``)
+    :return: данные варианта перелёта
+    """
+    for elem in iter_itinerary_elements(source):
+        yield extract(elem, schema).get('Flights', {})
 
 
+async def parse_xml_to_dict(**kwargs) -> AsyncIterator[tuple]:
+    """
+    Потоковый парсинг данных по полётам xml файла: варианты перелёта
+    отдаются по одному, в памяти держится только пакет вариантов. Пакеты
+    парсятся в пуле парсинга, event loop не блокируется. Неизвестный
+    файл - KeyError
+
+    :param kwargs:
+         * *need_return* (``str``) -- наличие обратного маршрута
+         * *response_id* (``str``) -- идентификатор загруженного ответа
+         * *fields* (``Iterable[str]``) -- пути к нужным полям варианта
+         перелёта, по умолчанию все поля
+
+    :rtype: (``AsyncIterator[tuple]``)
+    :return: пары (номер варианта, данные варианта)
+    """
+    file_path = get_file_path(kwargs.get('need_return'),
+                              kwargs.get('response_id'))
+    if not file_path:
+        raise KeyError('Required need_return')
+
+    fields = kwargs.get('fields')
+    schema = build_schema(fields) if fields else None
+
+    log.info(f'FILE {os.path.basename(file_path)}')
+
+    count = 0
+    start = time.time()
+    with open(file_path, "rb") as f:
+        itineraries = enumerate(iter_itineraries(f, schema))
+        async for batch in parse_executor.iterate(itineraries):
+            count += len(batch)
+            for item in batch:
+                yield item
+
+    elapsed = observe_stage('parse', start, count)
+    log.info(f'PARSING DATA  {elapsed} sec')
+
+
+@coalesce('parse_xml')
 async def parse_xml(**kwargs) -> dict:
     """
-    Парсинг тегов и атрибутов xml файла в словарь
+    Парсинг тегов и атрибутов xml файла в словарь. Результат кэшируется до
+    изменения файла
 
     :param kwargs:
         * *need_return* (``str``) -- наличие обратного маршрута
+        * *response_id* (``str``) -- идентификатор загруженного ответа
 
     :rtype: (``dict``)
     :return: теги и атрибуты xml файла
     """
-    filenames = {
-        '1': 'RS_Via-3.xml',
-        '2': 'RS_ViaOW.xml'
-    }
-    need_return = kwargs.get('need_return')
-    if need_return in ['true', 'True', 'TRUE']:
-        filename = filenames.get('1')
-    elif need_return in ['false', 'False', 'FALSE']:
-        filename = filenames.get('2')
-    else:
+    file_path = get_file_path(kwargs.get('need_return'),
+                              kwargs.get('response_id'))
+    if not file_path:
         return {'error': 'Required need_return'}
 
-    dir_path = os.path.dirname(os.path.realpath(__file__)) + '/data'
-    file_path = open(f'{dir_path}/{filename}', "rb")
+    log.info(f'FILE {os.path.basename(file_path)}')
+
+    return await load_cached(file_path, 'tags', load_tags,
+                             executor=diff_executor)
 
-    log.info(f'FILE {filename}')
 
-    context = ET.iterparse(file_path, events=("start", ))
-    context = iter(context)
-    _, root = next(context)
-    _, request_info = next(context)
-    _, flight_info = next(context)
+def load_tags(file_path: str) -> dict:
+    """
+    Синхронный потоковый парсинг тегов и атрибутов xml файла. Атрибуты
+    хранятся как неизменяемые сигнатуры (тег, отсортированные пары
+    атрибутов) с количеством вхождений. Разобранные узлы сразу удаляются из
+    дерева, поэтому память ограничена количеством разных сигнатур, а не
+    размером файла. Корень и служебные узлы верхнего уровня (RequestId,
+    PricedItineraries) не учитываются
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+
+    :rtype: (``dict``)
+    :return: теги и атрибуты xml файла в виде
+    {
+        'tags': {тег, ...},
+        'attributes': Counter({(тег, ((атрибут, значение), ...)): количество})
+    }
+    """
+    header_depth = 2
+    tags = set()
+    attributes = Counter()
+    stack = []
 
     start = time.time()
 
-    data = dict(
-        tags=set(),
-        attributes=list()
-    )
-    for event, elem in context:
-        data['tags'].add(elem.tag)
-        if elem.attrib:
-            attributes = elem.attrib
-            attributes['tag'] = elem.tag
-            if attributes not in data['attributes']:
-                data['attributes'].append(attributes)
-        elem.clear()
-
-    log.info(f'PARSING DATA  {time.time() - start} sec')
-    return data
+    with open(file_path, "rb") as f:
+        for event, elem in ET.iterparse(f, events=('start', 'end')):
+            if event == 'start':
+                stack.append(elem)
+                if len(stack) > header_depth:
+                    tags.add(elem.tag)
+                    if elem.attrib:
+                        attributes[(elem.tag,
+                                    tuple(sorted(elem.attrib.items())))] += 1
+                continue
+
+            stack.pop()
+            if stack:
+                stack[-1].remove(elem)
+                if len(stack) == header_depth:
+                    check_cancelled()
+
+    elapsed = observe_stage('parse', start)
+    log.info(f'PARSING DATA  {elapsed} sec')
+    return dict(tags=tags, attributes=attributes)
+
+
+async def compare_tags(data_f1: dict, data_f2: dict) -> dict:
+    """
+    Симметричная разница тегов и атрибутов двух файлов в пуле парсинга,
+    event loop свободен на время сравнения
+
+    :param
+        * *data_f1* (``dict``) -- теги и атрибуты первого файла
+    :param
+        * *data_f2* (``dict``) -- теги и атрибуты второго файла
+
+    :rtype: (``dict``)
+    :return: результат сравнения в форме diff_tags
+    """
+    return await parse_executor.run(diff_tags, data_f1, data_f2)
 
 
-async def diff_parse_xml(file_key: str) -> dict:
+def diff_tags(data_f1: dict, data_f2: dict) -> dict:
     """
-    Парсинг данных тега OnwardPricedItinerary по полётам xml файла в словарь.
+    Синхронная симметричная разница тегов и атрибутов двух файлов.
+    Сравниваются данные, полученные из метода parse_xml, за линейное время
+    от количества разных сигнатур атрибутов
+
+    :param
+        * *data_f1* (``dict``) -- теги и атрибуты первого файла
+    :param
+        * *data_f2* (``dict``) -- теги и атрибуты второго файла
+
+    :rtype: (``dict``)
+    :return: результат сравнения, в виде
+    {
+        'tags': [...], - теги первого файла, которых нет во втором
+        'attributes': {тег: [{атрибут: значение}, ...]} - наборы атрибутов,
+        встречающиеся только в одном из файлов
+    }
+    """
+    start = time.time()
+    attributes_f1 = data_f1['attributes']
+    attributes_f2 = data_f2['attributes']
+    sym_diff = [x for x in attributes_f1 if x not in attributes_f2]
+    sym_diff.extend(x for x in attributes_f2 if x not in attributes_f1)
+
+    # визуальная эстетика
+    attrib = dict()
+    for tag, items in sym_diff:
+        attrib.setdefault(tag, []).append(dict(items))
+
+    compare = {
+        'tags': sorted(data_f1['tags'] - data_f2['tags']),
+        'attributes': attrib
+    }
+    observe_stage('diff', start)
+    return compare
+
+
+async def parse_itineraries(**kwargs) -> Sequence[Itinerary]:
+    """
+    Парсинг вариантов перелёта xml файла в компактную модель. Результат
+    кэшируется до изменения файла
+
+    :param kwargs:
+         * *need_return* (``str``) -- наличие обратного маршрута
+         * *response_id* (``str``) -- идентификатор загруженного ответа
+
+    :rtype: (``Sequence[Itinerary]``)
+    :return: варианты перелёта
+    """
+    file_path = get_file_path(kwargs.get('need_return'),
+                              kwargs.get('response_id'))
+    if not file_path:
+        return []
+
+    log.info(f'FILE {os.path.basename(file_path)}')
+
+    return await load_cached(file_path, 'models', load_models)
+
+
+def load_models(file_path: str) -> Sequence[Itinerary]:
+    """
+    Синхронная загрузка вариантов перелёта xml файла: из действительного
+    снимка, либо парсингом с сохранением снимка
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+
+    :rtype: (``Sequence[Itinerary]``)
+    :return: варианты перелёта
+    """
+    snapshot = snapshots.load(file_path)
+    if snapshot is not None:
+        return snapshot.itineraries
+
+    fingerprint = parsed_cache.fingerprint(file_path)
+    itineraries = parse_models(file_path)
+    snapshots.save(fingerprint, itineraries)
+    return itineraries
+
+
+def parse_models(file_path: str, strict: bool = False) -> List[Itinerary]:
+    """
+    Синхронный потоковый парсинг вариантов перелёта xml файла в компактную
+    модель. Повторяющиеся строки ответа хранятся в одном экземпляре
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+    :param
+        * *strict* (``bool``) -- вариант без билетов в одном из
+        направлений - InvalidItinerary вместо пропуска
+
+    :rtype: (``List[Itinerary]``)
+    :return: варианты перелёта
+    """
+    strings = StringTable()
+    start = time.time()
+
+    with open(file_path, "rb") as f:
+        itineraries = list(build_models(iter_itinerary_elements(f), strings,
+                                        strict))
+
+    elapsed = observe_stage('parse', start, len(itineraries))
+    log.info(f'PARSING DATA  {elapsed} sec | '
+             f'{len(itineraries)} itineraries, {len(strings)} strings')
+    return itineraries
+
+
+@coalesce('diff_parse_xml')
+async def diff_parse_xml(file_key: str, source: str) -> dict:
+    """
+    Группировка билетов тега OnwardPricedItinerary по полётам xml файла.
     За уникальность сделана привязка к отправной точке маршрута по ключу =
     '{ID перевозчика}-{номер рейса}' отправного билета
 
     :param:
          * *file_key* (``str``) -- ключ файла
+    :param:
+         * *source* (``str``) -- отправная точка маршрута
 
     :rtype: (``dict``)
-    :return: подготовленные данные о полётах тега OnwardPricedItinerary
+    :return: подготовленные данные о полётах тега OnwardPricedItinerary,
+    билет - Segment, либо tuple из Segment для перелёта с пересадками
     """
-    filenames = {
-        '1': 'RS_Via-3.xml',
-        '2': 'RS_ViaOW.xml'
-    }
-    filename = filenames.get(file_key)
-    source = 'DXB'
+    file_path = get_file_key_path(file_key)
+    if not file_path:
+        raise KeyError(f'Unknown file {file_key!r}')
 
-    dir_path = os.path.dirname(os.path.realpath(__file__)) + '/data'
-    file_path = open(f'{dir_path}/{filename}', "rb")
+    log.info(f'FILE {os.path.basename(file_path)}')
 
-    log.info(f'FILE {filename}')
+    return await load_cached(file_path, ('onward', source), load_onward,
+                             source, executor=diff_executor)
 
-    tree = ET.parse(file_path)
-    root = tree.getroot()
+
+def load_onward(file_path: str, source: str) -> dict:
+    """
+    Синхронная группировка билетов тега OnwardPricedItinerary по полётам
+    xml файла. Модель вариантов перелёта берётся из общего кэша
+
+    :param
+        * *file_path* (``str``) -- путь к файлу
+    :param
+        * *source* (``str``) -- отправная точка маршрута
+
+    :rtype: (``dict``)
+    :return: подготовленные данные о полётах тега OnwardPricedItinerary
+    """
+    itineraries = parsed_cache.get_or_parse(file_path, 'models', load_models)
 
     data = dict()
     start = time.time()
 
-    loop = asyncio.get_event_loop()
+    for key, tickets in iter_onward_tickets(itineraries, source):
+        if key not in data.keys():
+            data[key] = []
 
-    count = 0
-    key = ''
-    for elem in root.iter('OnwardPricedItinerary'):
+        data[key].append(tickets)
 
-        # elem_dict = etree_to_dict(elem)
-        elem_dict = await get_etree_to_dict(loop, elem)
+    elapsed = observe_stage('group', start, len(itineraries))
+    log.info(f'QTY of tickets {len(itineraries)} in TAG '
+             f'OnwardPricedItinerary | {os.path.basename(file_path)}')
+    log.info(f'PARSING DATA  {elapsed} sec')
+    return data
 
-        tickets = elem_dict['OnwardPricedItinerary']['Flights']['Flight']
-        onward_ticket = None
-        if isinstance(tickets, list):
 
-            onward_ticket = next((x for x in tickets if x.get('Source') ==
-                                  source), None)
-            for el in tickets:
-                carrier_info = el.pop('Carrier')
-                el.update(carrier_info)
+def iter_onward_tickets(itineraries: Iterable[Itinerary],
+                        source: str) -> Iterator[tuple]:
+    """
+    Билеты тега OnwardPricedItinerary с ключом полёта
+    '{ID перевозчика}-{номер рейса}' билета из отправной точки. Вариант без
+    такого билета получает ключ предыдущего варианта
 
-        else:
-            if tickets.get('Source') == source:
-                onward_ticket = tickets
+    :param
+        * *itineraries* (``Iterable[Itinerary]``) -- варианты перелёта
+    :param
+        * *source* (``str``) -- отправная точка маршрута
 
-                carrier_info = tickets.pop('Carrier')
-                tickets.update(carrier_info)
+    :rtype: (``Iterator[tuple]``)
+    :return: пары (ключ, билет - Segment или tuple из Segment)
+    """
+    key = ''
+    for itinerary in itineraries:
+        segments = itinerary.onward
+        tickets = segments if len(segments) > 1 else segments[0]
 
+        onward_ticket = next((x for x in segments if x.source == source),
+                             None)
         if onward_ticket:
-            carrier_id = onward_ticket.get('id')
-            flight_num = onward_ticket.get('FlightNumber')
-            key = f'{carrier_id}-{flight_num}'
+            key = f'{onward_ticket.carrier_id}-{onward_ticket.flight_number}'
 
-        if key not in data.keys():
-            data[key] = []
+        yield key, tickets
 
-        data[key].append(tickets)
-        elem.clear()
-    root.clear()
 
-    log.info(f'QTY of tickets {count} in TAG OnwardPricedItinerary | '
-             f'{filename}')
-    log.info(f'PARSING DATA  {time.time() - start} sec')
-    return data
+def ticket_to_dict(ticket, source: str):
+    """
+    Сериализация билета из diff_parse_xml в форму ответа /v1/onward_diff
+
+    :param
+        * *ticket* (``Segment or tuple``) -- билет или билеты с пересадками
+    :param
+        * *source* (``str``) -- отправная точка маршрута
+
+    :rtype: (``dict or list``)
+    :return: данные билета(ов) с развёрнутым перевозчиком
+    """
+    if isinstance(ticket, tuple):
+        return [x.to_flat_dict() for x in ticket]
+    # одиночный билет с чужой отправной точкой исторически не разворачивался
+    if ticket.source == source:
+        return ticket.to_flat_dict()
+    return ticket.to_dict()
+
+
+def _segments(ticket) -> tuple:
+    return ticket if isinstance(ticket, tuple) else (ticket, )
+
+
+def _ticket_delta(ticket, new_ticket):
+    """
+    Поля билета(ов) new_ticket, отличающиеся от ticket. Для билетов с
+    пересадками - список различий по каждому билету ticket
 
+    :param
+        * *ticket* (``Segment or tuple``) -- сравнивающий билет
+    :param
+        * *new_ticket* (``Segment or tuple``) -- сравниваемый билет
 
-async def compare_xml(data_f1: dict, data_f2: dict) -> dict:
+    :rtype: (``dict or list``)
+    :return: различия в форме {тег: новое значение}
     """
-    Получение различия между двумя файлами. Сравниваются данные, полученные
-    из метода diff_parse_xml
+    new_segments = _segments(new_ticket)
+    delta = list()
+    for num, old in enumerate(_segments(ticket)):
+        if num >= len(new_segments):
+            delta.append(dict())
+            continue
+        old_items = dict(old.flat_items())
+        delta.append({k: v for k, v in new_segments[num].flat_items()
+                      if k not in old_items or old_items[k] != v})
+    return delta if isinstance(ticket, tuple) else delta[0]
+
+
+def compare_flight(tickets: list, new_tickets: Optional[list],
+                   source: str) -> tuple:
+    """
+    Сравнение билетов одного ключа '{ID перевозчика}-{номер рейса}' по
+    порядку следования
+
+    :param
+        * *tickets* (``list``) -- билеты сравнивающего файла
+    :param
+        * *new_tickets* (``list``) -- билеты сравниваемого файла, None -
+        ключа нет
+    :param
+        * *source* (``str``) -- отправная точка маршрута
+
+    :rtype: (``tuple``)
+    :return: различия, новые и неправильные билеты и оставшиеся без пары
+    билеты сравниваемого файла в форме ответа
+    """
+    def to_dicts(values) -> list:
+        return [ticket_to_dict(x, source) for x in values]
+
+    if not new_tickets:
+        return [], to_dicts(tickets), [], []
+
+    rest = deque(new_tickets)
+    diff_tickets = list()
+    new_val = list()
+    wrong_val = list()
+    for ticket in tickets:
+        if not rest:
+            if _segments(ticket)[0].source == source:
+                new_val.append(ticket)
+            else:
+                wrong_val.append(ticket)
+            continue
+
+        new_ticket = rest.popleft()
+        if isinstance(ticket, tuple) and ticket[0].source != source:
+            # перелёт с пересадками из чужой отправной точки не
+            # сравнивается, его пара - новый или неправильный билет
+            wrong_val.append(ticket)
+            if _segments(new_ticket)[0].source == source:
+                new_val.append(new_ticket)
+            else:
+                wrong_val.append(new_ticket)
+            continue
+
+        diff_tickets.append({
+            'ticket': ticket_to_dict(ticket, source),
+            'new_ticket': ticket_to_dict(new_ticket, source),
+            'difference': _ticket_delta(ticket, new_ticket)
+        })
+    return diff_tickets, to_dicts(new_val), to_dicts(wrong_val), \
+        to_dicts(rest)
+
+
+async def compare_xml(data_f1: dict, data_f2: dict, source: str) -> dict:
+    """
+    Получение различия между двумя файлами в пуле парсинга, event loop
+    свободен на время сравнения
 
     :param
         * *data_f1* (``dict``) -- данные по полетам сравнивающего файла
     :param
         * *data_f2* (``dict``) -- данные по полетам сравниваемого файла
+    :param
+        * *source* (``str``) -- отправная точка маршрута
+
+    :rtype: (``dict``)
+    :return: результат сравнения в форме diff_onward
+    """
+    return await parse_executor.run(diff_onward, data_f1, data_f2, source)
+
+
+def diff_onward(data_f1: dict, data_f2: dict, source: str) -> dict:
+    """
+    Синхронное получение различия между двумя файлами. Сравниваются данные,
+    полученные из метода diff_parse_xml, входные данные не изменяются.
+
+    Билеты внутри ключа '{ID перевозчика}-{номер рейса}' сопоставляются по
+    порядку следования, для пар считаются отличающиеся поля. Билеты без
+    пары попадают в новые, перелёты с пересадками из другой отправной
+    точки - в неправильные. Сложность линейна от количества билетов
+
+    :param
+        * *data_f1* (``dict``) -- данные по полетам сравнивающего файла
+    :param
+        * *data_f2* (``dict``) -- данные по полетам сравниваемого файла
+    :param
+        * *source* (``str``) -- отправная точка маршрута
 
     :rtype: (``dict``)
     :return: результат сравнения, в виде
@@ -267,85 +986,37 @@ async def compare_xml(data_f1: dict, data_f2: dict) -> dict:
         точкой маршрута)
     }
     """
-    compare = dict()
+    start = time.time()
     new = list()
     wrong = list()
     difference = list()
-    allowed_source = 'DXB'
-    for flight_key, val_list in data_f1.items():
-        diff_tickets = list()
-        new_val = list()
-        wrong_val = list()
-        val_to_compare = data_f2.get(flight_key)
-        if val_to_compare:
-
-            while val_list:
-                val = val_list.pop(0)
-                if len(val_to_compare) > 0:
-                    to_compare = val_to_compare.pop(0)
-                    ticket_compare = dict()
-                    if isinstance(val, list):
-
-                        if val[0].get('Source') == allowed_source:
-                            val_diff = list()
-                            for num, el in enumerate(val):
-                                diff = set(to_compare[num].items()) - set(
-                                    el.items())
-                                val_diff.append(dict(diff))
-
-                            ticket_compare['ticket'] = val
-                            ticket_compare['new_ticket'] = to_compare
-                            ticket_compare['difference'] = val_diff
-                            diff_tickets.append(ticket_compare)
-                        else:
-                            wrong_val.append(val)
-
-                            if to_compare[0].get('Source') == allowed_source:
-                                new_val.append(to_compare)
-                            else:
-                                wrong_val.append(to_compare)
-
-                    else:
-                        diff = set(to_compare.items()) - set(val.items())
-                        ticket_compare['ticket'] = val
-                        ticket_compare['new_ticket'] = to_compare
-                        ticket_compare['difference'] = dict(diff)
-                        diff_tickets.append(ticket_compare)
-                else:
-
-                    to_new = False
-                    if isinstance(val, list):
-                        if val[0].get('Source') == allowed_source:
-                            to_new = True
-                    else:
-                        if val.get('Source') == allowed_source:
-                            to_new = True
-
-                    if to_new:
-                        new_val.append(val)
-                    else:
-                        wrong_val.append(val)
-
-            # добавляем отсепарированные данные
-            if diff_tickets:
-                difference.append({flight_key: diff_tickets})
-
-            if new_val:
-                new.append({flight_key: new_val})
-
-            if wrong_val:
-                wrong.append({flight_key: wrong_val})
-
-            if val_to_compare:
-                new.append({flight_key: val_to_compare})
 
-        else:
-            new.append({flight_key: val_list})
+    for flight_key, tickets in data_f1.items():
+        check_cancelled()
+        diff_tickets, new_val, wrong_val, rest = compare_flight(
+            tickets, data_f2.get(flight_key), source)
+
+        # добавляем отсепарированные данные
+        if diff_tickets:
+            difference.append({flight_key: diff_tickets})
 
+        if new_val:
+            new.append({flight_key: new_val})
+
+        if wrong_val:
+            wrong.append({flight_key: wrong_val})
+
+        if rest:
+            new.append({flight_key: rest})
+
+    compare = dict()
     compare['differences'] = difference
     compare['new_tickets'] = new
     compare['wrong_tickets'] = wrong
 
-    log.info(f'{compare}')
+    elapsed = observe_stage('diff', start)
+    log.info(f'COMPARING DATA {elapsed} sec | '
+             f'{len(difference)} differences, {len(new)} new, '
+             f'{len(wrong)} wrong')
 
     return compare